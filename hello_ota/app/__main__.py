@@ -0,0 +1,6 @@
+"""
+以 `python3 <版本目錄或.pyz>` 執行時的進入點
+"""
+import main
+
+main.main()
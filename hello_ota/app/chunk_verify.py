@@ -0,0 +1,125 @@
+"""
+分塊驗證 - 以雜湊樹逐區塊驗證更新包
+
+更新資訊的 chunks 欄位列出每個區塊的SHA256與雜湊樹根。下載時每個區塊寫入前立即驗證，
+損毀或中斷只需重新下載受影響的區塊；已驗證的區塊記錄在狀態檔，
+續傳時直接信任，不需重新計算整個暫存檔的雜湊。
+"""
+import json
+import hashlib
+from pathlib import Path
+from flash_io import atomic_write_json
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# 區塊數上限，避免更新資訊過大（超過時加大區塊）
+MAX_CHUNKS = 1024
+
+def merkle_root(leaf_hashes):
+    """由區塊雜湊（hex）計算雜湊樹根；奇數個節點時最後一個直接進入上一層"""
+    level = [bytes.fromhex(leaf) for leaf in leaf_hashes]
+    if not level:
+        return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1:
+        paired = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0].hex()
+
+def choose_chunk_size(file_size):
+    """預設 1 MB，區塊數超過上限時加倍"""
+    chunk_size = DEFAULT_CHUNK_SIZE
+    while file_size > chunk_size * MAX_CHUNKS:
+        chunk_size *= 2
+    return chunk_size
+
+def build_chunk_info(file_path, chunk_size=None):
+    """計算更新包的區塊雜湊與雜湊樹根（寫入更新資訊的 chunks 欄位）"""
+    file_size = Path(file_path).stat().st_size
+    chunk_size = chunk_size or choose_chunk_size(file_size)
+    hashes = []
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hashes.append(hashlib.sha256(chunk).hexdigest())
+    return {"size": chunk_size, "hashes": hashes, "root": merkle_root(hashes)}
+
+class ChunkManifest:
+    """更新包的區塊清單"""
+
+    def __init__(self, chunk_size, hashes, total_size, root):
+        self.chunk_size = chunk_size
+        self.hashes = hashes
+        self.total_size = total_size
+        self.root = root
+
+    @classmethod
+    def from_update_info(cls, update_info):
+        """由更新資訊建立，沒有 chunks 欄位時回傳None；清單不一致時拋出例外"""
+        chunks = update_info.get('chunks')
+        if not chunks:
+            return None
+
+        chunk_size = chunks.get('size')
+        hashes = chunks.get('hashes') or []
+        total_size = update_info.get('size')
+        if not isinstance(chunk_size, int) or chunk_size <= 0 or not isinstance(total_size, int):
+            raise Exception("區塊清單缺少區塊大小或檔案大小")
+        if len(hashes) != -(-total_size // chunk_size):
+            raise Exception(f"區塊數量與檔案大小不符: {len(hashes)}")
+        try:
+            root = merkle_root(hashes)
+        except ValueError:
+            raise Exception("區塊雜湊格式錯誤")
+        if root != chunks.get('root'):
+            raise Exception("區塊清單與雜湊樹根不符")
+        return cls(chunk_size, hashes, total_size, root)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def chunk_range(self, index):
+        """區塊的 (起始位置, 長度)"""
+        start = index * self.chunk_size
+        return start, min(self.chunk_size, self.total_size - start)
+
+    def chunk_index(self, offset):
+        return offset // self.chunk_size
+
+    def verify(self, index, data):
+        return hashlib.sha256(data).hexdigest() == self.hashes[index]
+
+class ChunkState:
+    """已驗證區塊的狀態檔（<檔案>.chunks），只在資料同步到儲存裝置後才記錄"""
+
+    def __init__(self, file_path, manifest):
+        self.file_path = Path(file_path)
+        self.path = self.file_path.with_name(self.file_path.name + ".chunks")
+        self.manifest = manifest
+        self.verified = set()
+
+    def exists(self):
+        return self.path.exists()
+
+    def load(self):
+        """載入屬於同一個更新包（雜湊樹根相同）的已驗證區塊，回傳數量"""
+        self.verified = set()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('root') == self.manifest.root and \
+                    self.file_path.stat().st_size == self.manifest.total_size:
+                self.verified = {index for index in state.get('verified', []) if 0 <= index < len(self.manifest)}
+        except (OSError, ValueError, TypeError):
+            pass
+        return len(self.verified)
+
+    def save(self):
+        atomic_write_json(self.path, {"root": self.manifest.root, "verified": sorted(self.verified)})
+
+    def missing(self):
+        return [index for index in range(len(self.manifest)) if index not in self.verified]
+
+    def clear(self):
+        self.verified = set()
+        if self.path.exists():
+            self.path.unlink()
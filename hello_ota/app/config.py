@@ -1,15 +1,41 @@
 """
 設定管理模組
 """
-import json
 import os
+import json
+import atexit
+import threading
 from pathlib import Path
+from contextlib import contextmanager
+from flash_io import atomic_write_json
+
+DEFAULT_CONFIG_FILE = "/etc/hello-ota/config.json"
+
+# 多元件更新隨版本發佈的設定，放在版本槽位內，回滾時一併還原
+RELEASE_CONFIG_FILE = Path(__file__).resolve().parent / "release_config.json"
+
+_MISSING = object()
+
+# 可用環境變數指定設定檔，供測試或同一台機器執行多個實例
+CONFIG_ENV = "HELLO_OTA_CONFIG"
 
 class Config:
-    def __init__(self, config_file="/etc/hello-ota/config.json"):
+    def __init__(self, config_file=DEFAULT_CONFIG_FILE, flush_delay=1.0, release_config_file=RELEASE_CONFIG_FILE):
         self.config_file = Path(config_file)
+        self.release_config_file = Path(release_config_file)
         self.config = {}
+        self.release_config = {}
+
+        # 批次寫入：在 flush_delay 秒內的多次 set 只寫入一次
+        self.flush_delay = flush_delay
+        self.write_count = 0
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._flush_timer = None
+        self._transaction_depth = 0
+
         self.load_config()
+        atexit.register(self.flush)
 
     def load_config(self):
         """載入設定檔"""
@@ -19,6 +45,11 @@ class Config:
         else:
             self.create_default_config()
 
+        # 版本設定只讀取，set/save 只寫入本機設定檔
+        if self.release_config_file.exists():
+            with open(self.release_config_file, 'r', encoding='utf-8') as f:
+                self.release_config = json.load(f)
+
     def create_default_config(self):
         """建立預設設定檔"""
         self.config = {
@@ -27,16 +58,56 @@ class Config:
                 "port": 8080,
                 "host": "0.0.0.0",
                 "heartbeat_interval": 30,
-                "log_level": "INFO"
+                "log_level": "INFO",
+                "log_max_bytes": 1048576,
+                "log_backup_count": 5,
+                "log_rate_limit": 1.0,
+                "log_rate_limit_loggers": ["hello_ota.progress"]
             },
             "ota": {
                 "enabled": True,
                 "update_server": "http://localhost:9000",
                 "check_interval": 300,
                 "backup_count": 3,
-                "auto_update": False
+                "auto_update": False,
+                "history_retention": 50,
+                "service_manager": "systemd",
+                "restart_command": [],
+                "health_deadline": 60,
+                "io_buffer_size": 1048576,
+                "tmpfs_reserve": 67108864,
+                "trace_memory": True,
+                "background_worker": True,
+                "worker_nice": 10,
+                "max_cpu_percent": 60,
+                "max_load_per_cpu": 1.5,
+                "worker_timeout": 3600,
+                "maintenance_window": "",
+                "apply_after_idle_minutes": 0,
+                "activity_file": "",
+                "peer_cache": False,
+                "peers": [],
+                "peer_cache_keep": 2,
+                "peer_timeout": 5,
+                "download_retries": 3,
+                "download_connect_timeout": 10,
+                "download_read_timeout": 60,
+                "mirror_probe_bytes": 65536,
+                "mirror_probe_timeout": 2,
+                "mirror_probe_ttl": 3600,
+                "component_download_workers": 4,
+                "long_poll": True,
+                "long_poll_timeout": 60,
+                "transport": "http",
+                "device_id": "",
+                "mqtt_host": "localhost",
+                "mqtt_port": 1883,
+                "mqtt_topic_prefix": "hello-ota"
             },
             "system": {
+                "app_dir": "/opt/hello-ota",
+                "backup_dir": "/var/backups/hello-ota",
+                "temp_dir": "/tmp/hello-ota-update",
                 "data_dir": "/var/lib/hello-ota",
                 "log_dir": "/var/log/hello-ota",
                 "pid_file": "/var/run/hello-ota.pid"
@@ -48,35 +119,108 @@ class Config:
         self.save_config()
 
     def save_config(self):
-        """儲存設定檔"""
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            json.dump(self.config, f, indent=2, ensure_ascii=False)
+        """儲存設定檔（暫存檔 + fsync + rename，斷電時不會留下半個檔案）"""
+        with self._lock:
+            self._cancel_flush_timer()
+
+            atomic_write_json(self.config_file, self.config, indent=2, ensure_ascii=False)
+            self._dirty = False
+            self.write_count += 1
+
+    def flush(self):
+        """立即寫入尚未儲存的變更"""
+        with self._lock:
+            if self._dirty:
+                self.save_config()
+
+    @contextmanager
+    def transaction(self):
+        """多個鍵的批次更新，離開區塊時只寫入一次"""
+        with self._lock:
+            self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self.flush()
+
+    def _schedule_flush(self):
+        """排程延遲寫入，窗口內的變更合併為一次寫入"""
+        if self._transaction_depth > 0 or self._flush_timer is not None:
+            return
+
+        if self.flush_delay <= 0:
+            self.save_config()
+            return
+
+        self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+    def _cancel_flush_timer(self):
+        """取消尚未觸發的延遲寫入"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
 
     def get(self, key, default=None):
-        """取得設定值，支援點號分隔的巢狀鍵"""
+        """取得設定值，支援點號分隔的巢狀鍵
+
+        優先順序：版本設定（release_config.json）> 本機設定檔 > default。
+        版本設定隨版本槽位切換與回滾，因此本機無法以 set 覆寫其中的鍵。
+        """
         keys = key.split('.')
-        value = self.config
+        value = self._lookup(self.release_config, keys)
+        if value is _MISSING:
+            value = self._lookup(self.config, keys)
+        return default if value is _MISSING else value
 
+    @staticmethod
+    def _lookup(value, keys):
         for k in keys:
             if isinstance(value, dict) and k in value:
                 value = value[k]
             else:
-                return default
-
+                return _MISSING
         return value
 
     def set(self, key, value):
-        """設定值，支援點號分隔的巢狀鍵"""
+        """設定值，支援點號分隔的巢狀鍵；版本設定中已有的鍵拒絕寫入"""
         keys = key.split('.')
-        config = self.config
+        if self._lookup(self.release_config, keys) is not _MISSING:
+            # 寫入本機設定檔後 get 仍會回傳版本設定的值，直接拒絕以免設定看似成功
+            raise Exception(f"設定 {key} 由目前版本的 release_config.json 提供，無法在本機覆寫")
 
-        for k in keys[:-1]:
-            if k not in config:
-                config[k] = {}
-            config = config[k]
+        with self._lock:
+            config = self.config
 
-        config[keys[-1]] = value
-        self.save_config()
+            for k in keys[:-1]:
+                if k not in config:
+                    config[k] = {}
+                config = config[k]
+
+            config[keys[-1]] = value
+            self._dirty = True
+            self._schedule_flush()
+
+class _LazyConfig:
+    """首次存取時才建立設定實例，避免匯入模組時就讀寫設定檔"""
+
+    def __init__(self):
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def _get_instance(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = Config(os.environ.get(CONFIG_ENV, DEFAULT_CONFIG_FILE))
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._get_instance(), name)
 
 # 全域設定實例
-config = Config()
\ No newline at end of file
+config = _LazyConfig()
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+SD卡友善的檔案寫入層 - 預先配置空間、對齊的大區塊寫入、提交點批次fsync
+
+廉價SD卡對大量小寫入與頻繁fsync特別敏感（速度慢、寫入放大、磨損）。
+同一次更新的下載、解壓縮與備份都經由同一個 FlashWriteSession，
+寫入時不逐檔fsync，而在提交點一次同步所有檔案與目錄項目，並統計寫入量。
+"""
+import os
+import json
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+# 寫入以頁面大小對齊，避免同一個快閃頁面被多次改寫
+ALIGNMENT = 4096
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+MAX_BUFFER_SIZE = 8 * 1024 * 1024
+
+def preallocate(fd, size):
+    """預先配置檔案空間以減少碎片，檔案系統不支援時回傳False"""
+    if not size or size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError:
+        return False
+
+def fsync_dir(directory):
+    """同步目錄項目，讓新建立或rename的檔案在斷電後仍存在"""
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.fsync(dir_fd)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(dir_fd)
+
+def atomic_write_json(path, data, **dump_options):
+    """以暫存檔 + fsync + rename 寫入JSON檔並同步目錄項目，斷電時不會留下半個檔案"""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, **dump_options)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    fsync_dir(path.parent)
+
+def device_write_bytes():
+    """本行程實際送往儲存裝置的位元組數（/proc/self/io），無法取得時回傳None"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+class FlashFile:
+    """以對齊的大區塊寫入單一檔案，關閉時不fsync，由工作階段於提交點同步"""
+
+    def __init__(self, session, path, size=None, mode=0o644):
+        self.path = Path(path)
+        self._session = session
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, mode)
+        self._preallocated = preallocate(self._fd, size)
+        self._buffer = bytearray()
+        self.size = 0
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._session.buffer_size:
+            aligned = len(self._buffer) - len(self._buffer) % ALIGNMENT
+            self._write_out(aligned)
+        return len(data)
+
+    def _write_out(self, length):
+        with memoryview(self._buffer) as view, view[:length] as chunk:
+            written = 0
+            while written < length:
+                with chunk[written:] as remaining:
+                    written += os.write(self._fd, remaining)
+        del self._buffer[:length]
+        self.size += length
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            if self._buffer:
+                self._write_out(len(self._buffer))
+            # 預先配置的大小與實際不同時截斷
+            if self._preallocated:
+                os.ftruncate(self._fd, self.size)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+        self._session._track(self.path, self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class FlashWriteSession:
+    """一次更新的寫入工作階段，統計寫入量並於提交點批次同步"""
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, pace=None):
+        buffer_size = min(buffer_size, MAX_BUFFER_SIZE)
+        self.buffer_size = max(ALIGNMENT, buffer_size - buffer_size % ALIGNMENT)
+        self.bytes_written = 0
+        self.files_written = 0
+        self.fsync_count = 0
+        self._pending_files = []
+        self._pending_dirs = set()
+        self._lock = threading.Lock()
+        self._device_start = device_write_bytes()
+        # 每寫入一個區塊呼叫一次，讓呼叫端可依系統負載暫停
+        self._pace = pace or (lambda: None)
+
+    def open(self, path, size=None, mode=0o644):
+        """開啟寫入檔案，size 已知時預先配置空間"""
+        return FlashFile(self, path, size, mode)
+
+    def _track(self, path, size):
+        with self._lock:
+            self.bytes_written += size
+            self.files_written += 1
+            self._pending_files.append(Path(path))
+            self._pending_dirs.add(Path(path).parent)
+
+    def track_existing(self, path):
+        """納入其他工具寫入的檔案（例如編譯產生的 .pyc），一併統計與同步"""
+        self._track(path, Path(path).stat().st_size)
+
+    def copy_file(self, src, dst):
+        """複製檔案，可作為 shutil.copytree 的 copy_function"""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        size = os.path.getsize(src)
+        with open(src, 'rb') as source, self.open(dst, size=size) as target:
+            for chunk in iter(lambda: source.read(self.buffer_size), b""):
+                target.write(chunk)
+                self._pace()
+        shutil.copystat(src, dst)
+        return dst
+
+    def copy_tree(self, src, dst):
+        """複製目錄（保留符號連結）"""
+        shutil.copytree(src, dst, symlinks=True, copy_function=self.copy_file)
+        with self._lock:
+            for directory, _, _ in os.walk(dst):
+                self._pending_dirs.add(Path(directory).parent)
+
+    def extract_tar(self, tar, dest):
+        """解壓縮tar檔，拒絕指向目標目錄之外的路徑"""
+        dest = Path(dest).resolve()
+
+        def inside(path):
+            return path == dest or dest in path.parents
+
+        for member in tar:
+            target = (dest / member.name).resolve()
+            if not inside(target):
+                raise Exception(f"更新包含有不安全的路徑: {member.name}")
+
+            if member.isdir():
+                target.mkdir(parents=True, exist_ok=True)
+                with self._lock:
+                    self._pending_dirs.add(target.parent)
+            elif member.isfile():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                source = tar.extractfile(member)
+                with self.open(target, size=member.size, mode=member.mode & 0o777) as f:
+                    for chunk in iter(lambda: source.read(self.buffer_size), b""):
+                        f.write(chunk)
+                        self._pace()
+                os.utime(target, (member.mtime, member.mtime))
+            elif member.issym():
+                if not inside((target.parent / member.linkname).resolve()):
+                    raise Exception(f"更新包含有不安全的符號連結: {member.name}")
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.symlink(member.linkname, target)
+                with self._lock:
+                    self._pending_dirs.add(target.parent)
+            else:
+                raise Exception(f"更新包含有不支援的項目: {member.name}")
+
+    def commit(self):
+        """提交點：一次同步所有待同步的檔案與目錄項目"""
+        with self._lock:
+            files, self._pending_files = self._pending_files, []
+            dirs, self._pending_dirs = self._pending_dirs, set()
+
+        for path in files:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+                self.fsync_count += 1
+            finally:
+                os.close(fd)
+
+        # 深層目錄先同步，上層目錄項目最後寫入
+        for directory in sorted(dirs, key=lambda d: len(d.parts), reverse=True):
+            if fsync_dir(directory):
+                self.fsync_count += 1
+
+    def report(self):
+        """本次工作階段的寫入統計"""
+        device_bytes = None
+        device_now = device_write_bytes()
+        if self._device_start is not None and device_now is not None:
+            device_bytes = device_now - self._device_start
+
+        return {
+            "bytes_written": self.bytes_written,
+            "files_written": self.files_written,
+            "fsync_count": self.fsync_count,
+            "device_write_bytes": device_bytes,
+            "write_amplification": (
+                round(device_bytes / self.bytes_written, 2)
+                if device_bytes and self.bytes_written else None
+            )
+        }
@@ -0,0 +1,103 @@
+"""
+行程內熱更新 - 只修改請求處理邏輯的版本不需重啟服務
+
+以 importlib 從新版本槽位載入 version 與 main 模組，
+替換執行中 HTTPServer 的處理器類別；行程、監聽socket與背景線程都維持不變。
+其他模組有變動時無法安全熱更新，由呼叫端改走重啟流程。
+"""
+import sys
+import hashlib
+import logging
+import importlib.util
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 可在行程內替換的模組，其餘模組持有執行中狀態，變動時必須重啟
+RELOADABLE_MODULES = ("version", "main")
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def changed_modules(old_dir, new_dir):
+    """比對兩個版本目錄，回傳新增、刪除或內容不同的模組名稱"""
+    old_files = {p.stem: p for p in Path(old_dir).glob("*.py")}
+    new_files = {p.stem: p for p in Path(new_dir).glob("*.py")}
+
+    changed = set(old_files) ^ set(new_files)
+    for name in set(old_files) & set(new_files):
+        if _file_digest(old_files[name]) != _file_digest(new_files[name]):
+            changed.add(name)
+
+    # 槽位入口檔不屬於應用程式模組
+    changed.discard("__main__")
+    return changed
+
+def _load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class HotReloader:
+    """替換執行中服務的請求處理器"""
+
+    def __init__(self, server, app, probe_timeout=5):
+        self.server = server
+        self.app = app
+        self.probe_timeout = probe_timeout
+
+    def running_dir(self):
+        """目前執行中 main 模組所在目錄"""
+        module = sys.modules.get("main") or sys.modules["__main__"]
+        return Path(module.__file__).resolve().parent
+
+    def reload(self, release_dir, version):
+        """載入新版本的處理邏輯，失敗時還原並拋出例外"""
+        release_dir = Path(release_dir)
+        if not release_dir.is_dir():
+            raise Exception(f"封存檔版本不支援熱更新: {release_dir}")
+
+        unsafe = changed_modules(self.running_dir(), release_dir) - set(RELOADABLE_MODULES)
+        if unsafe:
+            raise Exception(f"下列模組有變動，無法熱更新: {', '.join(sorted(unsafe))}")
+
+        saved_modules = {name: sys.modules.get(name) for name in RELOADABLE_MODULES}
+        saved_handler = self.server.RequestHandlerClass
+        # 新版本的 main.py 匯入時會把槽位目錄加入 sys.path，每次熱更新都會多一筆
+        saved_path = list(sys.path)
+
+        try:
+            # 先替換 version，新的 main 匯入時才會取得新版本號
+            new_version = _load_module("version", release_dir / "version.py")
+            if new_version.__version__ != version:
+                raise Exception(f"版本不符: {new_version.__version__} != {version}")
+            sys.modules["version"] = new_version
+
+            new_main = _load_module("main", release_dir / "main.py")
+            new_main.app = self.app
+            sys.modules["main"] = new_main
+
+            self.server.RequestHandlerClass = new_main.HelloOTAHandler
+
+            if not self._probe(version):
+                raise Exception("熱更新後 /version 未回報新版本")
+
+        except Exception:
+            self.server.RequestHandlerClass = saved_handler
+            for name, module in saved_modules.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+            raise
+        finally:
+            sys.path[:] = saved_path
+
+        logger.info(f"已熱更新到版本 {version}")
+
+    def _probe(self, version):
+        # 由服務本身回應，確認新的處理器實際生效
+        from updater import wait_healthy
+        return wait_healthy(self.server.server_port, self.probe_timeout, version) is not None
@@ -0,0 +1,159 @@
+"""
+日誌管線 - 非阻塞佇列、依大小輪替壓縮、依呼叫位置限流
+"""
+import os
+import gzip
+import time
+import queue
+import shutil
+import logging
+import threading
+import logging.handlers
+
+# 下載進度等高頻日誌使用的日誌器，預設只有它受呼叫位置限流
+PROGRESS_LOGGER = "hello_ota.progress"
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """依檔案大小輪替，並將封存檔以gzip壓縮"""
+
+    def __init__(self, filename, max_bytes=1024 * 1024, backup_count=5):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.namer = self._gz_namer
+        self.rotator = self._gz_rotator
+
+    @staticmethod
+    def _gz_namer(name):
+        return name + ".gz"
+
+    @staticmethod
+    def _gz_rotator(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+class CallSiteRateLimitFilter(logging.Filter):
+    """依呼叫位置(檔案+行號)限制日誌頻率
+
+    同一位置在 interval 秒內只放行一筆，WARNING以上不受限制。
+    被丟棄的筆數會附加在下一筆放行的訊息後，關閉時由 flush() 取出尚未回報的部分。
+    loggers 為受限流的日誌器名稱（含子日誌器），None 表示所有日誌器。
+    """
+
+    def __init__(self, interval=1.0, max_level=logging.INFO, loggers=None):
+        super().__init__()
+        self.interval = interval
+        self.max_level = max_level
+        self.loggers = tuple(loggers) if loggers is not None else None
+        self._last_emit = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def _applies_to(self, name):
+        if self.loggers is None:
+            return True
+        return any(name == logger_name or name.startswith(logger_name + ".") for logger_name in self.loggers)
+
+    def filter(self, record):
+        if record.levelno > self.max_level or not self._applies_to(record.name):
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+
+        with self._lock:
+            last = self._last_emit.get(key)
+            if last is not None and now - last < self.interval:
+                count, _ = self._suppressed.get(key, (0, None))
+                self._suppressed[key] = (count + 1, record)
+                return False
+
+            self._last_emit[key] = now
+            suppressed, _ = self._suppressed.pop(key, (0, None))
+
+        if suppressed:
+            self._annotate(record, suppressed)
+        return True
+
+    def flush(self):
+        """取出尚未回報的略過記錄：每個呼叫位置回傳最後被略過的一筆，並附加之前略過的筆數"""
+        with self._lock:
+            pending, self._suppressed = self._suppressed, {}
+        records = []
+        for count, record in pending.values():
+            if count > 1:
+                self._annotate(record, count - 1)
+            records.append(record)
+        return records
+
+    @staticmethod
+    def _annotate(record, suppressed):
+        record.msg = f"{record.getMessage()} (略過 {suppressed} 筆重複訊息)"
+        record.args = None
+
+class ProgressThrottle:
+    """進度日誌節流：進度前進 step_percent 或經過 interval 秒才回報一次"""
+
+    def __init__(self, step_percent=10, interval=5.0):
+        self.step_percent = step_percent
+        self.interval = interval
+        self._last_percent = None
+        self._last_time = 0.0
+
+    def should_report(self, done, total):
+        if total <= 0:
+            return False
+
+        percent = done * 100.0 / total
+        now = time.monotonic()
+
+        if (self._last_percent is None
+                or percent >= 100
+                or percent - self._last_percent >= self.step_percent
+                or now - self._last_time >= self.interval):
+            self._last_percent = percent
+            self._last_time = now
+            return True
+
+        return False
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    """停止時先寫出限流略過、尚未回報的記錄，再寫出佇列中剩餘的記錄"""
+
+    def __init__(self, log_queue, *handlers, rate_filter=None, respect_handler_level=False):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.rate_filter = rate_filter
+
+    def stop(self):
+        if self.rate_filter is not None:
+            for record in self.rate_filter.flush():
+                self.queue.put_nowait(record)
+        super().stop()
+
+def setup_queue_logging(level, handlers, rate_limit_interval=1.0, rate_limit_loggers=(PROGRESS_LOGGER,)):
+    """以QueueHandler/QueueListener設定根日誌器
+
+    呼叫端只把記錄放進佇列，實際的檔案與終端輸出由背景線程處理。
+    呼叫位置限流只套用到 rate_limit_loggers 列出的日誌器（預設為下載進度）。
+    回傳的listener需在關閉時呼叫 stop() 以寫出剩餘記錄。
+    """
+    log_queue = queue.SimpleQueue()
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    rate_filter = None
+    if rate_limit_interval > 0 and rate_limit_loggers:
+        rate_filter = CallSiteRateLimitFilter(rate_limit_interval, loggers=rate_limit_loggers)
+        queue_handler.addFilter(rate_filter)
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = FlushingQueueListener(log_queue, *handlers, rate_filter=rate_filter, respect_handler_level=True)
+    listener.start()
+    return listener
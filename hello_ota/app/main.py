@@ -3,59 +3,112 @@
 Hello OTA - Python OTA更新示範應用程式
 """
 
-import os
 import sys
+from pathlib import Path
+
+# 設定模組路徑：使用解析後的版本槽位，不經過 current 符號連結。
+# current 切換到新版本後（熱更新或交接重啟前），執行中行程的延遲匯入仍來自啟動時的版本
+APP_DIR = Path(__file__).resolve().parent
+sys.path[:] = [entry for entry in sys.path if not entry or Path(entry).resolve() != APP_DIR]
+sys.path.insert(0, str(APP_DIR))
+
+# 多元件更新的相依套件與程式碼放在同一個版本槽位
+if (APP_DIR / "_deps").is_dir():
+    sys.path.insert(1, str(APP_DIR / "_deps"))
+
+# 啟動效能分析需在其他模組匯入前啟用
+from startup_profiler import StartupProfiler
+profiler = StartupProfiler() if "--profile-startup" in sys.argv else None
+if profiler:
+    profiler.import_timer.install()
+
+import os
 import json
 import time
 import signal
 import logging
 import threading
+from contextlib import nullcontext
 from datetime import datetime
-from pathlib import Path
-from http.server import HTTPServer, BaseHTTPRequestHandler
-
-# 設定模組路徑
-sys.path.insert(0, str(Path(__file__).parent))
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 from version import __version__, get_version_info
 from config import config
 from ota_manager import OTAManager
+from log_pipeline import CompressingRotatingFileHandler, setup_queue_logging, PROGRESS_LOGGER
+from service_notify import notify, inherited_listen_socket
+from hot_reload import HotReloader
+from update_scheduler import UpdateScheduler, MaintenanceWindow, ActivityTracker
+from update_watcher import UpdateWatcher
+from update_transport import HTTPTransport, create_transport
+from peer_cache import PACKAGES_PATH
+
+# 服務器檢查關閉請求的間隔（秒）
+SHUTDOWN_POLL_INTERVAL = 0.05
 
 # 設定日誌
 def setup_logging():
+    """設定非阻塞日誌，回傳需在關閉時停止的listener"""
     log_level = getattr(logging, config.get('app.log_level', 'INFO'))
     log_dir = Path(config.get('system.log_dir', '/var/log/hello-ota'))
     log_dir.mkdir(parents=True, exist_ok=True)
 
-    logging.basicConfig(
-        level=log_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_dir / 'hello-ota.log'),
-            logging.StreamHandler(sys.stdout)
-        ]
+    file_handler = CompressingRotatingFileHandler(
+        log_dir / 'hello-ota.log',
+        max_bytes=config.get('app.log_max_bytes', 1024 * 1024),
+        backup_count=config.get('app.log_backup_count', 5)
+    )
+
+    return setup_queue_logging(
+        log_level,
+        [file_handler, logging.StreamHandler(sys.stdout)],
+        rate_limit_interval=config.get('app.log_rate_limit', 1.0),
+        rate_limit_loggers=config.get('app.log_rate_limit_loggers', [PROGRESS_LOGGER])
     )
 
 logger = logging.getLogger(__name__)
 
+# 請求內容整個讀入記憶體，限制大小
+MAX_REQUEST_BODY = 64 * 1024
+
+# 監控用的請求不算機器活動
+MONITORING_PATHS = ('/health', '/version', '/ota/status', '/ota/history')
+
+def _phase(name):
+    """啟動階段計時，未啟用分析時不做任何事"""
+    return profiler.phase(name) if profiler else nullcontext()
+
 class HelloOTAHandler(BaseHTTPRequestHandler):
     """HTTP請求處理器"""
 
     def do_GET(self):
         """處理GET請求"""
-        if self.path == '/':
+        path = urlparse(self.path).path
+        query = parse_qs(urlparse(self.path).query)
+        self._record_activity(path)
+
+        if path == '/':
             self._send_response(200, self._get_status())
-        elif self.path == '/version':
+        elif path == '/version':
             self._send_response(200, get_version_info())
-        elif self.path == '/health':
+        elif path == '/health':
             self._send_response(200, {"status": "healthy", "timestamp": datetime.now().isoformat()})
-        elif self.path == '/ota/status':
+        elif path == '/ota/status':
             self._send_response(200, self._get_ota_status())
+        elif path == '/ota/history':
+            self._handle_history(query)
+        elif path == PACKAGES_PATH:
+            self._send_response(200, app.ota_manager.peer_cache.status())
+        elif path.startswith(PACKAGES_PATH + '/'):
+            self._send_package(path[len(PACKAGES_PATH) + 1:])
         else:
             self._send_response(404, {"error": "Not Found"})
 
     def do_POST(self):
         """處理POST請求"""
+        self._record_activity(self.path)
+
         if self.path == '/trigger_update':
             self._handle_trigger_update()
         elif self.path == '/ota/check':
@@ -63,6 +116,11 @@ class HelloOTAHandler(BaseHTTPRequestHandler):
         else:
             self._send_response(404, {"error": "Not Found"})
 
+    def _record_activity(self, path):
+        """業務請求會延後閒置時才套用的更新"""
+        if path not in MONITORING_PATHS and not path.startswith(PACKAGES_PATH):
+            app.activity.touch()
+
     def _send_response(self, status_code, data):
         """發送JSON回應"""
         self.send_response(status_code)
@@ -70,6 +128,25 @@ class HelloOTAHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'))
 
+    def _send_package(self, checksum):
+        """提供已驗證的更新包給同一站點的節點"""
+        peer_cache = app.ota_manager.peer_cache
+        package_file = peer_cache.package_file(checksum)
+        if package_file is None:
+            self._send_response(404, {"error": "Package not found"})
+            return
+
+        with open(package_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            # 以 sendfile 由核心直接傳送，不經過Python緩衝
+            self.wfile.flush()
+            self.connection.sendfile(f)
+        peer_cache.record_served(size)
+
     def _get_status(self):
         """取得應用程式狀態"""
         uptime = time.time() - app.start_time
@@ -93,13 +170,48 @@ class HelloOTAHandler(BaseHTTPRequestHandler):
             "current_version": __version__,
             "ota_enabled": config.get('ota.enabled', True),
             "last_check": getattr(app, 'last_update_check', None),
-            "update_history": app.ota_manager.get_update_history()[-5:]  # 最近5筆
+            "memory": app.ota_manager.memory_status(),
+            "schedule": app.scheduler.status(),
+            "notifications": app.watcher.status(),
+            "transport": app.ota_manager.transport.status(),
+            "peer_cache": app.ota_manager.peer_cache.status(),
+            "mirrors": app.ota_manager.mirrors.status(),
+            "update_history": app.ota_manager.get_update_history(5)  # 最近5筆
         }
 
+    def _handle_history(self, query):
+        """處理更新歷史查詢，支援分頁與篩選"""
+        def param(name):
+            return query.get(name, [None])[0]
+
+        try:
+            offset = int(param('offset') or 0)
+            limit = min(int(param('limit') or 20), 100)
+        except ValueError:
+            self._send_response(400, {"error": "offset/limit 必須為整數"})
+            return
+
+        try:
+            result = app.ota_manager.history.query(
+                version=param('version'),
+                status=param('status'),
+                since=param('since'),
+                until=param('until'),
+                offset=max(offset, 0),
+                limit=max(limit, 1)
+            )
+        except Exception as e:
+            self._send_response(400, {"error": f"since/until 必須為ISO格式時間: {e}"})
+            return
+        self._send_response(200, result)
+
     def _handle_trigger_update(self):
         """處理觸發更新請求"""
         try:
             content_length = int(self.headers['Content-Length'])
+            if content_length > MAX_REQUEST_BODY:
+                self._send_response(413, {"error": "請求內容過大"})
+                return
             post_data = self.rfile.read(content_length)
             request_data = json.loads(post_data.decode('utf-8'))
 
@@ -118,17 +230,13 @@ class HelloOTAHandler(BaseHTTPRequestHandler):
                 "version": version,
                 "download_url": update_url,
                 "checksum": checksum,
+                "reloadable": bool(request_data.get('reloadable', False)),
                 "has_update": True,
                 "latest_version": version
             }
 
             # 在背景執行更新
-            update_thread = threading.Thread(
-                target=app._perform_update,
-                args=(update_info,)
-            )
-            update_thread.daemon = True
-            update_thread.start()
+            app.trigger_update(update_info)
 
             self._send_response(200, {
                 "message": "更新請求已接受",
@@ -163,13 +271,50 @@ class HelloOTAHandler(BaseHTTPRequestHandler):
 class HelloOTAApp:
     """Hello OTA 主應用程式"""
 
-    def __init__(self):
+    def __init__(self, mqtt_client=None):
+        """mqtt_client 為機器既有的MQTT連線，ota.transport 為 mqtt 時共用它收發更新訊息"""
         self.start_time = time.time()
         self.running = True
         self.server = None
         self.ota_manager = OTAManager()
         self.last_update_check = None
 
+        # 新版本通知與進度、結果回報的通道（HTTP或既有的MQTT連線）
+        try:
+            self.ota_manager.transport = create_transport(on_trigger=self.trigger_update, client=mqtt_client)
+        except Exception as e:
+            logger.error(f"無法建立更新傳輸，改用HTTP: {e}")
+            self.ota_manager.transport = HTTPTransport()
+
+        # 自動更新先預先下載，在維護時段或閒置時才套用
+        idle_minutes = config.get('ota.apply_after_idle_minutes', 0)
+        try:
+            window = MaintenanceWindow(config.get('ota.maintenance_window', ''))
+        except Exception as e:
+            # 設定錯誤時不可退回「立即套用」，改為不依時段自動套用
+            window = MaintenanceWindow.never(config.get('ota.maintenance_window', ''))
+            if idle_minutes:
+                logger.error(f"維護時段設定無效，只在閒置 {idle_minutes} 分鐘後套用更新: {e}")
+            else:
+                logger.error(f"維護時段設定無效，不自動套用更新（可手動觸發）: {e}")
+        self.activity = ActivityTracker(config.get('ota.activity_file') or None)
+        self.scheduler = UpdateScheduler(
+            self.ota_manager,
+            window=window,
+            idle_minutes=idle_minutes,
+            activity=self.activity
+        )
+        # 服務器支援時以長輪詢等待新版本，否則定期輪詢
+        self.watcher = UpdateWatcher(
+            self.ota_manager,
+            check_interval=config.get('ota.check_interval', 300),  # 5分鐘
+            long_poll=config.get('ota.long_poll', True),
+            wait_seconds=config.get('ota.long_poll_timeout', 60)
+        )
+        self._shutdown_lock = threading.Lock()
+        self._shutdown_done = threading.Event()
+        self._shutting_down = False
+
         # 設定信號處理
         signal.signal(signal.SIGTERM, self._signal_handler)
         signal.signal(signal.SIGINT, self._signal_handler)
@@ -177,7 +322,11 @@ class HelloOTAApp:
     def _signal_handler(self, signum, frame):
         """處理系統信號"""
         logger.info(f"收到信號 {signum}，準備優雅關閉")
-        self.shutdown()
+
+        # serve_forever 在主線程執行，server.shutdown() 必須由其他線程呼叫，否則會互相等待
+        shutdown_thread = threading.Thread(target=self.shutdown)
+        shutdown_thread.daemon = True
+        shutdown_thread.start()
 
     def start(self):
         """啟動應用程式"""
@@ -190,24 +339,47 @@ class HelloOTAApp:
         host = config.get('app.host', '0.0.0.0')
         port = config.get('app.port', 8080)
 
-        self.server = HTTPServer((host, port), HelloOTAHandler)
+        with _phase("server_bind"):
+            self.server = self._create_server(host, port)
         logger.info(f"HTTP服務器啟動於 {host}:{port}")
 
+        # 更新時把監聽socket交給新版本，埠不會中斷
+        self.ota_manager.listen_socket = self.server.socket
+        self.ota_manager.hot_reloader = HotReloader(self.server, self)
+
+        # 埠已綁定，通知 systemd（或更新執行器）服務已就緒
+        notify("READY=1")
+
         # 啟動心跳線程
         self._start_heartbeat()
 
-        # 啟動OTA檢查線程
+        # 啟動OTA檢查線程與套用排程（重啟前已預先下載的更新會繼續等待套用）
         if config.get('ota.enabled', True):
             self._start_ota_checker()
+            self.scheduler.start()
 
         try:
-            # 主服務循環
-            self.server.serve_forever()
+            # 主服務循環；shutdown() 要等到下一次輪詢才生效，預設的0.5秒會直接加在重啟的停機時間上
+            self.server.serve_forever(poll_interval=SHUTDOWN_POLL_INTERVAL)
         except KeyboardInterrupt:
             logger.info("收到中斷信號")
         finally:
             self.shutdown()
 
+    def _create_server(self, host, port):
+        """建立HTTP服務器，有繼承的監聽socket時直接使用而不重新綁定"""
+        listen_socket = inherited_listen_socket()
+        if listen_socket is None:
+            return ThreadingHTTPServer((host, port), HelloOTAHandler)
+
+        server = ThreadingHTTPServer((host, port), HelloOTAHandler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = listen_socket
+        server.server_address = listen_socket.getsockname()[:2]
+        server.server_name, server.server_port = server.server_address
+        logger.info(f"使用繼承的監聽socket: {server.server_address}")
+        return server
+
     def _create_pid_file(self):
         """建立PID檔案"""
         pid_file = Path(config.get('system.pid_file', '/var/run/hello-ota.pid'))
@@ -222,6 +394,11 @@ class HelloOTAApp:
             interval = config.get('app.heartbeat_interval', 30)
             while self.running:
                 logger.debug(f"心跳 - 運行時間: {int(time.time() - self.start_time)}秒")
+                # 更新執行器在其他行程寫入的結果（切換成功或回滾）也在此回報
+                try:
+                    self.ota_manager.report_outcomes()
+                except Exception as e:
+                    logger.warning(f"回報更新結果失敗: {e}")
                 time.sleep(interval)
 
         heartbeat_thread = threading.Thread(target=heartbeat_loop)
@@ -231,44 +408,67 @@ class HelloOTAApp:
     def _start_ota_checker(self):
         """啟動OTA檢查線程"""
         def ota_check_loop():
-            interval = config.get('ota.check_interval', 300)  # 5分鐘
             while self.running:
+                delay = self.watcher.check_interval
                 try:
                     logger.debug("檢查OTA更新")
                     self.last_update_check = datetime.now().isoformat()
 
-                    update_info = self.ota_manager.check_for_updates()
+                    update_info, delay = self.watcher.check()
                     if update_info and config.get('ota.auto_update', False):
-                        logger.info("發現更新且已啟用自動更新")
-                        self._perform_update(update_info)
+                        logger.info("發現更新且已啟用自動更新，開始預先下載")
+                        self.scheduler.submit(update_info)
 
                 except Exception as e:
                     logger.error(f"OTA檢查失敗: {e}")
 
-                time.sleep(interval)
+                time.sleep(delay)
 
         ota_thread = threading.Thread(target=ota_check_loop)
         ota_thread.daemon = True
         ota_thread.start()
 
+    def trigger_update(self, update_info):
+        """立即在背景下載並套用更新（/trigger_update 或MQTT的套用通知）"""
+        update_thread = threading.Thread(
+            target=self._perform_update,
+            args=(update_info,)
+        )
+        update_thread.daemon = True
+        update_thread.start()
+
     def _perform_update(self, update_info):
         """執行OTA更新"""
         try:
             logger.info(f"開始執行OTA更新到版本 {update_info['version']}")
 
-            # 下載更新
-            update_file = self.ota_manager.download_update(update_info)
-
-            # 套用更新（這會導致程式退出）
-            self.ota_manager.apply_update(update_file, update_info)
+            # 下載並套用更新（耗費資源的步驟在低優先權工作行程中執行，
+            # 更新執行器會在切換版本後重啟服務）
+            self.ota_manager.perform_update(update_info)
 
         except Exception as e:
             logger.error(f"OTA更新失敗: {e}")
+        finally:
+            try:
+                self.ota_manager.report_outcomes()
+            except Exception as e:
+                logger.warning(f"回報更新結果失敗: {e}")
 
     def shutdown(self):
-        """優雅關閉應用程式"""
+        """優雅關閉應用程式，重複呼叫時等待第一次關閉完成"""
+        with self._shutdown_lock:
+            already_shutting_down = self._shutting_down
+            self._shutting_down = True
+
+        if already_shutting_down:
+            self._shutdown_done.wait(timeout=10)
+            return
+
         logger.info("應用程式正在關閉...")
+        notify("STOPPING=1")
         self.running = False
+        self.scheduler.stop()
+        self.ota_manager.transport.stop()
 
         if self.server:
             self.server.shutdown()
@@ -280,23 +480,72 @@ class HelloOTAApp:
             pid_file.unlink()
 
         logger.info("應用程式已關閉")
+        self._shutdown_done.set()
+
+# 全域應用程式實例，於 main() 中建立以避免匯入時的副作用
+app = None
 
-# 全域應用程式實例
-app = HelloOTAApp()
+def _profile_startup(timeout=30):
+    """啟動到 /health 回應為止，輸出各階段耗時後關閉"""
+    import urllib.request
+
+    server_thread = threading.Thread(target=app.start)
+    server_thread.daemon = True
+    server_thread.start()
+
+    port = config.get('app.port', 8080)
+    deadline = time.monotonic() + timeout
+    healthy = False
+
+    while time.monotonic() < deadline and server_thread.is_alive():
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                if response.status == 200:
+                    healthy = True
+                    break
+        except OSError:
+            time.sleep(0.01)
+
+    if healthy:
+        profiler.mark("healthy")
+
+    app.shutdown()
+    server_thread.join(timeout=5)
+    return healthy
 
 def main():
     """主入口函數"""
-    setup_logging()
+    global app
+
+    if profiler:
+        profiler.import_timer.uninstall()
+        profiler.mark("imports_done")
+
+    with _phase("logging"):
+        log_listener = setup_logging()
 
     logger.info("="*50)
     logger.info(f"Hello OTA v{__version__} - Python OTA更新示範")
     logger.info("="*50)
 
+    healthy = False
     try:
-        app.start()
+        with _phase("app_init"):
+            app = HelloOTAApp()
+
+        if profiler:
+            healthy = _profile_startup()
+        else:
+            app.start()
     except Exception as e:
         logger.error(f"應用程式啟動失敗: {e}")
         sys.exit(1)
+    finally:
+        log_listener.stop()
+
+    if profiler:
+        profiler.dump(sys.stderr)
+        sys.exit(0 if healthy else 1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
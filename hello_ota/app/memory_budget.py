@@ -0,0 +1,182 @@
+"""
+OTA記憶體預算 - tmpfs剩餘空間判斷與各階段記憶體峰值量測
+
+服務以 MemoryLimit 限制記憶體，而 PrivateTmp 下的 /tmp 可能是tmpfs，
+寫入tmpfs的檔案會佔用記憶體並計入同一個cgroup，
+因此大型更新包在空間不足時改放到磁碟上。
+"""
+import os
+import time
+import threading
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+MEMORY_FILESYSTEMS = ("tmpfs", "ramfs")
+
+def current_rss():
+    """目前的常駐記憶體（bytes），無法取得時回傳None"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _existing_parent(path):
+    path = Path(path).resolve()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+def filesystem_type(path):
+    """路徑所在檔案系統的類型（依 /proc/self/mounts 最長的掛載點比對）"""
+    target = str(_existing_parent(path))
+    best_mount, best_type = "", None
+    try:
+        with open('/proc/self/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                prefix = mount_point.rstrip('/') + '/'
+                if (target == mount_point or target.startswith(prefix)) and len(mount_point) >= len(best_mount):
+                    best_mount, best_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+def cgroup_memory_headroom():
+    """cgroup記憶體上限扣除目前用量，沒有上限或無法取得時回傳None"""
+    try:
+        with open('/proc/self/cgroup', 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    for line in lines:
+        hierarchy, controllers, cgroup_path = line.split(':', 2)
+        if hierarchy == "0":
+            base = Path("/sys/fs/cgroup") / cgroup_path.lstrip('/')
+            files = (base / "memory.max", base / "memory.current")
+        elif "memory" in controllers.split(','):
+            base = Path("/sys/fs/cgroup/memory") / cgroup_path.lstrip('/')
+            files = (base / "memory.limit_in_bytes", base / "memory.usage_in_bytes")
+        else:
+            continue
+
+        try:
+            limit = files[0].read_text().strip()
+            usage = int(files[1].read_text().strip())
+        except (OSError, ValueError):
+            continue
+        # cgroup v1 無上限時為接近 2^63 的值
+        if limit == "max" or int(limit) >= 1 << 60:
+            return None
+        return max(int(limit) - usage, 0)
+
+    return None
+
+def memory_backed_headroom(path):
+    """路徑位於tmpfs時回傳可用空間（同時受cgroup記憶體上限限制），不在tmpfs時回傳None"""
+    if filesystem_type(path) not in MEMORY_FILESYSTEMS:
+        return None
+
+    stat = os.statvfs(_existing_parent(path))
+    headroom = stat.f_bavail * stat.f_frsize
+
+    cgroup_headroom = cgroup_memory_headroom()
+    if cgroup_headroom is not None:
+        headroom = min(headroom, cgroup_headroom)
+    return headroom
+
+def fits_in_memory_filesystem(path, size, reserve):
+    """path 不在tmpfs，或在tmpfs上仍保留 reserve 以上的餘裕時回傳True"""
+    headroom = memory_backed_headroom(path)
+    if headroom is None:
+        return True
+    # 大小未知時不冒險放在記憶體中
+    if not size:
+        return False
+    return headroom - size >= reserve
+
+class _RssSampler:
+    """背景取樣RSS，記錄期間的最大值"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return self.peak
+
+class StageMemoryProfiler:
+    """記錄OTA各階段的耗時、RSS峰值與Python配置峰值（tracemalloc）"""
+
+    def __init__(self, trace_python=True, sample_interval=0.02):
+        self.trace_python = trace_python
+        self.sample_interval = sample_interval
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        rss_before = current_rss()
+        sampler = _RssSampler(self.sample_interval)
+        sampler.start()
+
+        started_tracing = False
+        if self.trace_python:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            else:
+                tracemalloc.reset_peak()
+
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            python_peak = tracemalloc.get_traced_memory()[1] if self.trace_python else None
+            if started_tracing:
+                tracemalloc.stop()
+            rss_peak = sampler.stop()
+
+            self._record(name, {
+                "duration_ms": round((time.monotonic() - start_time) * 1000, 1),
+                "rss_peak_kb": rss_peak // 1024 if rss_peak is not None else None,
+                "rss_growth_kb": (
+                    (rss_peak - rss_before) // 1024 if rss_peak is not None and rss_before is not None else None
+                ),
+                "python_peak_kb": python_peak // 1024 if python_peak is not None else None
+            })
+
+    def _record(self, name, measured):
+        """同一階段進入多次時（例如每個元件各解壓縮一次）合併：耗時相加，峰值取最大"""
+        previous = self.stages.get(name)
+        if previous is not None:
+            merged = {"duration_ms": round(previous['duration_ms'] + measured['duration_ms'], 1)}
+            for key in ("rss_peak_kb", "rss_growth_kb", "python_peak_kb"):
+                values = [stage[key] for stage in (previous, measured) if stage[key] is not None]
+                merged[key] = max(values) if values else None
+            measured = merged
+        self.stages[name] = measured
+
+    def report(self):
+        return dict(self.stages)
@@ -0,0 +1,160 @@
+"""
+鏡像選擇 - 依回應時間與傳輸速率排序更新包的下載來源
+
+更新資訊的 mirrors 欄位列出同一個更新包的其他下載網址。下載前以小範圍的Range請求
+同時探測各鏡像，依預估的下載時間排序；量測結果以站點（scheme://host:port）為鍵記錄在資料目錄，
+有效期間內不重複探測，實際下載的速率與最佳鏡像也一併記錄，下一次更新直接沿用。
+"""
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit
+from flash_io import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+def mirror_origin(url):
+    """鏡像的站點（scheme://host:port），同一站點的量測結果跨版本共用"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+class MirrorSelector:
+    """探測並記錄各鏡像的回應時間（rtt_ms）與傳輸速率（bytes/s）"""
+
+    def __init__(self, state_file, probe_bytes=64 * 1024, probe_timeout=2, ttl=3600):
+        self.state_file = Path(state_file)
+        self.probe_bytes = probe_bytes
+        self.probe_timeout = probe_timeout
+        self.ttl = ttl
+        self.probes = 0
+        self._lock = threading.Lock()
+        self._mirrors, self.best = self._load()
+
+    def settings(self):
+        """建立相同設定所需的參數（交給工作行程）"""
+        return {
+            "state_file": str(self.state_file),
+            "probe_bytes": self.probe_bytes,
+            "probe_timeout": self.probe_timeout,
+            "ttl": self.ttl
+        }
+
+    def _load(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            return state.get('mirrors', {}), state.get('best')
+        except (OSError, ValueError):
+            return {}, None
+
+    def _save(self):
+        with self._lock:
+            state = {"best": self.best, "mirrors": dict(self._mirrors)}
+        try:
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_json(self.state_file, state, ensure_ascii=False, indent=2)
+        except OSError as e:
+            logger.warning(f"無法保存鏡像量測結果: {e}")
+
+    def rank(self, urls, size=0):
+        """依預估下載時間排序下載網址，只探測沒有量測結果或已過期的鏡像"""
+        urls = list(dict.fromkeys(url for url in urls if url))
+        if len(urls) <= 1:
+            return urls
+
+        now = time.time()
+        with self._lock:
+            stale = [url for url in urls
+                     if now - self._mirrors.get(mirror_origin(url), {}).get('measured_at', 0) > self.ttl]
+        if stale:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+                list(executor.map(self._probe, stale))
+            self._save()
+
+        ranked = sorted(urls, key=lambda url: self.estimate(url, size))
+        logger.info(f"鏡像排序: {', '.join(mirror_origin(url) for url in ranked)}")
+        return ranked
+
+    def estimate(self, url, size=0):
+        """預估下載秒數，無法連線的鏡像為無限大；相同時最佳鏡像優先"""
+        origin = mirror_origin(url)
+        with self._lock:
+            measured = self._mirrors.get(origin, {})
+        if not measured.get('throughput'):
+            return (float('inf'), 1)
+        seconds = measured.get('rtt_ms', 0) / 1000 + size / measured['throughput']
+        return (seconds, 0 if origin == self.best else 1)
+
+    def _probe(self, url):
+        """以Range請求讀取開頭的 probe_bytes，量測回應時間與傳輸速率"""
+        import requests
+
+        origin = mirror_origin(url)
+        start_time = time.perf_counter()
+        try:
+            response = requests.get(url, stream=True, timeout=self.probe_timeout,
+                                    headers={"Range": f"bytes=0-{self.probe_bytes - 1}"})
+            try:
+                response.raise_for_status()
+                rtt = time.perf_counter() - start_time
+                received = 0
+                # 服務器不支援Range時讀到 probe_bytes 即停止
+                for data in response.iter_content(chunk_size=16 * 1024):
+                    received += len(data)
+                    if received >= self.probe_bytes:
+                        break
+            finally:
+                response.close()
+            elapsed = time.perf_counter() - start_time
+        except Exception as e:
+            logger.info(f"鏡像無法連線 {origin}: {e}")
+            self._record(origin, rtt_ms=None, throughput=None, failed=True)
+            return
+
+        throughput = received / max(elapsed - rtt, 0.001) if received else None
+        self._record(origin, rtt_ms=round(rtt * 1000, 1), throughput=throughput, failed=not received)
+        with self._lock:
+            self.probes += 1
+
+    def _record(self, origin, rtt_ms, throughput, failed=False):
+        with self._lock:
+            measured = self._mirrors.setdefault(origin, {"failures": 0})
+            if rtt_ms is not None:
+                measured['rtt_ms'] = rtt_ms
+            measured['throughput'] = round(throughput) if throughput else None
+            measured['measured_at'] = time.time()
+            if failed:
+                measured['failures'] = measured.get('failures', 0) + 1
+
+    def record_success(self, url, size, seconds):
+        """以實際下載的速率更新量測結果，並記錄為最佳鏡像"""
+        origin = mirror_origin(url)
+        with self._lock:
+            measured = self._mirrors.setdefault(origin, {"failures": 0})
+            # 探測失敗的鏡像沒有回應時間，以實際下載成功的速率排序
+            measured.setdefault('rtt_ms', 0)
+            if size and seconds > 0:
+                measured['throughput'] = round(size / seconds)
+            measured['measured_at'] = time.time()
+            measured['failures'] = 0
+            self.best = origin
+        self._save()
+
+    def record_failure(self, url):
+        """下載中斷的鏡像排到最後，過期後重新探測"""
+        origin = mirror_origin(url)
+        with self._lock:
+            measured = self._mirrors.setdefault(origin, {"failures": 0})
+            measured['throughput'] = None
+            measured['failures'] = measured.get('failures', 0) + 1
+            if self.best == origin:
+                self.best = None
+        self._save()
+
+    def status(self):
+        with self._lock:
+            return {"best": self.best, "mirrors": {origin: dict(measured) for origin, measured in self._mirrors.items()}}
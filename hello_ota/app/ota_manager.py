@@ -4,111 +4,718 @@ OTA (Over-The-Air) 更新管理器
 import os
 import sys
 import json
+import time
 import hashlib
-import tarfile
 import shutil
 import subprocess
 import logging
-import requests
+import threading
 from pathlib import Path
 from datetime import datetime
-from .config import config
+from contextlib import nullcontext, contextmanager
+from config import config
+from update_history import UpdateHistory
+from log_pipeline import ProgressThrottle, PROGRESS_LOGGER
+from release_slots import ReleaseManager, DEPS_DIR_NAME, RELEASE_CONFIG_NAME, COMPONENTS_FILE
+from flash_io import FlashWriteSession, atomic_write_json
+from memory_budget import StageMemoryProfiler, fits_in_memory_filesystem, current_rss
+from update_scheduler import PrefetchCache
+from peer_cache import PeerCache
+from mirror_select import MirrorSelector
+from chunk_verify import ChunkManifest, ChunkState
+from update_transport import HTTPTransport, OUTCOME_STATUSES
+
+# requests 與 tarfile 在首次使用時才匯入，縮短服務冷啟動時間
 
 logger = logging.getLogger(__name__)
+# 下載進度日誌，依呼叫位置限流
+progress_logger = logging.getLogger(PROGRESS_LOGGER)
+
+# 各階段的讀寫緩衝上限，更新包大小不影響記憶體用量
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_MANIFEST_SIZE = 64 * 1024
+# 分塊下載時每寫入這麼多資料同步一次並記錄已驗證的區塊
+CHUNK_SYNC_BYTES = 16 * 1024 * 1024
+# tar更新包在臨時目錄中的下載位置，中斷後同一更新包由此續傳
+DOWNLOAD_FILE_NAME = "update.tar.gz"
+
+# 多元件更新的安裝方式：程式碼、相依套件（解開到槽位的 _deps）、版本設定（JSON）
+COMPONENT_STRATEGIES = ("release", "site-packages", "config")
 
 class OTAManager:
     def __init__(self):
-        self.app_dir = Path("/opt/hello-ota")
-        self.backup_dir = Path("/var/backups/hello-ota")
-        self.temp_dir = Path("/tmp/hello-ota-update")
-        self.update_script = Path("/tmp/hello_ota_updater.py")
+        # 安裝位置可由設定指定，測試時整個更新流程都在沙箱目錄中執行
+        self.app_dir = Path(config.get('system.app_dir', '/opt/hello-ota'))
+        self.backup_dir = Path(config.get('system.backup_dir', '/var/backups/hello-ota'))
+        self.temp_dir = Path(config.get('system.temp_dir', '/tmp/hello-ota-update'))
+        self.update_script = self.temp_dir.parent / "hello_ota_updater.py"
+
+        # 由 HelloOTAApp 設定，更新時交給新版本行程
+        self.listen_socket = None
+
+        # 由 HelloOTAApp 設定，reloadable 版本用於行程內熱更新
+        self.hot_reloader = None
+
+        # 在低優先權工作行程中執行時設定，負載超過預算時暫停
+        self.budget = None
+
+        # 目前這次更新的寫入工作階段與記憶體量測（下載開始時建立）
+        self._io_session = None
+        self._io_session_lock = threading.Lock()
+        self._memory_profile = None
 
         # 確保目錄存在
         self.backup_dir.mkdir(parents=True, exist_ok=True)
         self.temp_dir.mkdir(parents=True, exist_ok=True)
 
+        data_dir = Path(config.get('system.data_dir', '/var/lib/hello-ota'))
+        self.history = UpdateHistory(
+            data_dir / "update_history.jsonl",
+            retention=config.get('ota.history_retention', 50),
+            legacy_file=data_dir / "update_history.json"
+        )
+
+        # 預先下載的更新包放在資料目錄，服務重啟後仍可使用
+        self.prefetch_cache = PrefetchCache(data_dir / "prefetch")
+
+        # 同一站點的節點先互相取得更新包，啟用 peer_cache 時也提供給其他節點
+        self.peer_cache = PeerCache(
+            data_dir / "peer_cache",
+            enabled=config.get('ota.peer_cache', False),
+            peers=config.get('ota.peers', []),
+            keep=config.get('ota.peer_cache_keep', 2),
+            timeout=config.get('ota.peer_timeout', 5)
+        )
+
+        # 更新資訊列出多個鏡像時依量測結果排序，記住這台機器的最佳鏡像
+        self.mirrors = MirrorSelector(
+            data_dir / "mirrors.json",
+            probe_bytes=config.get('ota.mirror_probe_bytes', 64 * 1024),
+            probe_timeout=config.get('ota.mirror_probe_timeout', 2),
+            ttl=config.get('ota.mirror_probe_ttl', 3600)
+        )
+
+        # 最近一次下載的更新包來源（節點或更新服務器）
+        self.download_source = None
+        # 最近一次分塊下載的區塊統計（沿用、重新下載、校驗失敗）
+        self.chunk_stats = None
+
+        # 查詢新版本與回報進度、結果的通道（HTTP或MQTT），由 HelloOTAApp 依設定替換
+        self.transport = HTTPTransport()
+        self.outcome_marker = data_dir / "outcome_reported.json"
+        self._outcome_lock = threading.Lock()
+
+        # 正在下載或套用的版本，槽位清理時保留其暫存項目
+        self._versions_in_use = set()
+        self._versions_lock = threading.Lock()
+
+    @property
+    def releases(self):
+        """版本槽位管理器（依 app_dir 建立）"""
+        return ReleaseManager(self.app_dir)
+
     def check_for_updates(self):
         """檢查是否有可用更新"""
         try:
-            from .version import __version__
-
-            update_server = config.get('ota.update_server')
-            response = requests.get(
-                f"{update_server}/api/check_update",
-                params={"current_version": __version__},
-                timeout=30
-            )
-
-            if response.status_code == 200:
-                update_info = response.json()
-                if update_info.get('has_update', False):
-                    logger.info(f"發現新版本: {update_info['latest_version']}")
-                    return update_info
-                else:
-                    logger.debug("目前已是最新版本")
-                    return None
+            update_info = self.query_update_server()
+            if update_info.get('has_update', False):
+                logger.info(f"發現新版本: {update_info['latest_version']}")
+                return update_info
             else:
-                logger.warning(f"檢查更新失敗: {response.status_code}")
+                logger.debug("目前已是最新版本")
                 return None
 
         except Exception as e:
             logger.error(f"檢查更新時發生錯誤: {e}")
             return None
 
-    def download_update(self, update_info):
-        """下載更新檔案"""
-        download_url = update_info['download_url']
-        expected_checksum = update_info['checksum']
+    def query_update_server(self, wait=0, seen=None):
+        """經由更新傳輸查詢最新版本，失敗時拋出例外（wait 與 seen 用於長輪詢）"""
+        return self.transport.query(wait=wait, seen=seen)
 
-        logger.info(f"開始下載更新: {download_url}")
+    def _report_progress(self, update_info, stage, **details):
+        """經由更新傳輸回報進度，失敗不影響更新"""
+        try:
+            self.transport.report_progress(update_info, stage, **details)
+        except Exception as e:
+            logger.warning(f"回報更新進度失敗: {e}")
+
+    def report_outcomes(self):
+        """回報尚未送出的更新結果，回傳已送達的筆數
+
+        結果由更新歷史產生，包含更新執行器在其他行程寫入的記錄（切換成功或回滾）；
+        確認送達後才記錄進度，連線中斷時下次重送。
+        """
+        if not self.transport.reports_outcomes:
+            return 0
+
+        with self._outcome_lock:
+            last_reported = self._load_outcome_marker()
+            records = [
+                record for record in self.history.all()
+                if record.get('status') in OUTCOME_STATUSES and record.get('timestamp', '') > last_reported
+            ]
+
+            reported = 0
+            for record in records:
+                try:
+                    delivered = self.transport.report_outcome(record)
+                except Exception as e:
+                    logger.warning(f"回報更新結果失敗: {e}")
+                    delivered = False
+                if not delivered:
+                    break
+                self._save_outcome_marker(record['timestamp'])
+                reported += 1
+            return reported
+
+    def _load_outcome_marker(self):
+        try:
+            with open(self.outcome_marker, 'r', encoding='utf-8') as f:
+                return json.load(f)['timestamp']
+        except (OSError, ValueError, KeyError):
+            # 第一次啟用時不回報過去的記錄
+            recent = self.history.recent(1)
+            marker = recent[-1].get('timestamp', '') if recent else ''
+            self._save_outcome_marker(marker)
+            return marker
+
+    def _save_outcome_marker(self, timestamp):
+        atomic_write_json(self.outcome_marker, {"timestamp": timestamp})
+
+    def _write_session(self):
+        """本次更新的寫入工作階段，統計寫入量並於提交點批次同步"""
+        # 多元件平行下載時各線程共用同一個工作階段，只建立一次
+        with self._io_session_lock:
+            if self._io_session is None:
+                self._io_session = FlashWriteSession(
+                    buffer_size=config.get('ota.io_buffer_size', 1024 * 1024),
+                    pace=self._pace
+                )
+            return self._io_session
+
+    def _finish_write_session(self):
+        """提交剩餘寫入並回傳本次更新的寫入統計"""
+        session = self._write_session()
+        session.commit()
+        self._io_session = None
+
+        io_stats = session.report()
+        logger.info(
+            f"本次更新寫入 {io_stats['bytes_written']:,} bytes，"
+            f"{io_stats['files_written']} 個檔案，fsync {io_stats['fsync_count']} 次"
+        )
+        return io_stats
+
+    def _pace(self):
+        """讓出資源給交易處理：負載超過預算時暫停"""
+        if self.budget is not None:
+            self.budget.wait()
+
+    @contextmanager
+    def _using_version(self, version):
+        """標記版本正在下載或套用中"""
+        with self._versions_lock:
+            self._versions_in_use.add(version)
+        try:
+            yield
+        finally:
+            with self._versions_lock:
+                self._versions_in_use.discard(version)
+
+    def versions_in_use(self):
+        """正在下載、套用或等待套用（已預先下載）的版本"""
+        with self._versions_lock:
+            versions = set(self._versions_in_use)
+        pending = self.prefetch_cache.pending()
+        if pending and pending.get('version'):
+            versions.add(pending['version'])
+        return versions
+
+    def _memory_stage(self, name):
+        """量測單一更新階段的記憶體峰值"""
+        if self._memory_profile is None:
+            self._memory_profile = StageMemoryProfiler(
+                trace_python=config.get('ota.trace_memory', True)
+            )
+        return self._memory_profile.stage(name)
+
+    def _finish_memory_profile(self):
+        """回傳本次更新各階段的記憶體峰值"""
+        profile, self._memory_profile = self._memory_profile, None
+        if profile is None:
+            return {}
+        stages = profile.report()
+        peaks = ", ".join(f"{name} {stage['rss_peak_kb']} KB" for name, stage in stages.items())
+        logger.info(f"更新各階段RSS峰值: {peaks}")
+        return stages
+
+    def memory_status(self):
+        """目前RSS與最近一次更新的各階段記憶體峰值"""
+        rss = current_rss()
+        last_update = None
+        for record in reversed(self.history.recent(None)):
+            if record.get('memory'):
+                last_update = {"version": record.get('version'), "stages": record['memory']}
+                break
+
+        return {
+            "rss_kb": rss // 1024 if rss is not None else None,
+            "last_update": last_update
+        }
 
-        # 清理臨時目錄
-        if self.temp_dir.exists():
-            shutil.rmtree(self.temp_dir)
-        self.temp_dir.mkdir(parents=True)
+    def _download_path(self, update_info):
+        """tar更新包的下載位置：tmpfs空間不足時改放到槽位所在的磁碟"""
+        default_path = self.temp_dir / DOWNLOAD_FILE_NAME
+        reserve = config.get('ota.tmpfs_reserve', 64 * 1024 * 1024)
 
-        update_file = self.temp_dir / "update.tar.gz"
+        if fits_in_memory_filesystem(self.temp_dir, update_info.get('size', 0), reserve):
+            return default_path
 
+        disk_path = self.releases.staging_package(update_info.get('version', 'download'))
+        logger.info(f"暫存目錄位於記憶體且空間不足，改下載到磁碟: {disk_path}")
+        disk_path.parent.mkdir(parents=True, exist_ok=True)
+        return disk_path
+
+    def _clean_temp_dir(self, update_info):
+        """清理臨時目錄；同一更新包中斷留下的部分檔案與已驗證區塊狀態保留續傳"""
+        partial = self.temp_dir / DOWNLOAD_FILE_NAME
         try:
-            # 下載檔案，支援斷點續傳
-            self._download_with_progress(download_url, update_file)
+            manifest = ChunkManifest.from_update_info(update_info)
+        except Exception:
+            manifest = None
+        # 區塊狀態記錄的雜湊樹根與檔案大小都相符才是同一個更新包，其他版本留下的一併刪除
+        state = ChunkState(partial, manifest) if manifest is not None else None
+        resumable = state is not None and state.load() > 0
 
-            # 驗證檔案完整性
-            if self._verify_checksum(update_file, expected_checksum):
-                logger.info("更新檔案下載並驗證成功")
-                return update_file
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        for entry in self.temp_dir.iterdir():
+            if resumable and entry in (partial, state.path):
+                continue
+            if entry.is_dir() and not entry.is_symlink():
+                shutil.rmtree(entry)
             else:
-                raise Exception("檔案校驗失敗")
+                entry.unlink()
+
+    def download_update(self, update_info):
+        """下載更新檔案；多元件更新回傳 {元件名稱: 檔案}"""
+        # 每次更新重新統計寫入量與記憶體峰值
+        self._io_session = None
+        self._memory_profile = None
+        self.download_source = None
+
+        self._clean_temp_dir(update_info)
+
+        if update_info.get('components'):
+            return self._download_components(update_info)
+
+        download_url = update_info['download_url']
+        logger.info(f"開始下載更新: {download_url}")
+
+        # 已預先下載時直接使用快取
+        with self._memory_stage("verify"):
+            cached = self.prefetch_cache.get(update_info)
+        if cached is not None:
+            logger.info(f"使用預先下載的更新包: {cached}")
+            self.download_source = "prefetch"
+            if update_info.get('format') != 'zipapp':
+                return cached
+            update_file = self.releases.staging_archive(update_info['version'])
+            update_file.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(cached, update_file)
+            return update_file
+
+        if update_info.get('format') == 'zipapp':
+            # 封存檔直接下載到槽位所在的檔案系統，套用時只需rename
+            update_file = self.releases.staging_archive(update_info['version'])
+            update_file.parent.mkdir(parents=True, exist_ok=True)
+        else:
+            update_file = self._download_path(update_info)
+
+        try:
+            self.download_source = self._fetch_verified(update_info, update_file)
+            logger.info("更新檔案下載並驗證成功")
+            self._seed_peer_cache(update_file, update_info)
+            return update_file
 
         except Exception as e:
             logger.error(f"下載更新失敗: {e}")
             raise
 
-    def _download_with_progress(self, url, file_path):
-        """帶進度的檔案下載"""
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
+    def _download_components(self, update_info):
+        """平行下載多元件更新中有變動的元件，版本與目前槽位相同的元件沿用不下載"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        components = self._validate_components(update_info)
+        releases = self.releases
+        releases.releases_dir.mkdir(parents=True, exist_ok=True)
+
+        installed = releases.installed_components()
+        files = {}
+        pending = []
+        for component in components:
+            if installed.get(component['name'], {}).get('version') == component['version']:
+                logger.info(f"元件 {component['name']} 版本 {component['version']} 未變動，沿用目前版本")
+                files[component['name']] = None
+            else:
+                pending.append(component)
+
+        def fetch(component):
+            # 直接下載到槽位所在的檔案系統
+            target = releases.releases_dir / f".staging-{update_info['version']}-{component['name']}"
+            source = self._fetch_verified(component, target, profile=False)
+            self._seed_peer_cache(target, component)
+            return target, source
+
+        logger.info(f"平行下載 {len(pending)} 個元件: {', '.join(c['name'] for c in pending)}")
+        # 開始平行下載前建立寫入工作階段，所有元件的寫入都計入同一份統計並一起提交
+        self._write_session()
+        sources = {}
+        with self._memory_stage("download"):
+            with ThreadPoolExecutor(max_workers=max(config.get('ota.component_download_workers', 4), 1)) as pool:
+                futures = {component['name']: pool.submit(fetch, component) for component in pending}
+
+            errors = []
+            for name, future in futures.items():
+                try:
+                    files[name], sources[name] = future.result()
+                except Exception as e:
+                    errors.append(f"{name}: {e}")
+
+        if errors:
+            # 任一元件失敗時整個更新都不套用
+            for path in files.values():
+                if path is not None and path.exists():
+                    path.unlink()
+            raise Exception(f"元件下載失敗 ({'; '.join(errors)})")
+
+        self.download_source = sources
+        logger.info("所有元件下載並驗證成功")
+        return files
+
+    def _validate_components(self, update_info):
+        """檢查元件清單：名稱不重複、安裝方式有效，且恰有一個程式碼元件與更新版本相同"""
+        components = update_info['components']
+        names = [component.get('name') for component in components]
+        if len(set(names)) != len(names):
+            raise Exception(f"元件名稱重複: {names}")
+
+        for component in components:
+            missing = [key for key in ("name", "version", "strategy", "download_url", "checksum")
+                       if not component.get(key)]
+            if missing:
+                raise Exception(f"元件缺少欄位 {missing}: {component.get('name')}")
+            if component['strategy'] not in COMPONENT_STRATEGIES:
+                raise Exception(f"不支援的元件安裝方式: {component['strategy']}")
+
+        releases = [component for component in components if component['strategy'] == "release"]
+        if len(releases) != 1:
+            raise Exception("多元件更新必須恰有一個程式碼元件（strategy: release）")
+        if releases[0]['version'] != update_info['version']:
+            raise Exception(f"程式碼元件版本不符: {releases[0]['version']} != {update_info['version']}")
+        if update_info.get('format', 'tar') != 'tar':
+            raise Exception("多元件更新的程式碼元件必須為tar格式")
+        return components
+
+    def _fetch_verified(self, update_info, file_path, profile=True):
+        """下載並驗證更新包：先向同一站點的節點取得，都沒有時向更新服務器下載
+
+        回傳實際的下載來源；平行下載時 profile 為False，由呼叫端量測整體記憶體。
+        """
+        expected_checksum = update_info['checksum']
+        file_path = Path(file_path)
+        stage = self._memory_stage if profile else (lambda name: nullcontext())
+
+        # 帶有區塊清單時逐區塊驗證；上次中斷留下的已驗證區塊直接沿用
+        manifest = ChunkManifest.from_update_info(update_info)
+        state = ChunkState(file_path, manifest) if manifest is not None else None
+        resumed = state is not None and state.load() > 0
+        if resumed:
+            logger.info(f"沿用上次下載已驗證的 {len(state.verified)}/{len(manifest)} 個區塊")
+        else:
+            if state is not None:
+                state.clear()
+            # 不覆寫既有檔案的內容，它可能與節點快取共用同一個硬連結
+            if file_path.exists():
+                file_path.unlink()
+
+        # 已有部分區塊時向更新服務器續傳，節點只提供完整檔案
+        peer_urls = [] if resumed else self.peer_cache.peer_urls(expected_checksum)
+        for url in peer_urls:
+            try:
+                with stage("download"):
+                    self._download_with_progress(url, file_path, timeout=self.peer_cache.timeout)
+                with stage("verify"):
+                    verified = self._verify_checksum(file_path, expected_checksum)
+                if verified:
+                    logger.info(f"已從同一站點的節點取得更新包: {url}")
+                    return url
+                logger.warning(f"節點提供的更新包校驗失敗: {url}")
+            except Exception as e:
+                logger.info(f"節點無法提供更新包 {url}: {e}")
+            if file_path.exists():
+                file_path.unlink()
+
+        # 更新服務器與各鏡像依預估下載時間排序，下載中斷時由下一個鏡像接續
+        sources = self.mirrors.rank(
+            [update_info['download_url'], *update_info.get('mirrors', [])], size=update_info.get('size', 0)
+        )
+        start_time = time.monotonic()
+        with stage("download"):
+            if state is not None:
+                source = self._download_chunked(sources, file_path, state)
+            else:
+                source = self._download_with_progress(sources, file_path)
+        elapsed = time.monotonic() - start_time
+
+        # 驗證檔案完整性：整個檔案的校驗和仍是最終依據
+        with stage("verify"):
+            verified = self._verify_checksum(file_path, expected_checksum)
+        if state is not None:
+            state.clear()
+        if not verified:
+            if file_path.exists():
+                file_path.unlink()
+            raise Exception("檔案校驗失敗")
+        if len(sources) > 1:
+            self.mirrors.record_success(source, file_path.stat().st_size, elapsed)
+        return source
+
+    def _seed_peer_cache(self, package_file, update_info):
+        """保存已驗證的更新包供同一站點的節點下載，失敗不影響更新"""
+        try:
+            self.peer_cache.store(package_file, update_info, copy_function=self._write_session().copy_file)
+        except Exception as e:
+            logger.warning(f"無法保存更新包到節點快取: {e}")
+
+    def prefetch_update(self, update_info):
+        """下載並驗證更新包到預先下載快取，記錄為等待套用"""
+        with self._using_version(update_info.get('version')):
+            if update_info.get('components'):
+                # 多元件更新在套用時才平行下載，未變動的元件不需下載
+                self.prefetch_cache.set_pending(update_info)
+                return None
 
-        total_size = int(response.headers.get('content-length', 0))
+            if self.prefetch_cache.get(update_info) is None:
+                target = self.prefetch_cache.package_path(update_info)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                partial = target.with_name(target.name + ".part")
+
+                logger.info(f"預先下載更新: {update_info['download_url']}")
+                try:
+                    self.download_source = self._fetch_verified(update_info, partial)
+
+                    # 提交點：內容寫入儲存裝置後才改名，重啟後不會看到半個檔案
+                    self._write_session().commit()
+                    os.replace(partial, target)
+                finally:
+                    # 帶有區塊狀態的部分檔案保留到下次續傳
+                    if partial.exists() and not ChunkState(partial, None).exists():
+                        partial.unlink()
+                self._seed_peer_cache(target, update_info)
+
+            self.prefetch_cache.set_pending(update_info)
+            return self.prefetch_cache.package_path(update_info)
+
+    def prefetch_in_background(self, update_info):
+        """在低優先權工作行程中預先下載更新包"""
+        with self._using_version(update_info.get('version')):
+            if not config.get('ota.background_worker', True):
+                return self.prefetch_update(update_info)
+
+            from ota_worker import run_in_worker
+
+            return run_in_worker({
+                "action": "prefetch",
+                "update_info": update_info,
+                "app_dir": str(self.app_dir),
+                "temp_dir": str(self.temp_dir),
+                "backup_dir": str(self.backup_dir),
+                "prefetch_dir": str(self.prefetch_cache.cache_dir),
+                "peer_cache": self.peer_cache.settings(),
+                "mirrors": self.mirrors.settings()
+            }, timeout=config.get('ota.worker_timeout', 3600))
+
+    @staticmethod
+    def _download_timeout():
+        """下載請求的 (連線, 讀取) 逾時秒數；停滯的鏡像逾時後改由下一個鏡像接續"""
+        return (config.get('ota.download_connect_timeout', 10), config.get('ota.download_read_timeout', 60))
+
+    def _download_with_progress(self, urls, file_path, timeout=None):
+        """帶進度的檔案下載，回傳完成下載的網址
+
+        urls 列出多個鏡像時，下載中斷後以Range請求由下一個鏡像從已寫入的位置接續。
+        """
+        import requests
+
+        urls = [urls] if isinstance(urls, str) else list(urls)
+        timeout = timeout or self._download_timeout()
+        total_size = 0
         downloaded = 0
+        throttle = ProgressThrottle(
+            step_percent=config.get('ota.progress_log_step', 10),
+            interval=config.get('ota.progress_log_interval', 5)
+        )
 
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
+        f = None
+        try:
+            for index, url in enumerate(urls):
+                try:
+                    headers = {"Range": f"bytes={downloaded}-"} if downloaded else None
+                    response = requests.get(url, stream=True, timeout=timeout, headers=headers)
+                    response.raise_for_status()
+                    # 不支援Range的鏡像從頭傳送，略過已寫入的部分
+                    skip = downloaded if response.status_code != 206 else 0
+
+                    if f is None:
+                        # 已知大小時預先配置空間，以大區塊寫入
+                        total_size = int(response.headers.get('content-length', 0))
+                        f = self._write_session().open(file_path, size=total_size)
+
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if skip:
+                            skipped = min(skip, len(chunk))
+                            chunk = chunk[skipped:]
+                            skip -= skipped
+                        if chunk:
+                            f.write(chunk)
+                            downloaded += len(chunk)
+                            self._pace()
+
+                            if throttle.should_report(downloaded, total_size):
+                                progress = (downloaded / total_size) * 100
+                                progress_logger.info(f"下載進度: {progress:.1f}% ({downloaded:,}/{total_size:,} bytes)")
+                    return url
+                except requests.exceptions.RequestException as e:
+                    if index == len(urls) - 1:
+                        raise
+                    self.mirrors.record_failure(url)
+                    logger.warning(f"鏡像下載中斷 ({url})，改由 {urls[index + 1]} 從 {downloaded:,} bytes 繼續: {e}")
+        finally:
+            if f is not None:
+                f.close()
+
+    def _download_chunked(self, urls, file_path, state, timeout=None):
+        """逐區塊驗證的下載：每個區塊寫入前比對雜湊，只重新下載損毀或缺少的區塊
+
+        urls 列出多個鏡像時，中斷或提供損毀區塊的鏡像改由下一個鏡像接續，回傳最後使用的網址。
+        """
+        urls = [urls] if isinstance(urls, str) else list(urls)
+        url = urls[0]
+        timeout = timeout or self._download_timeout()
+        manifest = state.manifest
+        retries = config.get('ota.download_retries', 3)
+        stats = {"chunks": len(manifest), "resumed": len(state.verified), "refetched": 0, "bad": 0}
+        self.chunk_stats = stats
+
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != manifest.total_size:
+                os.ftruncate(fd, manifest.total_size)
+            # 每個鏡像至少嘗試一次
+            for attempt in range(max(retries + 1, len(urls))):
+                missing = state.missing()
+                if not missing:
+                    break
+                url = urls[attempt % len(urls)]
+                if attempt:
+                    stats["refetched"] += len(missing)
+                    logger.warning(f"重新下載 {len(missing)} 個區塊（第 {attempt} 次重試，{url}）")
+                bad = stats["bad"]
+                try:
+                    for first, last in self._chunk_runs(missing):
+                        self._stream_chunks(url, fd, state, first, last, stats, timeout)
+                    failed = stats["bad"] > bad
+                except Exception as e:
+                    logger.warning(f"分塊下載中斷 ({url}): {e}")
+                    failed = True
+                finally:
+                    # 已同步到儲存裝置的區塊才記錄為已驗證
+                    os.fsync(fd)
+                    state.save()
+                if failed and len(urls) > 1:
+                    self.mirrors.record_failure(url)
+        finally:
+            os.close(fd)
+
+        self._write_session().track_existing(file_path)
+        missing = state.missing()
+        if missing:
+            raise Exception(f"下載失敗，仍有 {len(missing)} 個區塊未通過驗證")
+        logger.info(
+            f"分塊下載完成: {stats['chunks']} 個區塊，沿用 {stats['resumed']}，重新下載 {stats['refetched']}"
+        )
+        return url
+
+    @staticmethod
+    def _chunk_runs(indexes):
+        """將區塊編號分組為連續的範圍 (first, last)，每個範圍一個請求"""
+        runs = []
+        for index in indexes:
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        return [tuple(run) for run in runs]
 
-                    if total_size > 0:
-                        progress = (downloaded / total_size) * 100
-                        logger.debug(f"下載進度: {progress:.1f}%")
+    def _stream_chunks(self, url, fd, state, first, last, stats, timeout=None):
+        """以Range請求下載第 first 到 last 個區塊；服務器不支援Range時從頭讀取並略過已驗證的區塊"""
+        import requests
+
+        manifest = state.manifest
+        start = manifest.chunk_range(first)[0]
+        end = sum(manifest.chunk_range(last)) - 1
+        response = requests.get(url, stream=True, timeout=timeout, headers={"Range": f"bytes={start}-{end}"})
+        response.raise_for_status()
+        index = first if response.status_code == 206 else 0
+
+        throttle = ProgressThrottle(
+            step_percent=config.get('ota.progress_log_step', 10),
+            interval=config.get('ota.progress_log_interval', 5)
+        )
+        buffer = bytearray()
+        unsynced = 0
+        try:
+            for data in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                buffer += data
+                while index <= last:
+                    offset, length = manifest.chunk_range(index)
+                    if len(buffer) < length:
+                        break
+                    chunk = bytes(buffer[:length])
+                    del buffer[:length]
+                    if index not in state.verified:
+                        if manifest.verify(index, chunk):
+                            os.pwrite(fd, chunk, offset)
+                            state.verified.add(index)
+                            unsynced += length
+                        else:
+                            stats["bad"] += 1
+                            logger.warning(f"區塊 {index} 校驗失敗，稍後重新下載")
+                    index += 1
+                    self._pace()
+
+                    if unsynced >= CHUNK_SYNC_BYTES:
+                        os.fdatasync(fd)
+                        state.save()
+                        unsynced = 0
+
+                    done = len(state.verified)
+                    if throttle.should_report(done, len(manifest)):
+                        progress_logger.info(f"下載進度: {done / len(manifest) * 100:.1f}% ({done}/{len(manifest)} 個區塊)")
+                if index > last:
+                    break
+        finally:
+            response.close()
 
     def _verify_checksum(self, file_path, expected_checksum):
         """驗證檔案SHA256校驗和"""
         sha256_hash = hashlib.sha256()
 
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
                 sha256_hash.update(chunk)
+                self._pace()
 
         actual_checksum = sha256_hash.hexdigest()
         return actual_checksum == expected_checksum
@@ -117,35 +724,325 @@ class OTAManager:
         """套用更新"""
         try:
             logger.info("開始套用更新")
+            self.stage_update(update_file, update_info)
+            self._activate_staged(update_info, self._finish_write_session(), self._finish_memory_profile())
+
+        except Exception as e:
+            self._record_failure(update_info, e)
+            raise
 
-            # 1. 備份當前版本
-            self._backup_current_version()
+    def perform_update(self, update_info):
+        """下載並套用更新
+
+        下載、驗證、解壓縮與備份依設定在低優先權的工作行程中執行，
+        只有切換版本（熱更新或交給更新執行器）在服務行程內進行。
+        """
+        with self._using_version(update_info.get('version')):
+            self._report_progress(update_info, "downloading")
+            if not config.get('ota.background_worker', True):
+                try:
+                    update_file = self.download_update(update_info)
+                except Exception as e:
+                    self._record_failure(update_info, e)
+                    raise
+                self.apply_update(update_file, {**update_info, "download_source": self.download_source})
+                return
+
+            from ota_worker import run_in_worker
+
+            try:
+                result = run_in_worker({
+                    "update_info": update_info,
+                    "app_dir": str(self.app_dir),
+                    "temp_dir": str(self.temp_dir),
+                    "backup_dir": str(self.backup_dir),
+                    "prefetch_dir": str(self.prefetch_cache.cache_dir),
+                    "peer_cache": self.peer_cache.settings(),
+                    "mirrors": self.mirrors.settings()
+                }, timeout=config.get('ota.worker_timeout', 3600))
+
+                # 工作行程的優先權與暫停統計一併記錄
+                update_info = {**update_info, "download_source": result.get('download_source'), "worker": {
+                    "priority": result.get('priority'), "budget": result.get('budget')
+                }}
+                self._activate_staged(update_info, result.get('io'), result.get('memory'))
+
+            except Exception as e:
+                self._record_failure(update_info, e)
+                raise
+
+    def stage_update(self, update_file, update_info):
+        """備份（舊版平鋪安裝）並將更新包驗證後放入版本槽位"""
+        version = update_info['version']
+        releases = self.releases
+
+        # 舊版平鋪安裝才需要完整備份，槽位結構下上一版本即為備份
+        if not releases.is_slot_layout():
+            with self._memory_stage("backup"):
+                self._backup_current_version()
+
+        with self._memory_stage("extract"):
+            if update_info.get('components'):
+                self._stage_components(update_file, update_info, releases)
+            elif update_info.get('format') == 'zipapp':
+                self._stage_zipapp(update_file, version, releases)
+            else:
+                self._stage_tarball(update_file, version, releases)
+
+        # 已放入槽位，預先下載的快取不再需要
+        self.prefetch_cache.discard(update_info)
+
+    def _activate_staged(self, update_info, io_stats=None, memory_stats=None):
+        """切換到已放入槽位的版本"""
+        self._report_progress(update_info, "activating", download_source=update_info.get('download_source'))
+        # 只修改處理邏輯的版本先嘗試行程內熱更新；相依套件與設定變動時必須重啟
+        if update_info.get('reloadable') and not update_info.get('components') and self._try_hot_reload(
+                update_info['version'], self.releases, update_info, io_stats, memory_stats):
+            return
+
+        # 建立更新執行腳本，交由更新執行器切換版本並重啟服務
+        self._create_update_script(update_info, io_stats, {**(memory_stats or {}), **self._finish_memory_profile()})
+        self._schedule_update_handover()
+
+    def _record_failure(self, update_info, error):
+        """清除暫存檔並記錄失敗"""
+        logger.error(f"套用更新失敗: {error}")
+        if update_info.get('version'):
+            releases = self.releases
+            shutil.rmtree(releases.staging_dir(update_info['version']), ignore_errors=True)
+            if releases.staging_archive(update_info['version']).exists():
+                releases.staging_archive(update_info['version']).unlink()
+            # 多元件更新已下載的元件
+            for staged in releases.releases_dir.glob(f".staging-{update_info['version']}-*"):
+                staged.unlink()
+        self._io_session = None
+        self.add_update_record(
+            {**update_info, "error": str(error)}, status="failed", memory=self._finish_memory_profile()
+        )
+
+    def _try_hot_reload(self, version, releases, update_info, io_stats=None, memory_stats=None):
+        """行程內熱更新，成功回傳True；失敗時回傳False改走重啟流程"""
+        if self.hot_reloader is None or not releases.is_slot_layout():
+            logger.info("無法熱更新，改為重啟更新")
+            return False
+
+        start_time = time.monotonic()
+        try:
+            with self._memory_stage("swap"):
+                self.hot_reloader.reload(releases.release_path(version), version)
+        except Exception as e:
+            logger.warning(f"熱更新失敗，改為重啟更新: {e}")
+            return False
 
-            # 2. 解壓縮更新檔案
-            extract_dir = self.temp_dir / "extracted"
-            self._extract_update(update_file, extract_dir)
+        # 切換 current，之後重啟時也使用新版本
+        releases.activate(version)
+        reload_ms = round((time.monotonic() - start_time) * 1000, 1)
 
-            # 3. 建立更新執行腳本
-            self._create_update_script(extract_dir, update_info)
+        self.history.append({
+            "timestamp": datetime.now().isoformat(),
+            "version": version,
+            "status": "completed",
+            "mode": "hot_reload",
+            "reload_ms": reload_ms,
+            "downtime_ms": 0.0,
+            "io": io_stats,
+            "memory": {**(memory_stats or {}), **self._finish_memory_profile()},
+            "details": update_info
+        })
+        releases.collect_garbage_async(config.get('ota.backup_count', 3), in_use=self.versions_in_use)
+        logger.info(f"熱更新完成，耗時 {reload_ms} ms")
+        return True
+
+    def _stage_tarball(self, update_file, version, releases, prepare=None):
+        """解壓縮tar更新包、編譯並測試後放入槽位
+
+        prepare(app_dir) 在編譯前呼叫，讓多元件更新把其他元件放進同一個槽位。
+        """
+        # 解壓縮到與槽位同一檔案系統的暫存目錄
+        extract_dir = releases.staging_dir(version)
+        self._extract_update(update_file, extract_dir)
+
+        app_dir = self._find_app_dir(extract_dir)
+        if prepare is not None:
+            prepare(app_dir)
+
+        # 預先編譯位元組碼並在隔離環境中測試匯入
+        self._precompile_release(app_dir, releases.release_dir(version))
+        self._smoke_test_release(app_dir, version)
+
+        # 提交點：放入槽位前所有檔案（含 .pyc）已寫入儲存裝置
+        session = self._write_session()
+        for pyc_file in app_dir.rglob("*.pyc"):
+            session.track_existing(pyc_file)
+        session.commit()
+
+        # 放入版本槽位（rename，不複製檔案）
+        releases.stage(version, app_dir)
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+        # 磁碟上的下載暫存檔已解壓縮，不再需要
+        if Path(update_file) == releases.staging_package(version):
+            Path(update_file).unlink()
+
+    def _stage_components(self, files, update_info, releases):
+        """將所有元件放入同一個版本槽位，一次切換、一次重啟，回滾時一併還原"""
+        version = update_info['version']
+        components = self._validate_components(update_info)
+        app_component = next(c for c in components if c['strategy'] == "release")
+        current = releases.release_path(releases.current_version()) if releases.is_slot_layout() else None
+
+        def install(app_dir):
+            session = self._write_session()
+            for component in components:
+                source = files.get(component['name'])
+                if component['strategy'] == "site-packages":
+                    target = app_dir / DEPS_DIR_NAME
+                    if source is None:
+                        session.copy_tree(self._installed_component_path(current, DEPS_DIR_NAME), target)
+                    else:
+                        import tarfile
+                        target.mkdir()
+                        with tarfile.open(source, 'r:*') as tar:
+                            session.extract_tar(tar, target)
+                elif component['strategy'] == "config":
+                    target = app_dir / RELEASE_CONFIG_NAME
+                    if source is None:
+                        source = self._installed_component_path(current, RELEASE_CONFIG_NAME)
+                    self._check_release_config(source)
+                    session.copy_file(source, target)
+
+            with session.open(app_dir / COMPONENTS_FILE) as f:
+                f.write(json.dumps({
+                    component['name']: {
+                        "version": component['version'],
+                        "strategy": component['strategy'],
+                        "checksum": component['checksum']
+                    }
+                    for component in components
+                }, indent=2, ensure_ascii=False).encode('utf-8'))
+
+        self._stage_tarball(files[app_component['name']], version, releases, prepare=install)
+
+        for path in files.values():
+            if path is not None and path.exists():
+                path.unlink()
+        logger.info(f"已放入 {len(components)} 個元件到版本 {version} 的槽位")
+
+    def _installed_component_path(self, current, name):
+        """沿用的元件在目前槽位中的路徑"""
+        if current is None or not (current / name).exists():
+            raise Exception(f"目前版本沒有可沿用的元件: {name}")
+        return current / name
+
+    def _check_release_config(self, path):
+        """版本設定必須是JSON物件"""
+        if Path(path).stat().st_size > MAX_MANIFEST_SIZE:
+            raise Exception(f"版本設定過大: {Path(path).stat().st_size} bytes")
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                release_config = json.load(f)
+            except ValueError as e:
+                raise Exception(f"版本設定不是有效的JSON: {e}")
+        if not isinstance(release_config, dict):
+            raise Exception("版本設定必須是JSON物件")
+
+    def _stage_zipapp(self, update_file, version, releases):
+        """驗證單一封存檔版本後直接放入槽位，不解壓縮"""
+        import zipfile
+        import importlib.util
+
+        with zipfile.ZipFile(update_file) as archive:
+            try:
+                manifest_info = archive.getinfo("MANIFEST.json")
+            except KeyError:
+                raise Exception("封存檔缺少 MANIFEST.json")
+            # 清單檔整個讀入記憶體，限制大小
+            if manifest_info.file_size > MAX_MANIFEST_SIZE:
+                raise Exception(f"MANIFEST.json 過大: {manifest_info.file_size} bytes")
+            manifest = json.loads(archive.read(manifest_info))
+
+        if manifest.get('version') != version:
+            raise Exception(f"封存檔版本不符: {manifest.get('version')} != {version}")
+
+        # 封存檔內只有 .pyc，必須與裝置上的Python位元組碼版本相同
+        if manifest.get('python_magic') != importlib.util.MAGIC_NUMBER.hex():
+            raise Exception(f"封存檔Python版本不符: {manifest.get('python_tag')}")
+
+        self._smoke_test_release(update_file, version)
+
+        # 提交點：下載的封存檔已寫入儲存裝置才放入槽位
+        self._write_session().commit()
+        releases.stage_archive(version, update_file)
+
+    def _precompile_release(self, app_dir, final_dir):
+        """以多個行程預先編譯位元組碼，新版本首次啟動時不需在裝置上編譯"""
+        import compileall
+
+        workers = config.get('ota.compile_workers', 0)
+        optimize_levels = config.get('ota.compile_optimize', [0])
+
+        logger.info(f"預先編譯位元組碼: {app_dir}")
+        start_time = time.monotonic()
+
+        # ddir 讓錯誤追蹤顯示最終槽位路徑而非暫存路徑
+        ok = compileall.compile_dir(
+            str(app_dir),
+            ddir=str(final_dir),
+            workers=workers,
+            optimize=optimize_levels,
+            quiet=1
+        )
+        if not ok:
+            raise Exception("更新包編譯失敗，拒絕套用")
+
+        logger.info(f"位元組碼編譯完成，耗時 {time.monotonic() - start_time:.2f}秒")
+
+    def _smoke_test_release(self, app_dir, version):
+        """在獨立行程中匯入新版本的核心模組，確認版本號正確"""
+        code = (
+            "import sys; sys.path.insert(0, sys.argv[1]); "
+            "import main, config, ota_manager, version; "
+            "assert version.__version__ == sys.argv[2], "
+            "f'版本不符: {version.__version__} != {sys.argv[2]}'"
+        )
 
-            # 4. 排程更新並退出
-            self._schedule_update_and_exit()
+        try:
+            result = subprocess.run(
+                [sys.executable, "-I", "-c", code, str(app_dir), version],
+                cwd=str(app_dir if app_dir.is_dir() else app_dir.parent),
+                capture_output=True,
+                text=True,
+                timeout=config.get('ota.smoke_test_timeout', 30)
+            )
+        except subprocess.TimeoutExpired:
+            raise Exception("新版本匯入測試逾時，拒絕套用")
 
-        except Exception as e:
-            logger.error(f"套用更新失敗: {e}")
-            raise
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1:] or ["未知錯誤"]
+            raise Exception(f"新版本匯入測試失敗，拒絕套用: {error[0]}")
+
+        logger.info("新版本匯入測試通過")
+
+    def _find_app_dir(self, extract_dir):
+        """在解壓縮目錄中找出含 main.py 的 app 目錄"""
+        for candidate in [extract_dir / "app", *sorted(extract_dir.glob("*/app"))]:
+            if (candidate / "main.py").exists():
+                return candidate
+        raise Exception(f"更新包中找不到 app/main.py: {extract_dir}")
 
     def _backup_current_version(self):
         """備份當前版本"""
-        from .version import __version__
+        from version import __version__
 
         backup_name = f"backup_{__version__}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         backup_path = self.backup_dir / backup_name
 
         logger.info(f"備份當前版本到: {backup_path}")
 
-        # 複製當前應用程式目錄
-        shutil.copytree(self.app_dir, backup_path, symlinks=True)
+        # 複製當前應用程式目錄，完成後一次同步
+        session = self._write_session()
+        session.copy_tree(self.app_dir, backup_path)
+        session.commit()
 
         # 清理舊備份（保留最近N個）
         self._cleanup_old_backups()
@@ -162,6 +1059,8 @@ class OTAManager:
 
     def _extract_update(self, update_file, extract_dir):
         """解壓縮更新檔案"""
+        import tarfile
+
         logger.info(f"解壓縮更新檔案到: {extract_dir}")
 
         if extract_dir.exists():
@@ -169,95 +1068,44 @@ class OTAManager:
         extract_dir.mkdir(parents=True)
 
         with tarfile.open(update_file, 'r:gz') as tar:
-            tar.extractall(extract_dir)
+            self._write_session().extract_tar(tar, extract_dir)
 
-    def _create_update_script(self, source_dir, update_info):
+    def _create_update_script(self, update_info, io_stats=None, memory_stats=None):
         """建立更新執行腳本"""
+        from version import __version__
+
+        params = {
+            "app_dir": str(self.app_dir),
+            "version": update_info['version'],
+            "old_version": __version__,
+            "old_pid": os.getpid(),
+            "update_info": update_info,
+            "data_dir": config.get('system.data_dir', '/var/lib/hello-ota'),
+            "port": config.get('app.port', 8080),
+            "keep": config.get('ota.backup_count', 3),
+            "service_manager": config.get('ota.service_manager', 'systemd'),
+            "restart_command": config.get('ota.restart_command') or None,
+            "timeout": config.get('ota.restart_timeout', 30),
+            "health_deadline": config.get('ota.health_deadline', 60),
+            "listen_fd": self._handoff_fd(),
+            "io_stats": io_stats,
+            "memory_stats": memory_stats
+        }
+
         script_content = f'''#!/usr/bin/env python3
 """
 自動生成的OTA更新執行腳本
 """
-import os
 import sys
-import time
-import shutil
-import subprocess
-import json
-from pathlib import Path
-
-def log(message):
-    print(f"[OTA] {{message}}")
 
-def main():
-    log("OTA更新執行腳本啟動")
+# 使用目前版本槽位中的更新執行器
+sys.path.insert(0, "{Path(__file__).resolve().parent}")
+from updater import run_update
 
-    # 等待主程式完全退出
-    time.sleep(3)
-
-    app_dir = Path("/opt/hello-ota")
-    source_dir = Path("{source_dir}")
-    backup_info_file = Path("/var/lib/hello-ota/last_update.json")
-
-    try:
-        # 記錄更新資訊
-        update_info = {update_info}
-        backup_info_file.parent.mkdir(parents=True, exist_ok=True)
-        with open(backup_info_file, 'w') as f:
-            json.dump(update_info, f, indent=2)
-
-        # 執行更新
-        log("開始複製新版本檔案")
-
-        # 使用原子性操作
-        temp_app_dir = app_dir.parent / "hello-ota-new"
-        if temp_app_dir.exists():
-            shutil.rmtree(temp_app_dir)
-
-        shutil.copytree(source_dir / "app", temp_app_dir)
-
-        # 原子性替換
-        old_app_dir = app_dir.parent / "hello-ota-old"
-        if old_app_dir.exists():
-            shutil.rmtree(old_app_dir)
-
-        if app_dir.exists():
-            app_dir.rename(old_app_dir)
-        temp_app_dir.rename(app_dir)
-
-        log("檔案更新完成")
-
-        # 重啟服務
-        log("重啟hello-ota服務")
-        subprocess.run(["sudo", "systemctl", "start", "hello-ota"], check=True)
-
-        log("OTA更新完成成功")
-
-        # 清理
-        if old_app_dir.exists():
-            shutil.rmtree(old_app_dir)
-
-    except Exception as e:
-        log(f"OTA更新失敗: {{e}}")
-
-        # 嘗試回滾
-        try:
-            if old_app_dir.exists():
-                log("執行回滾")
-                if app_dir.exists():
-                    shutil.rmtree(app_dir)
-                old_app_dir.rename(app_dir)
-
-                subprocess.run(["sudo", "systemctl", "start", "hello-ota"], check=True)
-                log("回滾完成")
-            else:
-                log("無法回滾：找不到備份")
-        except Exception as rollback_error:
-            log(f"回滾失敗: {{rollback_error}}")
-
-        sys.exit(1)
+PARAMS = {params!r}
 
 if __name__ == "__main__":
-    main()
+    sys.exit(run_update(PARAMS))
 '''
 
         with open(self.update_script, 'w', encoding='utf-8') as f:
@@ -267,48 +1115,50 @@ if __name__ == "__main__":
         os.chmod(self.update_script, 0o755)
         logger.info(f"更新腳本已建立: {self.update_script}")
 
-    def _schedule_update_and_exit(self):
-        """排程更新執行並優雅退出"""
+    def _schedule_update_handover(self):
+        """在背景啟動更新執行器，由它切換版本並重啟服務
+
+        目前行程持續服務到執行器重啟服務為止，不再自行停止服務或固定等待。
+        """
         logger.info("排程更新執行")
 
-        # 在背景執行更新腳本
-        subprocess.Popen([
-            sys.executable, str(self.update_script)
-        ], start_new_session=True)
+        command = [sys.executable, str(self.update_script)]
 
-        # 停止當前服務
-        logger.info("停止當前服務")
-        subprocess.run(["sudo", "systemctl", "stop", "hello-ota"])
+        # 在服務的cgroup之外執行，重啟服務時執行器不會一併被終止
+        if (config.get('ota.service_manager', 'systemd') == 'systemd'
+                and os.environ.get('INVOCATION_ID') and shutil.which('systemd-run')):
+            command = [
+                "sudo", "systemd-run", "--collect", "--quiet",
+                f"--unit=hello-ota-updater-{int(time.time())}"
+            ] + command
 
-        # 退出當前程式
-        sys.exit(0)
+        # 非systemd模式下把監聽socket傳給執行器，再由它交給新版本
+        handoff_fd = self._handoff_fd()
+        pass_fds = [handoff_fd] if handoff_fd is not None else []
 
-    def get_update_history(self):
-        """取得更新歷史"""
-        history_file = Path("/var/lib/hello-ota/update_history.json")
-        if history_file.exists():
-            with open(history_file, 'r') as f:
-                return json.load(f)
-        return []
+        subprocess.Popen(command, start_new_session=True, pass_fds=pass_fds)
 
-    def add_update_record(self, update_info):
-        """新增更新記錄"""
-        history_file = Path("/var/lib/hello-ota/update_history.json")
-        history_file.parent.mkdir(parents=True, exist_ok=True)
+    def _handoff_fd(self):
+        """需要由執行器轉交的監聽socket描述符（systemd socket activation 時不需要）"""
+        if self.listen_socket is None or config.get('ota.service_manager', 'systemd') != 'process':
+            return None
+        return self.listen_socket.fileno()
 
-        history = self.get_update_history()
+    def get_update_history(self, count=None):
+        """取得更新歷史（最近的記錄由記憶體提供）"""
+        if count is not None:
+            return self.history.recent(count)
+        return self.history.all()
 
+    def add_update_record(self, update_info, status="completed", memory=None):
+        """新增更新記錄"""
         record = {
             "timestamp": datetime.now().isoformat(),
             "version": update_info.get('version'),
-            "status": "completed",
+            "status": status,
             "details": update_info
         }
+        if memory:
+            record["memory"] = memory
 
-        history.append(record)
-
-        # 只保留最近50筆記錄
-        history = history[-50:]
-
-        with open(history_file, 'w') as f:
-            json.dump(history, f, indent=2, ensure_ascii=False)
\ No newline at end of file
+        self.history.append(record)
@@ -0,0 +1,238 @@
+"""
+OTA背景工作行程 - 以較低的CPU與I/O優先權執行下載、驗證、解壓縮與備份
+
+服務行程只負責切換版本；耗費資源的工作交給獨立行程，
+並在系統負載超過預算時暫停，避免影響交易處理的延遲。
+"""
+import os
+import sys
+import json
+import time
+import ctypes
+import logging
+import platform
+import subprocess
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# ioprio_set / ioprio_get 系統呼叫編號
+IOPRIO_SYSCALLS = {
+    "x86_64": (251, 252),
+    "i386": (289, 290),
+    "i686": (289, 290),
+    "aarch64": (30, 31),
+    "riscv64": (30, 31),
+    "armv7l": (314, 315),
+    "armv6l": (314, 315),
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_IDLE = 3
+
+def _ioprio_syscall(index, *args):
+    numbers = IOPRIO_SYSCALLS.get(platform.machine())
+    if numbers is None or not sys.platform.startswith("linux"):
+        return -1
+    libc = ctypes.CDLL(None, use_errno=True)
+    return libc.syscall(numbers[index], *args)
+
+def set_idle_io_priority(pid=0):
+    """將行程設為idle I/O類別，只在磁碟閒置時才進行I/O"""
+    result = _ioprio_syscall(0, IOPRIO_WHO_PROCESS, pid, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    if result == 0:
+        return True
+
+    # 系統呼叫不可用時改用 ionice
+    try:
+        subprocess.run(["ionice", "-c", "3", "-p", str(pid or os.getpid())],
+                       check=True, capture_output=True, timeout=5)
+        return True
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+def io_priority_class(pid=0):
+    """行程的I/O優先權類別（3為idle），無法取得時回傳None"""
+    result = _ioprio_syscall(1, IOPRIO_WHO_PROCESS, pid)
+    if result < 0:
+        return None
+    return result >> IOPRIO_CLASS_SHIFT
+
+def lower_priority(nice_increment=10):
+    """降低目前行程的CPU與I/O優先權，回傳實際的設定結果"""
+    try:
+        niceness = os.nice(nice_increment)
+    except OSError:
+        niceness = None
+    return {"nice": niceness, "idle_io": set_idle_io_priority()}
+
+def _cpu_times():
+    """系統整體 (忙碌, 總計) 的CPU時間（jiffies）"""
+    with open('/proc/stat', 'r') as f:
+        fields = [int(value) for value in f.readline().split()[1:]]
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    return sum(fields) - idle, sum(fields)
+
+def _own_cpu_jiffies():
+    times = os.times()
+    total = times.user + times.system + times.children_user + times.children_system
+    return total * os.sysconf('SC_CLK_TCK')
+
+class LoadBudget:
+    """系統負載預算：其他行程的CPU使用率或負載平均超過上限時暫停OTA工作
+
+    計算CPU使用率時扣除本行程（含子行程）自己的用量，避免因自身負載而暫停。
+    暫停超過 max_pause 秒仍會繼續，確保更新最終能完成。
+    """
+
+    def __init__(self, max_cpu_percent=60, max_load_per_cpu=1.5,
+                 check_interval=0.25, pause_interval=0.2, max_pause=30):
+        self.max_cpu_percent = max_cpu_percent
+        self.max_load_per_cpu = max_load_per_cpu
+        self.check_interval = check_interval
+        self.pause_interval = pause_interval
+        self.max_pause = max_pause
+        self.cpu_count = os.cpu_count() or 1
+        self.pause_count = 0
+        self.paused_seconds = 0.0
+        self._last_check = 0.0
+        self._last_sample = self._sample()
+
+    def _sample(self):
+        try:
+            busy, total = _cpu_times()
+        except (OSError, ValueError, IndexError):
+            return None
+        return busy, total, _own_cpu_jiffies()
+
+    def other_cpu_percent(self):
+        """自上次取樣以來其他行程佔用的CPU百分比（以全部核心為100%）"""
+        sample = self._sample()
+        previous, self._last_sample = self._last_sample, sample
+        if sample is None or previous is None:
+            return 0.0
+
+        busy = sample[0] - previous[0]
+        total = sample[1] - previous[1]
+        own = sample[2] - previous[2]
+        if total <= 0:
+            return 0.0
+        return max(busy - own, 0) * 100.0 / total
+
+    def over_budget(self):
+        if self.other_cpu_percent() > self.max_cpu_percent:
+            return True
+        try:
+            # 負載平均包含本行程自己
+            load = max(os.getloadavg()[0] - 1, 0)
+        except OSError:
+            return False
+        return load / self.cpu_count > self.max_load_per_cpu
+
+    def wait(self):
+        """超過預算時暫停，直到負載下降或達到最長暫停時間"""
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+
+        paused_at = None
+        while self.over_budget():
+            if paused_at is None:
+                paused_at = time.monotonic()
+                self.pause_count += 1
+            if time.monotonic() - paused_at >= self.max_pause:
+                logger.warning("系統負載持續偏高，繼續執行OTA工作")
+                break
+            time.sleep(self.pause_interval)
+
+        if paused_at is not None:
+            self.paused_seconds += time.monotonic() - paused_at
+            self._last_check = time.monotonic()
+
+    def report(self):
+        return {"pause_count": self.pause_count, "paused_seconds": round(self.paused_seconds, 2)}
+
+def run_in_worker(request, timeout=3600):
+    """在低優先權工作行程中下載並放入槽位（或只預先下載），回傳寫入與記憶體統計"""
+    app_dir = Path(__file__).resolve().parent
+    code = (
+        "import sys; sys.path.insert(0, sys.argv[1]); "
+        "import ota_worker; sys.exit(ota_worker.worker_main())"
+    )
+
+    logger.info("在背景工作行程中準備更新")
+    process = subprocess.Popen(
+        [sys.executable, "-c", code, str(app_dir)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    try:
+        output, _ = process.communicate(json.dumps(request), timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise Exception("OTA工作行程逾時")
+
+    lines = output.strip().splitlines()
+    try:
+        result = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        raise Exception(f"OTA工作行程異常結束 (exit {process.returncode})")
+
+    if not result.get('ok'):
+        raise Exception(result.get('error', "OTA工作行程失敗"))
+    return result
+
+def worker_main():
+    """工作行程入口：從stdin讀取請求，結果以一行JSON寫到stdout"""
+    from config import config
+
+    logging.basicConfig(
+        level=getattr(logging, config.get('app.log_level', 'INFO')),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        stream=sys.stderr
+    )
+
+    priority = lower_priority(config.get('ota.worker_nice', 10))
+    logger.info(f"OTA工作行程已降低優先權: {priority}")
+
+    request = json.loads(sys.stdin.read())
+
+    from ota_manager import OTAManager
+    from update_scheduler import PrefetchCache
+    from peer_cache import PeerCache
+    from mirror_select import MirrorSelector
+
+    manager = OTAManager()
+    manager.app_dir = Path(request['app_dir'])
+    manager.temp_dir = Path(request['temp_dir'])
+    manager.backup_dir = Path(request['backup_dir'])
+    manager.prefetch_cache = PrefetchCache(request['prefetch_dir'])
+    manager.peer_cache = PeerCache(**request['peer_cache'])
+    manager.mirrors = MirrorSelector(**request['mirrors'])
+    manager.budget = LoadBudget(
+        max_cpu_percent=config.get('ota.max_cpu_percent', 60),
+        max_load_per_cpu=config.get('ota.max_load_per_cpu', 1.5)
+    )
+
+    try:
+        update_info = request['update_info']
+        if request.get('action') == 'prefetch':
+            manager.prefetch_update(update_info)
+        else:
+            update_file = manager.download_update(update_info)
+            manager.stage_update(update_file, update_info)
+        result = {
+            "ok": True,
+            "io": manager._finish_write_session(),
+            "memory": manager._finish_memory_profile(),
+            "budget": manager.budget.report(),
+            "download_source": manager.download_source,
+            "priority": priority
+        }
+    except Exception as e:
+        logger.error(f"OTA工作行程失敗: {e}")
+        result = {"ok": False, "error": str(e)}
+
+    print(json.dumps(result, ensure_ascii=False), flush=True)
+    return 0 if result['ok'] else 1
@@ -0,0 +1,132 @@
+"""
+區域網路節點快取 - 同一站點的機器互相提供已驗證的更新包
+
+同一個路由器後面的機器先向鄰近節點取得更新包，都沒有時才向更新服務器下載，
+整個站點的上行流量只需要一份。更新包以更新服務器公布的SHA256為鍵，
+取得後一律以該校驗和驗證，節點提供錯誤內容時改向更新服務器下載。
+"""
+import os
+import re
+import json
+import shutil
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+from flash_io import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+# 節點之間提供更新包的路徑：/ota/packages/<sha256>
+PACKAGES_PATH = "/ota/packages"
+CHECKSUM_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class PeerCache:
+    """以SHA256為鍵的更新包快取
+
+    <cache_dir>/<sha256>.pkg   已驗證的更新包
+    <cache_dir>/<sha256>.json  版本與大小等資訊
+    """
+
+    def __init__(self, cache_dir, enabled=False, peers=(), keep=2, timeout=5):
+        self.cache_dir = Path(cache_dir)
+        self.enabled = enabled
+        self.peers = [peer.rstrip('/') for peer in peers]
+        self.keep = keep
+        self.timeout = timeout
+        self.served_bytes = 0
+        self._lock = threading.Lock()
+
+    def settings(self):
+        """建立相同設定所需的參數（交給工作行程）"""
+        return {
+            "cache_dir": str(self.cache_dir),
+            "enabled": self.enabled,
+            "peers": self.peers,
+            "keep": self.keep,
+            "timeout": self.timeout
+        }
+
+    def package_path(self, checksum):
+        if not CHECKSUM_PATTERN.match(checksum or ""):
+            raise Exception(f"無效的校驗和: {checksum}")
+        return self.cache_dir / f"{checksum}.pkg"
+
+    def package_file(self, checksum):
+        """可提供給其他節點的更新包路徑，沒有時回傳None"""
+        if not self.enabled or not CHECKSUM_PATTERN.match(checksum or ""):
+            return None
+        path = self.package_path(checksum)
+        return path if path.exists() else None
+
+    def peer_urls(self, checksum):
+        """依設定順序向各節點取得更新包的網址"""
+        if not CHECKSUM_PATTERN.match(checksum or ""):
+            return []
+        return [f"{peer}{PACKAGES_PATH}/{checksum}" for peer in self.peers]
+
+    def store(self, package_file, update_info, copy_function=shutil.copyfile):
+        """保存已驗證的更新包供其他節點下載，同一檔案系統時以硬連結不複製內容"""
+        if not self.enabled:
+            return None
+
+        checksum = update_info['checksum']
+        target = self.package_path(checksum)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        if not target.exists():
+            tmp_file = target.with_suffix('.tmp')
+            if tmp_file.exists():
+                tmp_file.unlink()
+            try:
+                os.link(package_file, tmp_file)
+            except OSError:
+                copy_function(package_file, tmp_file)
+            os.replace(tmp_file, target)
+
+        info = {
+            "checksum": checksum,
+            "version": update_info.get('version'),
+            "format": update_info.get('format', 'tar'),
+            "size": target.stat().st_size,
+            "stored_at": datetime.now().isoformat()
+        }
+        atomic_write_json(target.with_suffix('.json'), info, ensure_ascii=False)
+
+        logger.info(f"版本 {info['version']} 的更新包已可提供給同一站點的節點")
+        self._prune()
+        return target
+
+    def _prune(self):
+        """只保留最近的 keep 個更新包"""
+        packages = sorted(self.packages(), key=lambda info: info['stored_at'], reverse=True)
+        for info in packages[self.keep:]:
+            for suffix in ('.pkg', '.json'):
+                path = self.cache_dir / f"{info['checksum']}{suffix}"
+                if path.exists():
+                    path.unlink()
+
+    def packages(self):
+        """目前可提供的更新包資訊"""
+        packages = []
+        for info_file in self.cache_dir.glob("*.json"):
+            try:
+                with open(info_file, 'r', encoding='utf-8') as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if (self.cache_dir / f"{info.get('checksum')}.pkg").exists():
+                packages.append(info)
+        return packages
+
+    def record_served(self, size):
+        with self._lock:
+            self.served_bytes += size
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "peers": self.peers,
+            "packages": self.packages() if self.enabled else [],
+            "served_bytes": self.served_bytes
+        }
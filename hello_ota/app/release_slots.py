@@ -0,0 +1,286 @@
+"""
+版本槽位管理 - releases/<version> 目錄加上 current 符號連結
+
+切換版本只需原子性替換一個符號連結，回滾同樣是O(1)。
+槽位可以是解開的目錄，也可以是單一的 <version>.pyz 封存檔，
+兩者都能以 `python3 /opt/hello-ota/current` 直接執行。
+"""
+import os
+import json
+import shutil
+import logging
+import threading
+from pathlib import Path
+from flash_io import fsync_dir
+
+logger = logging.getLogger(__name__)
+
+# 舊版平鋪安裝轉換後，讓 /opt/hello-ota/main.py 仍可啟動目前版本
+LEGACY_LAUNCHER = '''#!/usr/bin/env python3
+import os
+import sys
+
+target = os.path.join(os.path.dirname(os.path.abspath(__file__)), "current")
+os.execv(sys.executable, [sys.executable, target] + sys.argv[1:])
+'''
+
+# 多元件更新：相依套件與版本設定和程式碼放在同一個槽位，切換與回滾都只需替換一個連結
+DEPS_DIR_NAME = "_deps"
+RELEASE_CONFIG_NAME = "release_config.json"
+COMPONENTS_FILE = "COMPONENTS.json"
+
+# 讓解開的版本目錄可以 `python3 <目錄>` 直接執行
+ENTRY_POINT = '''import main
+main.main()
+'''
+
+class ReleaseManager:
+    """版本槽位管理器
+
+    目錄結構:
+        <base_dir>/releases/<version>/      解開的版本程式碼
+        <base_dir>/releases/<version>.pyz   或單一封存檔版本
+        <base_dir>/current -> releases/<version>[.pyz]
+        <base_dir>/previous -> releases/<version>[.pyz]
+    """
+
+    ARCHIVE_SUFFIX = ".pyz"
+
+    def __init__(self, base_dir):
+        self.base_dir = Path(base_dir)
+        self.releases_dir = self.base_dir / "releases"
+        self.current_link = self.base_dir / "current"
+        self.previous_link = self.base_dir / "previous"
+
+    def is_slot_layout(self):
+        """是否已使用版本槽位結構"""
+        return self.current_link.is_symlink()
+
+    def release_dir(self, version):
+        return self.releases_dir / version
+
+    def release_archive(self, version):
+        return self.releases_dir / f"{version}{self.ARCHIVE_SUFFIX}"
+
+    def release_path(self, version):
+        """版本槽位實際路徑（目錄或封存檔），不存在時回傳None"""
+        for path in (self.release_dir(version), self.release_archive(version)):
+            if path.exists():
+                return path
+        return None
+
+    def staging_dir(self, version):
+        """暫存目錄，與 releases 位於同一檔案系統以便直接rename"""
+        return self.releases_dir / f".staging-{version}"
+
+    def staging_archive(self, version):
+        """封存檔版本的下載暫存位置"""
+        return self.releases_dir / f".staging-{version}{self.ARCHIVE_SUFFIX}"
+
+    def staging_package(self, version):
+        """tar更新包在tmpfs空間不足時的磁碟暫存位置"""
+        return self.releases_dir / f".staging-{version}.tar.gz"
+
+    def _link_target(self, link):
+        if not link.is_symlink():
+            return None
+        name = Path(os.readlink(link)).name
+        if name.endswith(self.ARCHIVE_SUFFIX):
+            name = name[:-len(self.ARCHIVE_SUFFIX)]
+        return name
+
+    def current_version(self):
+        return self._link_target(self.current_link)
+
+    def previous_version(self):
+        return self._link_target(self.previous_link)
+
+    def installed_components(self, version=None):
+        """槽位中各元件的版本資訊（預設為目前版本），沒有時回傳空字典"""
+        version = version or self.current_version()
+        path = self.release_path(version) if version else None
+        if path is None or not path.is_dir():
+            return {}
+        try:
+            with open(path / COMPONENTS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def list_releases(self):
+        """列出所有版本槽位（依修改時間，舊到新）"""
+        if not self.releases_dir.exists():
+            return []
+        slots = [
+            p for p in self.releases_dir.iterdir()
+            if not p.name.startswith('.') and (p.is_dir() or p.name.endswith(self.ARCHIVE_SUFFIX))
+        ]
+        return [
+            p.name[:-len(self.ARCHIVE_SUFFIX)] if p.is_file() else p.name
+            for p in sorted(slots, key=lambda p: p.stat().st_mtime)
+        ]
+
+    def stage(self, version, source_dir):
+        """將已解壓縮的版本放入槽位"""
+        source_dir = Path(source_dir)
+        target = self.release_dir(version)
+        self.releases_dir.mkdir(parents=True, exist_ok=True)
+
+        self._remove_existing(version)
+
+        try:
+            # 同一檔案系統時為O(1)
+            source_dir.rename(target)
+        except OSError:
+            shutil.copytree(source_dir, target, symlinks=True)
+            shutil.rmtree(source_dir, ignore_errors=True)
+
+        self._ensure_entry_point(target)
+        fsync_dir(self.releases_dir)
+        logger.info(f"版本 {version} 已放入槽位: {target}")
+        return target
+
+    @staticmethod
+    def _ensure_entry_point(slot_dir):
+        """舊版本目錄缺少 __main__.py 時補上"""
+        entry_point = slot_dir / "__main__.py"
+        if not entry_point.exists():
+            with open(entry_point, 'w', encoding='utf-8') as f:
+                f.write(ENTRY_POINT)
+
+    def stage_archive(self, version, archive_file):
+        """將單一封存檔版本放入槽位，只需一次rename"""
+        archive_file = Path(archive_file)
+        target = self.release_archive(version)
+        self.releases_dir.mkdir(parents=True, exist_ok=True)
+
+        self._remove_existing(version)
+
+        try:
+            archive_file.rename(target)
+        except OSError:
+            shutil.copy2(archive_file, target)
+            archive_file.unlink()
+
+        fsync_dir(self.releases_dir)
+        logger.info(f"版本 {version} 已放入槽位: {target}")
+        return target
+
+    def _remove_existing(self, version):
+        """移除同版本的舊槽位（正在使用中的版本不可覆寫）"""
+        existing = self.release_path(version)
+        if existing is None:
+            return
+        if self.current_version() == version:
+            raise Exception(f"版本 {version} 正在使用中，無法覆寫")
+        self._remove_slot(existing)
+
+    @staticmethod
+    def _remove_slot(path):
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        elif path.exists():
+            path.unlink()
+
+    def activate(self, version):
+        """原子性切換 current 到指定版本"""
+        target = self.release_path(version)
+        if target is None:
+            raise Exception(f"版本槽位不存在: {self.release_dir(version)}")
+
+        old_version = self.current_version()
+        old_target = self.release_path(old_version) if old_version else None
+        if old_target is not None and old_version != version:
+            self._replace_link(self.previous_link, old_target.name)
+
+        self._replace_link(self.current_link, target.name)
+        logger.info(f"已切換版本: {old_version} -> {version}")
+        return old_version
+
+    def rollback(self):
+        """切回上一個版本"""
+        previous = self.previous_version()
+        if not previous or self.release_path(previous) is None:
+            raise Exception("無法回滾：找不到上一個版本")
+        return self.activate(previous)
+
+    def _replace_link(self, link, slot_name):
+        """建立暫存連結後以rename原子性替換"""
+        tmp_link = link.with_name(f".{link.name}.tmp")
+        if tmp_link.is_symlink() or tmp_link.exists():
+            tmp_link.unlink()
+
+        os.symlink(os.path.join("releases", slot_name), tmp_link)
+        os.replace(tmp_link, link)
+        fsync_dir(self.base_dir)
+
+    def migrate_legacy(self, version):
+        """將平鋪安裝的 /opt/hello-ota 轉換為槽位結構"""
+        if self.is_slot_layout():
+            return
+
+        target = self.release_dir(version)
+        target.mkdir(parents=True, exist_ok=True)
+
+        for entry in self.base_dir.iterdir():
+            if entry.name in ("releases", "current", "previous"):
+                continue
+            entry.rename(target / entry.name)
+
+        self._ensure_entry_point(target)
+        self._replace_link(self.current_link, version)
+
+        launcher = self.base_dir / "main.py"
+        with open(launcher, 'w', encoding='utf-8') as f:
+            f.write(LEGACY_LAUNCHER)
+        os.chmod(launcher, 0o755)
+
+        logger.info(f"已轉換為版本槽位結構，目前版本: {version}")
+
+    def collect_garbage(self, keep=3, in_use=None):
+        """刪除多餘的舊版本槽位，current 與 previous 一律保留
+
+        in_use() 在清理暫存項目時呼叫，回傳正在下載、預先下載或等待套用的版本，
+        這些版本的暫存目錄、元件與續傳狀態不會被刪除。
+        """
+        previous = self.previous_version()
+        protected = {self.current_version(), previous}
+        removable = [v for v in self.list_releases() if v not in protected]
+        removed = []
+
+        # keep 為保留的舊版本數，previous 也算在內
+        while len(removable) > max(keep - (1 if previous else 0), 0):
+            version = removable.pop(0)
+            logger.info(f"刪除舊版本槽位: {version}")
+            self._remove_slot(self.release_path(version))
+            removed.append(version)
+
+        # 清除中斷更新留下的暫存目錄與檔案，仍在使用中的版本除外
+        if self.releases_dir.exists():
+            active = {self.current_version(), *(in_use() if in_use else ())} - {None}
+            for staging in self.releases_dir.glob(".staging-*"):
+                if self._staging_version_in(staging, active):
+                    continue
+                self._remove_slot(staging)
+
+        return removed
+
+    def _staging_version_in(self, staging, versions):
+        """暫存項目是否屬於 versions 中的版本（目錄、封存檔、更新包、元件及其續傳狀態）"""
+        # 續傳狀態檔與其寫入中的暫存檔（<項目>.chunks、<項目>.chunks.*.tmp）屬於同一項目
+        name = staging.name.split(".chunks", 1)[0]
+        for version in versions:
+            prefix = f".staging-{version}"
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if rest in ("", self.ARCHIVE_SUFFIX, ".tar.gz") or rest.startswith("-"):
+                return True
+        return False
+
+    def collect_garbage_async(self, keep=3, in_use=None):
+        """在背景執行槽位清理"""
+        gc_thread = threading.Thread(target=self.collect_garbage, args=(keep, in_use))
+        gc_thread.daemon = True
+        gc_thread.start()
+        return gc_thread
@@ -0,0 +1,104 @@
+"""
+服務就緒通知與監聽socket繼承 - systemd sd_notify / socket activation 協定與本機替代
+
+systemd 以 Type=notify 啟動時會設定 NOTIFY_SOCKET；
+不在 systemd 下執行時（開發、測試），更新執行器以 HELLO_OTA_READY_SOCKET
+提供相同協定的 unix datagram socket。
+
+監聽socket可由 systemd socket activation（LISTEN_FDS）傳入，
+或由更新執行器以 HELLO_OTA_LISTEN_FD 指定繼承的檔案描述符。
+"""
+import os
+import time
+import socket
+import tempfile
+from pathlib import Path
+
+READY_SOCKET_ENV = "HELLO_OTA_READY_SOCKET"
+LISTEN_FD_ENV = "HELLO_OTA_LISTEN_FD"
+
+# systemd 傳入的第一個檔案描述符
+SD_LISTEN_FDS_START = 3
+
+def inherited_listen_socket():
+    """取得繼承的監聽socket，沒有時回傳None"""
+    fd = None
+
+    if os.environ.get("LISTEN_PID") == str(os.getpid()) and int(os.environ.get("LISTEN_FDS", "0")) >= 1:
+        fd = SD_LISTEN_FDS_START
+    elif os.environ.get(LISTEN_FD_ENV):
+        fd = int(os.environ[LISTEN_FD_ENV])
+
+    # 避免再傳給之後啟動的子行程
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES", LISTEN_FD_ENV):
+        os.environ.pop(name, None)
+
+    if fd is None:
+        return None
+
+    sock = socket.socket(fileno=fd)
+    os.set_inheritable(sock.fileno(), False)
+    return sock
+
+def notify(state):
+    """送出狀態通知（例如 READY=1），沒有通知socket時回傳False"""
+    address = os.environ.get("NOTIFY_SOCKET") or os.environ.get(READY_SOCKET_ENV)
+    if not address:
+        return False
+
+    # 以 @ 開頭為Linux抽象命名空間
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode('utf-8'))
+        return True
+    except OSError:
+        return False
+
+class ReadySocket:
+    """本機替代的通知socket，等待新行程送出 READY=1"""
+
+    def __init__(self):
+        self._dir = tempfile.mkdtemp(prefix="hello-ota-notify-")
+        self.path = str(Path(self._dir) / "notify.sock")
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+
+    def environ(self):
+        """傳給新行程的環境變數"""
+        env = dict(os.environ)
+        env.pop("NOTIFY_SOCKET", None)
+        env[READY_SOCKET_ENV] = self.path
+        return env
+
+    def wait_ready(self, timeout):
+        """等待 READY=1，逾時回傳False"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._sock.settimeout(remaining)
+            try:
+                message = self._sock.recv(4096).decode('utf-8', 'replace')
+            except socket.timeout:
+                return False
+            if "READY=1" in message.split("\n"):
+                return True
+
+    def close(self):
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+            os.rmdir(self._dir)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,125 @@
+"""
+啟動效能分析 - 記錄各模組匯入時間與啟動階段耗時
+
+只依賴標準函式庫，需在其他模組匯入前載入。
+"""
+import sys
+import time
+import json
+from contextlib import contextmanager
+
+class _TimedLoader:
+    """包裝原本的loader，記錄 exec_module 的耗時"""
+
+    def __init__(self, loader, timer, name):
+        self._loader = loader
+        self._timer = timer
+        self._name = name
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer._enter(self._name)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer._exit(self._name)
+
+class ImportTimer:
+    """sys.meta_path 尋找器，統計每個模組的匯入時間（類似 -X importtime）"""
+
+    def __init__(self):
+        self.timings = {}
+        self._stack = []
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self, fullname)
+                return spec
+        return None
+
+    def _enter(self, name):
+        # [名稱, 開始時間, 子模組耗時]
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def _exit(self, name):
+        _, started, children = self._stack.pop()
+        cumulative = time.perf_counter() - started
+        self.timings[name] = {
+            "self_ms": round((cumulative - children) * 1000, 3),
+            "cumulative_ms": round(cumulative * 1000, 3)
+        }
+        if self._stack:
+            self._stack[-1][2] += cumulative
+
+    def top(self, count=15):
+        """依自身耗時排序的前N個模組"""
+        ranked = sorted(self.timings.items(), key=lambda item: item[1]['self_ms'], reverse=True)
+        return dict(ranked[:count])
+
+def process_age():
+    """行程自建立以來的秒數（含直譯器啟動），非Linux時回傳None"""
+    try:
+        import os
+        with open('/proc/self/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        start_ticks = int(fields[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class StartupProfiler:
+    """記錄啟動各階段耗時，時間點以建立實例時為零點"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.interpreter_startup = process_age()
+        self.phases = {}
+        self.marks = {}
+        self.import_timer = ImportTimer()
+
+    @contextmanager
+    def phase(self, name):
+        phase_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - phase_start) * 1000, 3)
+
+    def mark(self, name):
+        """記錄自零點起算的時間點（毫秒）"""
+        self.marks[name] = round((time.perf_counter() - self.started) * 1000, 3)
+
+    def report(self):
+        return {
+            "interpreter_startup_ms": (
+                round(self.interpreter_startup * 1000, 1) if self.interpreter_startup is not None else None
+            ),
+            "phases_ms": self.phases,
+            "marks_ms": self.marks,
+            "slowest_imports": self.import_timer.top()
+        }
+
+    def dump(self, stream=None):
+        stream = stream or sys.stdout
+        json.dump(self.report(), stream, indent=2, ensure_ascii=False)
+        stream.write("\n")
@@ -0,0 +1,197 @@
+"""
+更新歷史記錄 - 僅追加(append-only)的JSONL日誌
+"""
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class UpdateHistory:
+    """更新歷史儲存
+
+    每筆記錄為一行JSON追加到日誌檔，不再每次重寫整個陣列。
+    最近的記錄保留在記憶體中，/ota/status 不需要讀檔。
+    """
+
+    def __init__(self, journal_file, retention=50, tail_size=20, legacy_file=None):
+        self.journal_file = Path(journal_file)
+        self.retention = retention
+        self._tail = deque(maxlen=tail_size)
+        self._line_count = 0
+        self._lock = threading.Lock()
+        self._compacting = False
+
+        self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+
+        if legacy_file is not None:
+            self._migrate_legacy(Path(legacy_file))
+
+        self._load_tail()
+
+    def _load_tail(self):
+        """啟動時載入最近的記錄到記憶體"""
+        if not self.journal_file.exists():
+            return
+
+        self._truncate_partial_line()
+
+        for record in self._iter_journal():
+            self._tail.append(record)
+            self._line_count += 1
+
+    def _truncate_partial_line(self):
+        """截掉斷電時寫到一半的最後一行，避免下一筆記錄接在後面"""
+        with open(self.journal_file, 'rb+') as f:
+            data = f.read()
+            if not data or data.endswith(b"\n"):
+                return
+            f.truncate(data.rfind(b"\n") + 1)
+            logger.warning("已截除歷史記錄中不完整的最後一行")
+
+    def _iter_journal(self):
+        """逐行讀取日誌檔，略過斷電造成的不完整行"""
+        if not self.journal_file.exists():
+            return
+
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning(f"略過損毀的歷史記錄: {line[:80]}")
+
+    def _migrate_legacy(self, legacy_file):
+        """將舊版JSON陣列格式的歷史記錄轉為日誌檔"""
+        if not legacy_file.exists() or self.journal_file.exists():
+            return
+
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"無法讀取舊版歷史記錄: {e}")
+            return
+
+        self._write_journal(records[-self.retention:])
+        legacy_file.rename(legacy_file.with_suffix('.json.migrated'))
+        logger.info(f"已轉換舊版歷史記錄: {len(records)} 筆")
+
+    def append(self, record):
+        """追加一筆記錄"""
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+
+        with self._lock:
+            with open(self.journal_file, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._tail.append(record)
+            self._line_count += 1
+            needs_compaction = self._line_count > self.retention * 2
+
+        if needs_compaction:
+            self._start_compaction()
+
+    def recent(self, count=5):
+        """取得最近N筆記錄（由記憶體提供）"""
+        with self._lock:
+            tail = list(self._tail)
+        return tail[-count:] if count else tail
+
+    def query(self, version=None, status=None, since=None, until=None, offset=0, limit=20):
+        """依條件查詢歷史記錄，新的在前
+
+        since/until 為ISO格式時間字串（可含時區，未含時區視為本機時間），offset/limit 用於分頁；
+        無法解析時拋出例外。
+        """
+        since_dt = self._parse_time(since)
+        until_dt = self._parse_time(until)
+        for value, parsed in ((since, since_dt), (until, until_dt)):
+            if value and parsed is None:
+                raise Exception(f"無法解析的時間: {value}")
+
+        matched = []
+        for record in self._iter_journal():
+            if version is not None and record.get('version') != version:
+                continue
+            if status is not None and record.get('status') != status:
+                continue
+            if since_dt or until_dt:
+                record_dt = self._parse_time(record.get('timestamp'))
+                if record_dt is None:
+                    continue
+                if since_dt and record_dt < since_dt:
+                    continue
+                if until_dt and record_dt > until_dt:
+                    continue
+            matched.append(record)
+
+        matched.reverse()
+
+        return {
+            "total": len(matched),
+            "offset": offset,
+            "limit": limit,
+            "records": matched[offset:offset + limit]
+        }
+
+    def all(self):
+        """取得全部記錄（舊到新）"""
+        return list(self._iter_journal())
+
+    @staticmethod
+    def _parse_time(value):
+        """解析ISO格式時間並轉為含時區的時間；記錄的時間戳未含時區，視為本機時間"""
+        if not value:
+            return None
+        try:
+            # Python 3.11 之前的 fromisoformat 不接受 Z 結尾
+            if value.endswith('Z'):
+                value = value[:-1] + '+00:00'
+            parsed = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+        return parsed if parsed.tzinfo is not None else parsed.astimezone()
+
+    def _start_compaction(self):
+        """在背景執行壓縮，不阻塞呼叫端"""
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+
+        compact_thread = threading.Thread(target=self.compact)
+        compact_thread.daemon = True
+        compact_thread.start()
+
+    def compact(self):
+        """只保留最近 retention 筆記錄，以原子性替換重寫日誌檔"""
+        try:
+            with self._lock:
+                records = list(self._iter_journal())[-self.retention:]
+                self._write_journal(records)
+                self._line_count = len(records)
+            logger.debug(f"歷史記錄壓縮完成，保留 {len(records)} 筆")
+        finally:
+            self._compacting = False
+
+    def _write_journal(self, records):
+        """將記錄寫入暫存檔後替換日誌檔"""
+        tmp_file = self.journal_file.with_suffix('.jsonl.tmp')
+
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_file, self.journal_file)
@@ -0,0 +1,253 @@
+"""
+更新排程 - 發現更新時先在背景預先下載，只在維護時段或機器閒置時套用
+
+預先下載的更新包保存在資料目錄，服務重啟後仍可直接使用，不需重新下載。
+"""
+import json
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+from flash_io import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+class MaintenanceWindow:
+    """每日維護時段，例如 "02:00-05:00"；結束時間較早表示跨越午夜"""
+
+    def __init__(self, spec):
+        self.spec = spec or ""
+        self.start = self.end = None
+        self.closed = False
+        if self.spec:
+            try:
+                start, end = self.spec.split('-')
+                self.start = self._minutes(start)
+                self.end = self._minutes(end)
+            except (ValueError, AttributeError):
+                raise Exception(f"維護時段格式錯誤（應為 HH:MM-HH:MM）: {self.spec}")
+
+    @classmethod
+    def never(cls, spec):
+        """設定無效時使用：視為已設定維護時段，但時段永遠不會開始（不依時段自動套用）"""
+        window = cls("")
+        window.spec = str(spec)
+        window.closed = True
+        return window
+
+    @staticmethod
+    def _minutes(text):
+        hour, minute = text.strip().split(':')
+        hour, minute = int(hour), int(minute)
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError(text)
+        return hour * 60 + minute
+
+    def enabled(self):
+        return self.start is not None or self.closed
+
+    def contains(self, now=None):
+        if self.start is None:
+            return False
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+class ActivityTracker:
+    """記錄機器最後一次活動時間
+
+    活動來源為服務收到的業務請求，以及其他程式（例如交易處理）定期更新修改時間的活動檔。
+    """
+
+    def __init__(self, activity_file=None):
+        self.activity_file = Path(activity_file) if activity_file else None
+        self._last_activity = time.time()
+
+    def touch(self):
+        self._last_activity = time.time()
+
+    def last_activity(self):
+        last = self._last_activity
+        if self.activity_file is not None:
+            try:
+                last = max(last, self.activity_file.stat().st_mtime)
+            except OSError:
+                pass
+        return last
+
+    def idle_seconds(self):
+        return max(time.time() - self.last_activity(), 0)
+
+class PrefetchCache:
+    """預先下載的更新包快取
+
+    <cache_dir>/<檔名>      已驗證的更新包
+    <cache_dir>/pending.json 等待套用的更新資訊
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.pending_file = self.cache_dir / "pending.json"
+
+    def package_path(self, update_info):
+        name = Path(update_info['download_url'].split('?', 1)[0]).name
+        return self.cache_dir / (name or f"{update_info['version']}.pkg")
+
+    def get(self, update_info):
+        """已快取且校驗和相符的更新包路徑，沒有時回傳None"""
+        if not update_info.get('download_url') or not update_info.get('checksum'):
+            return None
+        path = self.package_path(update_info)
+        if not path.exists():
+            return None
+
+        sha256_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                sha256_hash.update(chunk)
+        if sha256_hash.hexdigest() != update_info['checksum']:
+            logger.warning(f"快取的更新包校驗失敗，將重新下載: {path}")
+            path.unlink()
+            return None
+        return path
+
+    def set_pending(self, update_info):
+        """記錄等待套用的更新（原子性寫入）"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(self.pending_file, update_info, ensure_ascii=False)
+
+    def pending(self):
+        try:
+            with open(self.pending_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def discard(self, update_info=None):
+        """套用完成或不再需要時清除快取"""
+        pending = self.pending()
+        for info in (update_info, pending):
+            if info and info.get('download_url'):
+                path = self.package_path(info)
+                if path.exists():
+                    path.unlink()
+        if self.pending_file.exists():
+            self.pending_file.unlink()
+
+class UpdateScheduler:
+    """分開預先下載與套用兩個階段
+
+    submit() 發現更新時在背景預先下載；排程線程定期檢查，
+    在維護時段內或閒置超過 idle_minutes 分鐘時才套用。
+    兩者都未設定時預先下載完成後立即套用。
+    """
+
+    def __init__(self, ota_manager, window=None, idle_minutes=0, activity=None, tick_interval=30):
+        self.ota_manager = ota_manager
+        self.window = window or MaintenanceWindow("")
+        self.idle_minutes = idle_minutes
+        self.activity = activity or ActivityTracker()
+        self.tick_interval = tick_interval
+        self.running = False
+        self._lock = threading.Lock()
+        self._prefetching = None
+        self._applying = False
+
+    def submit(self, update_info):
+        """發現更新：背景預先下載，完成後等待套用時機"""
+        with self._lock:
+            pending = self.ota_manager.prefetch_cache.pending()
+            if self._prefetching == update_info['version']:
+                return
+            if pending and pending.get('version') == update_info['version']:
+                return
+            self._prefetching = update_info['version']
+
+        prefetch_thread = threading.Thread(target=self._prefetch, args=(update_info,))
+        prefetch_thread.daemon = True
+        prefetch_thread.start()
+
+    def _prefetch(self, update_info):
+        try:
+            self.ota_manager.prefetch_in_background(update_info)
+            logger.info(f"版本 {update_info['version']} 已預先下載，等待套用時機")
+        except Exception as e:
+            logger.error(f"預先下載失敗: {e}")
+        finally:
+            with self._lock:
+                self._prefetching = None
+        self.tick()
+
+    def apply_due(self):
+        """目前是否可以套用更新"""
+        if not self.window.enabled() and not self.idle_minutes:
+            return True
+        if self.window.contains():
+            return True
+        return bool(self.idle_minutes) and self.activity.idle_seconds() >= self.idle_minutes * 60
+
+    def tick(self):
+        """有已預先下載的更新且到了套用時機時套用，回傳是否已套用"""
+        from version import __version__
+
+        pending = self.ota_manager.prefetch_cache.pending()
+        if not pending:
+            return False
+
+        if pending.get('version') == __version__:
+            self.ota_manager.prefetch_cache.discard(pending)
+            return False
+
+        if not self.apply_due():
+            return False
+
+        with self._lock:
+            if self._applying:
+                return False
+            self._applying = True
+
+        try:
+            logger.info(f"到達套用時機，套用預先下載的版本 {pending['version']}")
+            self.ota_manager.perform_update(pending)
+            return True
+        except Exception as e:
+            # 失敗已記錄在更新歷史，清除後由下次檢查重新下載，避免反覆套用
+            logger.error(f"套用預先下載的更新失敗: {e}")
+            self.ota_manager.prefetch_cache.discard(pending)
+            return False
+        finally:
+            with self._lock:
+                self._applying = False
+
+    def status(self):
+        pending = self.ota_manager.prefetch_cache.pending()
+        return {
+            "pending_version": pending.get('version') if pending else None,
+            "prefetching": self._prefetching,
+            "maintenance_window": self.window.spec or None,
+            "apply_after_idle_minutes": self.idle_minutes or None,
+            "idle_seconds": int(self.activity.idle_seconds()),
+            "apply_due": self.apply_due()
+        }
+
+    def start(self):
+        """啟動排程線程"""
+        def schedule_loop():
+            while self.running:
+                try:
+                    self.tick()
+                except Exception as e:
+                    logger.error(f"更新排程檢查失敗: {e}")
+                time.sleep(self.tick_interval)
+
+        self.running = True
+        schedule_thread = threading.Thread(target=schedule_loop)
+        schedule_thread.daemon = True
+        schedule_thread.start()
+
+    def stop(self):
+        self.running = False
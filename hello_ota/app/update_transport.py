@@ -0,0 +1,233 @@
+"""
+更新傳輸 - 裝置與更新服務器之間的訊息通道
+
+HTTPTransport 以 /api/check_update（支援長輪詢）查詢新版本；
+MQTTTransport 使用機器既有的MQTT連線，以QoS 1接收新版本通知與更新觸發，
+並回報更新進度與結果，不需要另外的HTTP輪詢。
+"""
+import json
+import socket
+import logging
+import threading
+from datetime import datetime
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 回報為更新結果的歷史記錄狀態
+OUTCOME_STATUSES = ("completed", "failed", "rolled_back")
+
+def _version_tuple(version):
+    return tuple(int(part) for part in str(version).split('.') if part.isdigit())
+
+class HTTPTransport:
+    """以HTTP向更新服務器查詢；更新服務器沒有進度與結果的回報端點"""
+
+    name = "http"
+    reports_outcomes = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def query(self, wait=0, seen=None):
+        """向更新服務器查詢最新版本，失敗時拋出例外
+
+        wait 大於0時要求長輪詢：服務器等到最新版本不同於 seen 或 wait 秒後才回應。
+        """
+        import requests
+        from version import __version__
+
+        update_server = config.get('ota.update_server')
+        params = {"current_version": __version__, "formats": "tar,zipapp"}
+        if wait:
+            params["wait"] = wait
+            if seen:
+                params["seen"] = seen
+
+        response = requests.get(
+            f"{update_server}/api/check_update",
+            params=params,
+            timeout=30 + wait
+        )
+        if response.status_code != 200:
+            raise Exception(f"檢查更新失敗: {response.status_code}")
+        return response.json()
+
+    def report_progress(self, update_info, stage, **details):
+        pass
+
+    def report_outcome(self, record):
+        return True
+
+    def status(self):
+        return {"name": self.name, "update_server": config.get('ota.update_server')}
+
+class MQTTTransport:
+    """經由MQTT收發更新訊息（QoS 1，至少送達一次）
+
+    client 為 paho-mqtt 相容的用戶端（subscribe、message_callback_add、publish），
+    可直接使用機器與雲端之間既有的MQTT工作階段。
+
+    <prefix>/<device_id>/update    雲端 → 裝置：新版本通知；"apply" 為 true 時立即套用
+    <prefix>/broadcast/update      雲端 → 所有裝置：新版本通知
+    <prefix>/<device_id>/progress  裝置 → 雲端：更新進度
+    <prefix>/<device_id>/outcome   裝置 → 雲端：更新結果（completed、failed、rolled_back）
+    """
+
+    name = "mqtt"
+    reports_outcomes = True
+
+    def __init__(self, client, device_id, prefix="hello-ota", qos=1, on_trigger=None, publish_timeout=10,
+                 owns_client=False):
+        self.client = client
+        self.owns_client = owns_client
+        self.device_id = device_id
+        self.prefix = prefix.rstrip('/')
+        self.qos = qos
+        self.on_trigger = on_trigger
+        self.publish_timeout = publish_timeout
+        self.announced = None
+        self.received = 0
+        self._condition = threading.Condition()
+
+    def topic(self, name, device_id=None):
+        return f"{self.prefix}/{device_id or self.device_id}/{name}"
+
+    def start(self):
+        """訂閱新版本通知（自行建立的用戶端在每次連線後呼叫）"""
+        for topic in (self.topic("update"), self.topic("update", "broadcast")):
+            self.client.message_callback_add(topic, self._on_update)
+            self.client.subscribe(topic, qos=self.qos)
+        logger.info(f"以MQTT接收更新通知: {self.topic('update')}")
+
+    def stop(self):
+        # 共用的既有工作階段由原本的擁有者關閉
+        if self.owns_client:
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def _on_update(self, client, userdata, message):
+        try:
+            payload = json.loads(message.payload)
+            if not payload.get('version') or not payload.get('download_url'):
+                raise ValueError("缺少 version 或 download_url")
+        except ValueError as e:
+            logger.warning(f"略過無效的更新通知 ({message.topic}): {e}")
+            return
+
+        with self._condition:
+            self.announced = payload
+            self.received += 1
+            self._condition.notify_all()
+        logger.info(f"收到新版本通知: {payload['version']}")
+
+        # 與 /trigger_update 相同：立即在背景下載並套用
+        if payload.get('apply') and self.on_trigger is not None:
+            self.on_trigger(self._response(payload))
+
+    def _response(self, announced):
+        """組成與 /api/check_update 相同格式的回應"""
+        from version import __version__
+
+        if announced is None:
+            return {"has_update": False, "current_version": __version__,
+                    "latest_version": __version__, "long_poll": True}
+
+        try:
+            newer = _version_tuple(announced['version']) > _version_tuple(__version__)
+        except ValueError:
+            newer = announced['version'] != __version__
+        update_info = {key: value for key, value in announced.items() if key != 'apply'}
+        update_info.update({
+            "has_update": newer,
+            "current_version": __version__,
+            "latest_version": announced['version'] if newer else __version__,
+            "long_poll": True
+        })
+        return update_info
+
+    def query(self, wait=0, seen=None):
+        """回傳最近一次收到的通知；wait 大於0時等到出現不同於 seen 的版本或逾時"""
+        with self._condition:
+            if wait:
+                self._condition.wait_for(
+                    lambda: self.announced is not None and self.announced['version'] != seen, wait
+                )
+            return self._response(self.announced)
+
+    def _publish(self, name, payload):
+        return self.client.publish(
+            self.topic(name), json.dumps(payload, ensure_ascii=False), qos=self.qos
+        )
+
+    def report_progress(self, update_info, stage, **details):
+        self._publish("progress", {
+            "version": update_info.get('version'),
+            "stage": stage,
+            "timestamp": datetime.now().isoformat(),
+            **details
+        })
+
+    def report_outcome(self, record):
+        """回報更新結果，確認送達（收到PUBACK）時回傳True"""
+        details = record.get('details') or {}
+        info = self._publish("outcome", {
+            # 雲端以 id 去除重複送達的訊息
+            "id": f"{record.get('version')}@{record.get('timestamp')}",
+            "version": record.get('version'),
+            "status": record.get('status'),
+            "timestamp": record.get('timestamp'),
+            "error": details.get('error'),
+            "rolled_back_to": record.get('rolled_back_to'),
+            "downtime_ms": record.get('downtime_ms')
+        })
+        info.wait_for_publish(self.publish_timeout)
+        return info.is_published()
+
+    def status(self):
+        return {
+            "name": self.name,
+            "topic": self.topic("update"),
+            "announced_version": self.announced.get('version') if self.announced else None,
+            "received": self.received
+        }
+
+def create_transport(on_trigger=None, client=None):
+    """依設定建立更新傳輸；MQTT需要 paho-mqtt 套件（1.x 或 2.x）
+
+    client 為機器既有的已連線MQTT用戶端時直接共用該工作階段，不另外建立連線；
+    重新連線後訂閱若未保留（非持久工作階段），擁有者須在 on_connect 中再呼叫 transport.start()。
+    """
+    if config.get('ota.transport', 'http') != 'mqtt':
+        return HTTPTransport()
+
+    device_id = config.get('ota.device_id') or socket.gethostname()
+    prefix = config.get('ota.mqtt_topic_prefix', 'hello-ota')
+
+    if client is not None:
+        transport = MQTTTransport(client, device_id, prefix=prefix, on_trigger=on_trigger)
+        transport.start()
+        return transport
+
+    try:
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        raise Exception("ota.transport 為 mqtt 時需要安裝 paho-mqtt 套件")
+
+    # 持久工作階段：離線期間的QoS 1訊息在重新連線後送達
+    options = {"client_id": f"hello-ota-{device_id}", "clean_session": False}
+    # paho-mqtt 2.x 須指定回呼介面版本；以下的回呼使用 1.x 的參數形式
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        options["callback_api_version"] = mqtt.CallbackAPIVersion.VERSION1
+    client = mqtt.Client(**options)
+    transport = MQTTTransport(client, device_id, prefix=prefix, on_trigger=on_trigger, owns_client=True)
+
+    # 連線建立（或重新連線）後才能訂閱
+    client.on_connect = lambda client, userdata, flags, rc: transport.start()
+    client.connect_async(config.get('ota.mqtt_host', 'localhost'), config.get('ota.mqtt_port', 1883))
+    client.loop_start()
+    return transport
@@ -0,0 +1,75 @@
+"""
+更新通知 - 以長輪詢等待更新服務器發佈新版本
+
+服務器支援長輪詢時保持一個請求等待，發佈新版本時立即回應，緊急修正可在數秒內送達；
+服務器不支援（舊版或單線程服務器）時改回每 check_interval 秒輪詢。
+"""
+import time
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class UpdateWatcher:
+    """決定下一次檢查更新的方式與時機
+
+    seen_version 為已知的最新版本，長輪詢時服務器等到出現不同的版本或逾時才回應。
+    """
+
+    def __init__(self, ota_manager, check_interval=300, long_poll=True, wait_seconds=60,
+                 retry_seconds=5, min_interval=1):
+        self.ota_manager = ota_manager
+        self.check_interval = check_interval
+        self.long_poll = long_poll
+        self.wait_seconds = wait_seconds
+        self.retry_seconds = retry_seconds
+        self.min_interval = min_interval
+        self.mode = "long_poll" if long_poll else "poll"
+        self.seen_version = None
+        self.failures = 0
+        self.last_check = None
+
+    def check(self):
+        """檢查一次，回傳 (更新資訊或None, 下次檢查前等待的秒數)"""
+        wait = self.wait_seconds if self.mode == "long_poll" else 0
+        start_time = time.monotonic()
+        self.last_check = datetime.now().isoformat()
+
+        try:
+            response = self.ota_manager.query_update_server(wait=wait, seen=self.seen_version)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"檢查更新時發生錯誤: {e}")
+            if not self.long_poll:
+                return None, self.check_interval
+            # 連線失敗以指數退避重試，最長不超過輪詢間隔
+            return None, min(self.retry_seconds * 2 ** (self.failures - 1), self.check_interval)
+        self.failures = 0
+
+        # 每次回應都帶有服務器是否支援長輪詢，服務器升級或降級後自動切換
+        if self.long_poll:
+            mode = "long_poll" if response.get('long_poll') else "poll"
+            if mode != self.mode:
+                logger.info(f"更新通知方式改為 {mode}")
+                self.mode = mode
+
+        update_info = response if response.get('has_update', False) else None
+        if update_info:
+            if update_info.get('latest_version') != self.seen_version:
+                logger.info(f"發現新版本: {update_info['latest_version']}")
+            self.seen_version = update_info.get('latest_version')
+        else:
+            logger.debug("目前已是最新版本")
+
+        if self.mode == "poll":
+            return update_info, self.check_interval
+        # 服務器沒有等待就回應時也不立即重連，避免異常的服務器造成忙碌迴圈
+        return update_info, max(self.min_interval - (time.monotonic() - start_time), 0)
+
+    def status(self):
+        return {
+            "mode": self.mode,
+            "seen_version": self.seen_version,
+            "consecutive_failures": self.failures,
+            "last_check": self.last_check
+        }
@@ -0,0 +1,268 @@
+"""
+OTA更新執行器 - 在服務行程之外完成版本切換與重啟
+
+由 OTAManager 產生的腳本呼叫，切換 current 連結後重啟服務，
+以就緒通知取代固定等待時間，並記錄每次更新的停機時間。
+切換後須在期限內通過健康檢查閘門（/health 正常且 /version 為新版本），
+否則自動回滾到上一個槽位。
+"""
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+import urllib.request
+from pathlib import Path
+from datetime import datetime
+
+from release_slots import ReleaseManager
+from update_history import UpdateHistory
+from service_notify import ReadySocket, LISTEN_FD_ENV
+from memory_budget import StageMemoryProfiler
+from update_scheduler import PrefetchCache
+
+def log(message):
+    print(f"[OTA] {message}", flush=True)
+
+def pid_alive(pid):
+    """行程是否仍存在（已結束但未回收的殭屍行程視為不存在）"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+        return state != 'Z'
+    except (OSError, IndexError):
+        return True
+
+def wait_for_exit(pid, timeout):
+    """等待行程結束，逾時回傳False"""
+    deadline = time.monotonic() + timeout
+    while pid_alive(pid):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def _probe(port, expected_version):
+    """單次探測：/health 回應200，且指定版本時 /version 必須相符"""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=2) as response:
+            if response.status != 200:
+                return False
+        if expected_version is None:
+            return True
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/version", timeout=2) as response:
+            return json.load(response).get('version') == expected_version
+    except (OSError, ValueError):
+        return False
+
+def wait_healthy(port, timeout, expected_version=None):
+    """健康檢查閘門，回傳通過所花秒數，逾時回傳None"""
+    started = time.monotonic()
+    deadline = started + timeout
+    while True:
+        if _probe(port, expected_version):
+            return time.monotonic() - started
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.05)
+
+class SystemdController:
+    """以 systemctl 重啟服務；Type=notify 下 restart 會等到 READY=1 才返回
+
+    command 指定時以該命令取代 systemctl（例如其他服務管理器或測試用的服務管理器），
+    命令須同樣在新行程就緒後才返回。
+    """
+
+    def __init__(self, unit="hello-ota", command=None):
+        self.unit = unit
+        self.command = command or ["sudo", "systemctl", "restart", unit]
+
+    def restart(self, old_pid, timeout):
+        """重啟服務，回傳停機秒數（舊行程停止到新行程就緒）"""
+        started = time.monotonic()
+        subprocess.run(self.command, check=True, timeout=timeout)
+        if old_pid and not wait_for_exit(old_pid, timeout):
+            raise Exception(f"舊行程 {old_pid} 未結束")
+        return time.monotonic() - started
+
+    def recover(self, timeout):
+        """回滾切換後重啟服務"""
+        self.restart(None, timeout)
+
+class ProcessController:
+    """不使用 systemd 時直接管理行程，以本機通知socket等待就緒
+
+    有 listen_fd 時新舊行程共用同一個監聽socket：先啟動新行程並等待就緒，
+    再停止舊行程，排隊中的連線由新版本接手，埠不會拒絕連線。
+    """
+
+    def __init__(self, command, listen_fd=None):
+        self.command = command
+        self.listen_fd = listen_fd
+        self.process = None
+        self._old_stopped = False
+
+    def restart(self, old_pid, timeout):
+        """停止舊行程並啟動新行程，回傳停機秒數（無行程接受連線的時間）"""
+        if old_pid is None and self.process is not None:
+            old_pid = self.process.pid
+
+        if self.listen_fd is not None:
+            self._start(timeout)
+            self._stop(old_pid, timeout)
+            return 0.0
+
+        started = time.monotonic()
+        self._stop(old_pid, timeout)
+        self._start(timeout)
+        return time.monotonic() - started
+
+    def recover(self, timeout):
+        """回滾切換後恢復服務；新版本未曾接手時舊行程仍在服務，不需重啟"""
+        if self.process is None and not self._old_stopped:
+            return
+        self.restart(None, timeout)
+
+    def _start(self, timeout):
+        self.process = None
+        with ReadySocket() as ready_socket:
+            env = ready_socket.environ()
+            pass_fds = []
+            if self.listen_fd is not None:
+                env[LISTEN_FD_ENV] = str(self.listen_fd)
+                pass_fds.append(self.listen_fd)
+
+            process = subprocess.Popen(
+                self.command, env=env, pass_fds=pass_fds, start_new_session=True
+            )
+
+            if not ready_socket.wait_ready(timeout):
+                process.kill()
+                process.wait()
+                raise Exception("新版本未在時限內送出就緒通知")
+
+            self.process = process
+
+    def _stop(self, pid, timeout):
+        if pid and pid_alive(pid):
+            os.kill(pid, signal.SIGTERM)
+            if not wait_for_exit(pid, timeout):
+                raise Exception(f"舊行程 {pid} 未結束")
+        self._old_stopped = True
+
+def make_controller(params):
+    if params.get('service_manager', 'systemd') == 'process':
+        command = params.get('service_command') or [
+            sys.executable, str(Path(params['app_dir']) / "current")
+        ]
+        return ProcessController(command, params.get('listen_fd'))
+    return SystemdController(params.get('service_unit', 'hello-ota'), params.get('restart_command'))
+
+def run_update(params):
+    """執行版本切換與重啟，回傳程式結束碼"""
+    log("OTA更新執行腳本啟動")
+
+    releases = ReleaseManager(Path(params['app_dir']))
+    version = params['version']
+    update_info = params['update_info']
+    data_dir = Path(params['data_dir'])
+    history = UpdateHistory(data_dir / "update_history.jsonl")
+    controller = make_controller(params)
+    timeout = params.get('timeout', 30)
+    health_deadline = params.get('health_deadline', 60)
+    activated_at = None
+    memory = StageMemoryProfiler()
+
+    try:
+        # 記錄更新資訊
+        data_dir.mkdir(parents=True, exist_ok=True)
+        with open(data_dir / "last_update.json", 'w') as f:
+            json.dump(update_info, f, indent=2)
+
+        # 舊版平鋪安裝先轉換為槽位結構
+        releases.migrate_legacy(params['old_version'])
+
+        # 原子性切換 current 符號連結（舊行程仍持續服務）
+        with memory.stage("swap"):
+            releases.activate(version)
+            activated_at = time.monotonic()
+            log(f"已切換到版本 {version}")
+
+            # 重啟服務並等待就緒通知
+            downtime = controller.restart(params.get('old_pid'), timeout)
+        log(f"服務已就緒，停機時間 {downtime * 1000:.0f} ms")
+
+        # 健康檢查閘門：期限自切換起算
+        remaining = health_deadline - (time.monotonic() - activated_at)
+        if wait_healthy(params['port'], max(remaining, 0), version) is None:
+            raise Exception(f"新版本未在 {health_deadline} 秒內通過健康檢查")
+        time_to_healthy = time.monotonic() - activated_at
+        log(f"健康檢查通過，耗時 {time_to_healthy * 1000:.0f} ms")
+
+        history.append({
+            "timestamp": datetime.now().isoformat(),
+            "version": version,
+            "status": "completed",
+            "downtime_ms": round(downtime * 1000, 1),
+            "time_to_healthy_ms": round(time_to_healthy * 1000, 1),
+            "io": params.get('io_stats'),
+            "memory": {**(params.get('memory_stats') or {}), **memory.report()},
+            "details": update_info
+        })
+        log("OTA更新完成成功")
+
+        # 健康檢查通過後清理舊版本槽位；服務行程可能已開始預先下載下一版本
+        prefetch = PrefetchCache(data_dir / "prefetch")
+        releases.collect_garbage(
+            params.get('keep', 3), in_use=lambda: {(prefetch.pending() or {}).get('version')}
+        )
+        return 0
+
+    except Exception as e:
+        log(f"OTA更新失敗: {e}")
+
+        record = {
+            "timestamp": datetime.now().isoformat(),
+            "version": version,
+            "status": "failed",
+            "memory": {**(params.get('memory_stats') or {}), **memory.report()},
+            "details": {**update_info, "error": str(e)}
+        }
+
+        # 已切換時回滾到上一個槽位；尚未切換時舊版本仍在服務
+        if activated_at is not None:
+            record.update(_rollback(releases, controller, params, timeout, health_deadline))
+
+        history.append(record)
+        return 1
+
+def _rollback(releases, controller, params, timeout, health_deadline):
+    """切回上一個槽位並確認舊版本恢復服務，回傳要寫入歷史記錄的欄位"""
+    started = time.monotonic()
+    try:
+        log("執行回滾")
+        previous = releases.previous_version()
+        releases.rollback()
+        controller.recover(timeout)
+
+        if wait_healthy(params['port'], health_deadline, previous) is None:
+            raise Exception(f"回滾版本 {previous} 未通過健康檢查")
+
+        time_to_rollback = time.monotonic() - started
+        log(f"回滾完成，耗時 {time_to_rollback * 1000:.0f} ms")
+        return {
+            "status": "rolled_back",
+            "rolled_back_to": previous,
+            "time_to_rollback_ms": round(time_to_rollback * 1000, 1)
+        }
+    except Exception as rollback_error:
+        log(f"回滾失敗: {rollback_error}")
+        return {"rollback_error": str(rollback_error)}
@@ -139,11 +139,16 @@ EOF
 copy_application() {
     log_info "複製應用程式檔案..."
 
-    # 複製應用程式檔案
-    cp -r app/* /opt/hello-ota/
+    # 安裝到版本槽位 releases/<version>，current 符號連結指向目前版本
+    APP_VERSION=$(python3 -c "import sys; sys.path.insert(0, 'app'); from version import __version__; print(__version__)")
+    RELEASE_DIR=/opt/hello-ota/releases/$APP_VERSION
+
+    mkdir -p "$RELEASE_DIR"
+    cp -r app/* "$RELEASE_DIR/"
+    ln -sfn "releases/$APP_VERSION" /opt/hello-ota/current
 
     # 設定執行權限
-    chmod +x /opt/hello-ota/main.py
+    chmod +x "$RELEASE_DIR/main.py"
 
     # 設定所有權
     chown -R hello-ota:hello-ota /opt/hello-ota
@@ -156,11 +161,13 @@ install_systemd_service() {
 
     # 複製服務檔案
     cp systemd/hello-ota.service /etc/systemd/system/
+    cp systemd/hello-ota.socket /etc/systemd/system/
 
     # 重新載入systemd
     systemctl daemon-reload
 
     # 啟用服務
+    systemctl enable hello-ota.socket
     systemctl enable hello-ota.service
 
     log_success "systemd服務安裝完成"
@@ -177,16 +184,56 @@ create_default_config() {
     "port": 8080,
     "host": "0.0.0.0",
     "heartbeat_interval": 30,
-    "log_level": "INFO"
+    "log_level": "INFO",
+    "log_max_bytes": 1048576,
+    "log_backup_count": 5,
+    "log_rate_limit": 1.0,
+    "log_rate_limit_loggers": ["hello_ota.progress"]
   },
   "ota": {
     "enabled": true,
     "update_server": "http://localhost:9000",
     "check_interval": 300,
     "backup_count": 3,
-    "auto_update": false
+    "auto_update": false,
+    "history_retention": 50,
+    "service_manager": "systemd",
+    "restart_command": [],
+    "health_deadline": 60,
+    "io_buffer_size": 1048576,
+    "tmpfs_reserve": 67108864,
+    "trace_memory": true,
+    "background_worker": true,
+    "worker_nice": 10,
+    "max_cpu_percent": 60,
+    "max_load_per_cpu": 1.5,
+    "worker_timeout": 3600,
+    "maintenance_window": "",
+    "apply_after_idle_minutes": 0,
+    "activity_file": "",
+    "peer_cache": false,
+    "peers": [],
+    "peer_cache_keep": 2,
+    "peer_timeout": 5,
+    "download_retries": 3,
+    "download_connect_timeout": 10,
+    "download_read_timeout": 60,
+    "mirror_probe_bytes": 65536,
+    "mirror_probe_timeout": 2,
+    "mirror_probe_ttl": 3600,
+    "component_download_workers": 4,
+    "long_poll": true,
+    "long_poll_timeout": 60,
+    "transport": "http",
+    "device_id": "",
+    "mqtt_host": "localhost",
+    "mqtt_port": 1883,
+    "mqtt_topic_prefix": "hello-ota"
   },
   "system": {
+    "app_dir": "/opt/hello-ota",
+    "backup_dir": "/var/backups/hello-ota",
+    "temp_dir": "/tmp/hello-ota-update",
     "data_dir": "/var/lib/hello-ota",
     "log_dir": "/var/log/hello-ota",
     "pid_file": "/var/run/hello-ota.pid"
@@ -204,27 +251,16 @@ EOF
 setup_logrotate() {
     log_info "設定日誌輪替..."
 
-    cat > /etc/logrotate.d/hello-ota << EOF
-/var/log/hello-ota/*.log {
-    daily
-    missingok
-    rotate 7
-    compress
-    delaycompress
-    notifempty
-    create 644 hello-ota hello-ota
-    postrotate
-        systemctl reload hello-ota 2>/dev/null || true
-    endscript
-}
-EOF
+    # 應用程式已自行依大小輪替並壓縮日誌，移除舊的logrotate設定避免重複輪替
+    rm -f /etc/logrotate.d/hello-ota
 
-    log_success "日誌輪替設定完成"
+    log_success "日誌輪替由應用程式處理 (app.log_max_bytes / app.log_backup_count)"
 }
 
 start_service() {
     log_info "啟動Hello OTA服務..."
 
+    systemctl start hello-ota.socket
     systemctl start hello-ota.service
 
     # 等待服務啟動
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Download Strategy Benchmark - 不良網路下的下載策略比較
+
+經由網路狀況代理（netem_proxy.py）向本機的模擬更新服務器下載同一個更新包，
+比較三種策略在各網路狀況下的完成時間、重試次數與實際傳輸量：
+  single     單一連線下載，中斷後從頭重新下載
+  parallel   以多個Range請求同時下載不同區塊，逐區塊驗證，中斷時只重新下載缺少的區塊
+  resumable  單一連線逐區塊驗證，中斷時以Range請求從缺少的區塊續傳
+三種策略都使用 OTAManager 的下載函式；每個策略各自使用一個新的代理並使用相同的隨機種子，
+抖動、停頓與中斷位置相同，結果可以直接比較。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+from pathlib import Path
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+
+TESTS_DIR = Path(__file__).resolve().parent
+APP_DIR = TESTS_DIR.parent / "app"
+for path in (APP_DIR, TESTS_DIR):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+from netem_proxy import NetemProxy, PROFILES, resolve_profile
+
+STRATEGIES = ("single", "parallel", "resumable")
+DEFAULT_PROFILES = ("lan", "dsl", "3g", "stalling", "flaky")
+PACKAGE_NAME = "v1.1.0.tar.gz"
+
+class DownloadBenchmark:
+    """在各網路狀況下以不同策略下載同一個更新包"""
+
+    def __init__(self, work_dir, size_bytes=2 * 1024 * 1024, chunk_size=256 * 1024, streams=4,
+                 attempts=8, repeat=1, timeout=30, seed=0):
+        self.work_dir = Path(work_dir)
+        self.size_bytes = size_bytes
+        self.chunk_size = chunk_size
+        self.streams = streams
+        self.attempts = attempts
+        self.repeat = repeat
+        self.timeout = timeout
+        self.seed = seed
+
+    def run(self, profiles=DEFAULT_PROFILES, strategies=STRATEGIES):
+        from mock_server import MockUpdateServerHandler, MockThreadingHTTPServer
+        from chunk_verify import build_chunk_info
+
+        updates_dir = self.work_dir / "updates"
+        updates_dir.mkdir(parents=True, exist_ok=True)
+        package = updates_dir / PACKAGE_NAME
+        package.write_bytes(os.urandom(self.size_bytes))
+        update_info = {
+            "version": "1.1.0",
+            "size": self.size_bytes,
+            "checksum": hashlib.sha256(package.read_bytes()).hexdigest(),
+            "chunks": build_chunk_info(package, self.chunk_size)
+        }
+
+        handler = type("DownloadBenchmarkHandler", (MockUpdateServerHandler,), {
+            "quiet": True, "updates_dir": updates_dir
+        })
+        server = MockThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            results = {
+                self._profile_name(profile): {
+                    strategy: self._run_strategy(server.server_port, profile, strategy, update_info)
+                    for strategy in strategies
+                }
+                for profile in profiles
+            }
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(updates_dir, ignore_errors=True)
+
+        return {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count()
+            },
+            "size_bytes": self.size_bytes,
+            "chunk_size": self.chunk_size,
+            "streams": self.streams,
+            "attempts": self.attempts,
+            "repeat": self.repeat,
+            "profiles": {self._profile_name(profile): resolve_profile(profile) for profile in profiles},
+            "results": results
+        }
+
+    @staticmethod
+    def _profile_name(profile):
+        return profile if isinstance(profile, str) else "custom"
+
+    def _run_strategy(self, port, profile, strategy, update_info):
+        runs = []
+        for run in range(self.repeat):
+            run_dir = self.work_dir / f"{self._profile_name(profile)}-{strategy}-{run}"
+            run_dir.mkdir(parents=True)
+            # 每次執行使用新的代理與相同的種子，各策略遇到相同的中斷位置
+            with NetemProxy(('127.0.0.1', port), profile, seed=self.seed + run) as proxy:
+                started = time.perf_counter()
+                try:
+                    attempts = self._download(strategy, f"{proxy.url}/updates/{PACKAGE_NAME}", run_dir, update_info)
+                    completed = True
+                except Exception:
+                    attempts = self.attempts
+                    completed = False
+                seconds = time.perf_counter() - started
+                stats = proxy.snapshot()
+            shutil.rmtree(run_dir, ignore_errors=True)
+            runs.append({"completed": completed, "seconds": seconds, "attempts": attempts, **stats})
+
+        done = [run for run in runs if run['completed']]
+        return {
+            "completed": len(done),
+            "seconds": round(statistics.median(run['seconds'] for run in done), 3) if done else None,
+            "attempts": statistics.median(run['attempts'] for run in runs),
+            "connections": statistics.median(run['connections'] for run in runs),
+            "dropped": statistics.median(run['dropped'] for run in runs),
+            "stalls": statistics.median(run['stalls'] for run in runs),
+            # 實際傳輸量與更新包大小的比例；重新下載與中斷時用戶端尚未讀取而遺失的資料都計入
+            "overhead": round(statistics.median(run['bytes_down'] for run in runs) / self.size_bytes, 2)
+        }
+
+    def _download(self, strategy, url, run_dir, update_info):
+        """以指定策略下載並驗證，回傳使用的嘗試次數；全部嘗試都失敗時拋出例外"""
+        from config import config
+        from ota_manager import OTAManager
+
+        original_get = config.get
+        overrides = {
+            # 重試由各策略自行計數
+            'ota.download_retries': 0,
+            'system.app_dir': str(run_dir / "app"),
+            'system.backup_dir': str(run_dir / "backup"),
+            'system.temp_dir': str(run_dir / "tmp"),
+            'system.data_dir': str(run_dir / "data")
+        }
+        with patch.object(config, 'get', lambda key, default=None: overrides.get(
+                key, original_get(key, default))):
+            ota_manager = OTAManager()
+            file_path = run_dir / PACKAGE_NAME
+            download = getattr(self, f"_download_{strategy}")
+            try:
+                attempts = download(ota_manager, url, file_path, update_info)
+            finally:
+                ota_manager._finish_write_session()
+
+            if not ota_manager._verify_checksum(file_path, update_info['checksum']):
+                raise Exception("下載的更新包校驗失敗")
+        return attempts
+
+    def _download_single(self, ota_manager, url, file_path, update_info):
+        import requests
+
+        for attempt in range(1, self.attempts + 1):
+            if file_path.exists():
+                file_path.unlink()
+            try:
+                ota_manager._download_with_progress(url, file_path, timeout=self.timeout)
+                if ota_manager._verify_checksum(file_path, update_info['checksum']):
+                    return attempt
+            except requests.exceptions.RequestException:
+                pass
+        raise Exception(f"{self.attempts} 次嘗試後仍未完成下載")
+
+    def _download_resumable(self, ota_manager, url, file_path, update_info):
+        from chunk_verify import ChunkManifest, ChunkState
+
+        state = ChunkState(file_path, ChunkManifest.from_update_info(update_info))
+        for attempt in range(1, self.attempts + 1):
+            try:
+                ota_manager._download_chunked(url, file_path, state, timeout=self.timeout)
+                return attempt
+            except Exception:
+                pass
+        raise Exception(f"{self.attempts} 次嘗試後仍有 {len(state.missing())} 個區塊未完成")
+
+    def _download_parallel(self, ota_manager, url, file_path, update_info):
+        from ota_manager import OTAManager
+        from chunk_verify import ChunkManifest, ChunkState
+
+        manifest = ChunkManifest.from_update_info(update_info)
+        state = ChunkState(file_path, manifest)
+        stats = {"chunks": len(manifest), "resumed": 0, "refetched": 0, "bad": 0}
+
+        # 各連線寫入同一個狀態，記錄已驗證區塊時互斥
+        save_lock = threading.Lock()
+        save = state.save
+
+        def locked_save():
+            with save_lock:
+                save()
+        state.save = locked_save
+
+        def fetch(indexes):
+            for first, last in OTAManager._chunk_runs(indexes):
+                ota_manager._stream_chunks(url, fd, state, first, last, stats, self.timeout)
+
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, manifest.total_size)
+            for attempt in range(1, self.attempts + 1):
+                missing = state.missing()
+                # 缺少的區塊平均分給各連線，每個連線負責連續的一段
+                share = -(-len(missing) // self.streams)
+                groups = [missing[i:i + share] for i in range(0, len(missing), share)]
+                with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                    for future in [executor.submit(fetch, group) for group in groups]:
+                        future.exception()
+                os.fsync(fd)
+                if not state.missing():
+                    return attempt
+        finally:
+            os.close(fd)
+        raise Exception(f"{self.attempts} 次嘗試後仍有 {len(state.missing())} 個區塊未完成")
+
+def format_table(report):
+    """以表格列出各網路狀況、各策略的完成時間、嘗試次數與傳輸量比例"""
+    lines = ["網路狀況".ljust(12) + "策略".ljust(12) + "耗時".rjust(10) + "嘗試".rjust(6) + "傳輸量".rjust(8)]
+    for profile, strategies in report['results'].items():
+        for strategy, result in strategies.items():
+            seconds = f"{result['seconds']:.2f}s" if result['seconds'] is not None else "未完成"
+            lines.append(
+                profile.ljust(12) + strategy.ljust(12) + seconds.rjust(10) +
+                f"{result['attempts']:g}".rjust(6) + f"{result['overhead']:.2f}x".rjust(8)
+            )
+    return "\n".join(lines)
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="不良網路下的下載策略比較")
+    parser.add_argument("--profiles", default=",".join(DEFAULT_PROFILES),
+                        help=f"網路狀況（以逗號分隔，可用: {', '.join(PROFILES)}）")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help="下載策略（以逗號分隔）")
+    parser.add_argument("--size-mb", type=float, default=2, help="更新包大小（MB）")
+    parser.add_argument("--chunk-kb", type=int, default=256, help="區塊大小（KB）")
+    parser.add_argument("--streams", type=int, default=4, help="parallel 策略的同時連線數")
+    parser.add_argument("--attempts", type=int, default=8, help="每個策略最多嘗試次數")
+    parser.add_argument("--repeat", type=int, default=1, help="每個組合重複次數（取中位數）")
+    parser.add_argument("--timeout", type=float, default=30, help="每個請求的讀取逾時（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="代理的隨機種子")
+    parser.add_argument("--work-dir", help="工作目錄（預設使用暫存目錄）")
+    parser.add_argument("--output", help="報告輸出檔案（預設輸出到stdout）")
+    args = parser.parse_args()
+
+    # 中斷與重試是預期情況，只輸出錯誤
+    logging.basicConfig(level=logging.ERROR)
+    profiles = args.profiles.split(',')
+    strategies = args.strategies.split(',')
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            parser.error(f"未知的下載策略: {strategy}")
+
+    work_dir = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="download-benchmark-"))
+    try:
+        report = DownloadBenchmark(
+            work_dir, size_bytes=int(args.size_mb * 1024 * 1024), chunk_size=args.chunk_kb * 1024,
+            streams=args.streams, attempts=args.attempts, repeat=args.repeat, timeout=args.timeout, seed=args.seed
+        ).run(profiles, strategies)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    print(format_table(report), file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
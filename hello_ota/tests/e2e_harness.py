@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+End-to-End OTA Harness - 沙箱中的完整OTA更新循環
+
+每個沙箱有自己的根目錄（opt、var、tmp、etc 各自獨立）、臨時埠上的模擬更新服務器與服務，
+並以測試用的服務管理器取代 systemctl，完整執行
+檢查 → 下載 → 驗證 → 備份（放入槽位）→ 套用 → 重啟 → 健康檢查。
+不需要root權限、不使用固定埠，多個沙箱可同時執行，作為更新流程效能量測的基礎。
+
+目標是一次完整循環在一秒內完成，目前尚未達成：單一沙箱約 1.1 秒，
+兩個沙箱同時執行（--parallel 2）約 1.6-1.9 秒。時間主要花在套用階段（apply_ms 約 0.9-1.6 秒）：
+  放入槽位      解壓縮、預先編譯與隔離環境匯入測試，約 0.35 秒
+  切換與重啟    停止舊行程、新行程啟動與匯入到就緒通知（即 downtime_ms），約 0.4-0.7 秒
+  其餘          工作行程與更新執行器的直譯器啟動、健康檢查
+檢查（check_ms）約 0.2 秒。
+"""
+
+import io
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from contextlib import redirect_stdout
+
+TESTS_DIR = Path(__file__).resolve().parent
+APP_DIR = TESTS_DIR.parent / "app"
+UPDATES_DIR = TESTS_DIR.parent / "updates"
+for path in (APP_DIR, UPDATES_DIR, TESTS_DIR):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+# 更新循環的最終狀態（更新執行器寫入歷史記錄）
+FINAL_STATUSES = ("completed", "failed", "rolled_back")
+
+# redirect_stdout 替換的是整個行程的stdout，同時執行的沙箱依序建立更新包
+_PUBLISH_LOCK = threading.Lock()
+
+def free_port():
+    """向系統取得未使用的埠"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def build_release(target, version):
+    """以目前的應用程式模組建立指定版本的版本目錄"""
+    target = Path(target)
+    shutil.copytree(APP_DIR, target, ignore=shutil.ignore_patterns("__pycache__"))
+    with open(target / "version.py", 'w', encoding='utf-8') as f:
+        f.write(
+            f'__version__ = "{version}"\n'
+            'def get_version_info():\n'
+            '    return {"version": __version__}\n'
+        )
+    return target
+
+class OTASandbox:
+    """一台在沙箱根目錄中執行的裝置與它的更新服務器"""
+
+    def __init__(self, root=None, base_version="1.0.0", background_worker=False):
+        self.owns_root = root is None
+        self.root = Path(root) if root else Path(tempfile.mkdtemp(prefix="ota-sandbox-"))
+        self.base_version = base_version
+        self.background_worker = background_worker
+
+        self.app_dir = self.root / "opt" / "hello-ota"
+        self.backup_dir = self.root / "var" / "backups" / "hello-ota"
+        self.data_dir = self.root / "var" / "lib" / "hello-ota"
+        self.log_dir = self.root / "var" / "log" / "hello-ota"
+        self.temp_dir = self.root / "tmp" / "hello-ota-update"
+        self.config_file = self.root / "etc" / "hello-ota" / "config.json"
+        self.pid_file = self.root / "run" / "hello-ota.pid"
+        self.updates_dir = self.root / "srv" / "updates"
+        self.service_dir = self.root / "run" / "fake-service"
+
+        self.port = None
+        self.server = None
+        self.handler = None
+        self.service = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def history_file(self):
+        return self.data_dir / "update_history.jsonl"
+
+    def start(self):
+        """啟動模擬更新服務器與目前版本的服務"""
+        from http.server import ThreadingHTTPServer
+        from mock_server import MockUpdateServerHandler, ReleaseFeed
+        from release_slots import ReleaseManager
+        from fake_service_manager import FakeServiceManager
+
+        self.updates_dir.mkdir(parents=True)
+        self.handler = type("SandboxUpdateHandler", (MockUpdateServerHandler,), {
+            "quiet": True, "updates_dir": self.updates_dir, "feed": ReleaseFeed()
+        })
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.port = free_port()
+        self._write_config()
+
+        # 目前版本放入槽位
+        releases = ReleaseManager(self.app_dir)
+        releases.stage(self.base_version, build_release(self.root / "build" / self.base_version, self.base_version))
+        releases.activate(self.base_version)
+
+        self.service = FakeServiceManager(self.service_dir)
+        self.service.configure(
+            [sys.executable, str(self.app_dir / "current")],
+            env={"HELLO_OTA_CONFIG": str(self.config_file)}
+        )
+        self.service.start()
+        return self
+
+    def _write_config(self):
+        self.config_file.parent.mkdir(parents=True)
+        with open(self.config_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "app": {"host": "127.0.0.1", "port": self.port, "log_level": "WARNING"},
+                "ota": {
+                    # 更新由 run_cycle 觸發，不在背景輪詢
+                    "enabled": False,
+                    "update_server": f"http://127.0.0.1:{self.server.server_port}",
+                    "background_worker": self.background_worker,
+                    "trace_memory": False,
+                    "service_manager": "systemd",
+                    "restart_command": [
+                        sys.executable, str(TESTS_DIR / "fake_service_manager.py"),
+                        "--state-dir", str(self.service_dir), "restart"
+                    ],
+                    "restart_timeout": 10,
+                    "health_deadline": 10
+                },
+                "system": {
+                    "app_dir": str(self.app_dir),
+                    "backup_dir": str(self.backup_dir),
+                    "temp_dir": str(self.temp_dir),
+                    "data_dir": str(self.data_dir),
+                    "log_dir": str(self.log_dir),
+                    "pid_file": str(self.pid_file)
+                }
+            }, f, indent=2)
+
+    def publish(self, version, prepare=None):
+        """建立並發佈新版本的更新包；prepare 可在打包前修改版本目錄（例如模擬有問題的版本）"""
+        from create_update import UpdatePackageCreator
+
+        source = build_release(self.root / "build" / version, version)
+        if prepare is not None:
+            prepare(source)
+        with _PUBLISH_LOCK, redirect_stdout(io.StringIO()):
+            UpdatePackageCreator().create_update_package(version, source, self.updates_dir)
+        self.handler.feed.publish(version)
+
+    def history(self):
+        if not self.history_file.exists():
+            return []
+        with open(self.history_file, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _post(self, path, payload=None):
+        import requests
+
+        response = requests.post(f"{self.url}{path}", json=payload or {}, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def version(self):
+        import requests
+
+        return requests.get(f"{self.url}/version", timeout=5).json()['version']
+
+    def run_cycle(self, version, timeout=10):
+        """由服務檢查並套用指定版本，等到更新執行器記錄結果，回傳各段耗時"""
+        recorded = len(self.history())
+        started = time.perf_counter()
+
+        update_info = self._post("/ota/check")
+        if not update_info.get('has_update') or update_info.get('latest_version') != version:
+            raise Exception(f"服務沒有發現版本 {version}: {update_info}")
+        checked = time.perf_counter()
+
+        self._post("/trigger_update", {
+            "version": version,
+            "update_url": update_info['download_url'],
+            "checksum": update_info['checksum']
+        })
+
+        deadline = started + timeout
+        while True:
+            records = [record for record in self.history()[recorded:]
+                       if record.get('version') == version and record.get('status') in FINAL_STATUSES]
+            if records:
+                record = records[-1]
+                break
+            if time.perf_counter() > deadline:
+                raise Exception(f"更新循環未在 {timeout} 秒內完成")
+            time.sleep(0.005)
+        finished = time.perf_counter()
+
+        return {
+            "version": version,
+            "status": record['status'],
+            "running_version": self.version(),
+            "check_ms": round((checked - started) * 1000, 1),
+            "apply_ms": round((finished - checked) * 1000, 1),
+            "total_ms": round((finished - started) * 1000, 1),
+            "downtime_ms": record.get('downtime_ms'),
+            "time_to_healthy_ms": record.get('time_to_healthy_ms'),
+            "restarts": self.service.status()['restarts']
+        }
+
+    def close(self):
+        if self.service is not None:
+            self.service.stop()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.owns_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def run_sandbox(versions, work_dir=None, background_worker=False):
+    """在一個沙箱中依序更新到各版本，回傳每個循環的結果"""
+    root = Path(tempfile.mkdtemp(prefix="ota-sandbox-", dir=work_dir))
+    results = []
+    with OTASandbox(root, background_worker=background_worker) as sandbox:
+        for version in versions:
+            sandbox.publish(version)
+            results.append(sandbox.run_cycle(version))
+    shutil.rmtree(root, ignore_errors=True)
+    return results
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="沙箱中的完整OTA更新循環")
+    parser.add_argument("--parallel", type=int, default=1, help="同時執行的沙箱數")
+    parser.add_argument("--versions", default="1.1.0", help="依序更新到的版本（以逗號分隔）")
+    parser.add_argument("--background-worker", action="store_true", help="下載與放入槽位在低優先權工作行程中執行")
+    parser.add_argument("--work-dir", help="沙箱所在目錄（預設使用暫存目錄）")
+    args = parser.parse_args()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    versions = args.versions.split(',')
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        futures = [executor.submit(run_sandbox, versions, args.work_dir, args.background_worker)
+                   for _ in range(args.parallel)]
+        sandboxes = [future.result() for future in futures]
+
+    cycles = [cycle for results in sandboxes for cycle in results]
+    report = {
+        "sandboxes": sandboxes,
+        "cycles": len(cycles),
+        "failed": sum(1 for cycle in cycles if cycle['status'] != 'completed'),
+        "max_total_ms": max(cycle['total_ms'] for cycle in cycles),
+        "wall_seconds": round(time.perf_counter() - started, 2)
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 1 if report['failed'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Fake Service Manager - 測試用的服務管理器
+
+取代 systemctl：以 Type=notify 的方式啟動服務（等待 READY=1 才返回），
+狀態（啟動命令、環境變數、主行程PID、重啟次數）保存在狀態目錄，
+更新執行器以 ota.restart_command 呼叫 `restart` 時與測試行程看到相同的服務。
+不需要root權限或systemd，每個沙箱各自一個狀態目錄，可同時執行多個。
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+if str(APP_DIR) not in sys.path:
+    sys.path.insert(0, str(APP_DIR))
+
+from service_notify import ReadySocket
+from flash_io import atomic_write_json
+
+def pid_alive(pid):
+    """行程是否仍存在（殭屍行程視為已結束）；不匯入 updater，重啟量測不含額外的匯入時間"""
+    try:
+        os.kill(pid, 0)
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except ProcessLookupError:
+        return False
+    except (OSError, IndexError):
+        return True
+
+def wait_for_exit(pid, timeout):
+    deadline = time.monotonic() + timeout
+    while pid_alive(pid):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+class FakeServiceManager:
+    """單一服務的啟動、停止與重啟"""
+
+    def __init__(self, state_dir):
+        self.state_dir = Path(state_dir)
+        self.state_file = self.state_dir / "service.json"
+        self.log_file = self.state_dir / "service.log"
+
+    def configure(self, command, env=None):
+        """設定服務的啟動命令與環境變數"""
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self._save({"command": command, "env": env or {}, "pid": None, "restarts": 0})
+
+    def _load(self):
+        with open(self.state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self, state):
+        atomic_write_json(self.state_file, state)
+
+    def main_pid(self):
+        pid = self._load().get('pid')
+        return pid if pid and pid_alive(pid) else None
+
+    def status(self):
+        state = self._load()
+        return {"active": self.main_pid() is not None, "pid": state.get('pid'), "restarts": state.get('restarts', 0)}
+
+    def start(self, timeout=10):
+        """啟動服務並等待就緒通知，回傳主行程PID"""
+        state = self._load()
+        with ReadySocket() as ready_socket:
+            env = {**ready_socket.environ(), **state['env']}
+            # 與 systemd 相同，服務不繼承呼叫端的 systemd 環境
+            env.pop("INVOCATION_ID", None)
+            with open(self.log_file, 'ab') as log:
+                process = subprocess.Popen(
+                    state['command'], env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                    start_new_session=True
+                )
+            # 與 systemd 相同，服務在就緒前結束時立即判定啟動失敗
+            deadline = time.monotonic() + timeout
+            while not ready_socket.wait_ready(0.05):
+                if process.poll() is not None:
+                    raise Exception(f"服務啟動失敗，結束碼 {process.returncode}")
+                if time.monotonic() >= deadline:
+                    process.kill()
+                    process.wait()
+                    raise Exception("服務未在時限內送出就緒通知")
+
+        state['pid'] = process.pid
+        self._save(state)
+        return process.pid
+
+    def stop(self, timeout=10):
+        """以SIGTERM停止服務，逾時改用SIGKILL"""
+        pid = self.main_pid()
+        if pid is None:
+            return
+        os.kill(pid, signal.SIGTERM)
+        if not wait_for_exit(pid, timeout):
+            os.kill(pid, signal.SIGKILL)
+            wait_for_exit(pid, timeout)
+
+    def restart(self, timeout=10):
+        self.stop(timeout)
+        pid = self.start(timeout)
+        state = self._load()
+        state['restarts'] = state.get('restarts', 0) + 1
+        self._save(state)
+        return pid
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="測試用的服務管理器（取代 systemctl）")
+    parser.add_argument("--state-dir", required=True, help="服務狀態目錄")
+    parser.add_argument("--timeout", type=float, default=10, help="等待就緒或停止的秒數")
+    parser.add_argument("action", choices=("start", "stop", "restart", "status"))
+    args = parser.parse_args()
+
+    manager = FakeServiceManager(args.state_dir)
+    started = time.monotonic()
+    try:
+        if args.action == "status":
+            print(json.dumps(manager.status()))
+        else:
+            getattr(manager, args.action)(args.timeout)
+            print(f"[fake-service-manager] {args.action} 完成，耗時 {(time.monotonic() - started) * 1000:.0f} ms")
+    except Exception as e:
+        print(f"[fake-service-manager] {args.action} 失敗: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+Fleet Simulator - 以asyncio模擬大量裝置對更新服務器施加負載
+
+每個模擬裝置依 check_for_updates 的輪詢週期（加上隨機抖動）檢查更新，
+發現新版本後下載更新包並驗證校驗和，完成後以新版本繼續輪詢。
+結果以JSON輸出（延遲百分位數、吞吐量、錯誤率、整批更新完成時間），
+方便比較服務器修改前後的差異。
+
+長輪詢模式下每個裝置保持一個等待中的請求；發佈新版本後量測通知送達所有裝置的延遲，
+以及服務器在所有裝置連線時的線程數與記憶體，估算單一服務器可容納的裝置數。
+"""
+
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import hashlib
+import argparse
+import subprocess
+import urllib.request
+from pathlib import Path
+from urllib.parse import urlsplit, urlencode
+
+READ_CHUNK_SIZE = 64 * 1024
+
+def percentile(values, percent):
+    """最近排名法的百分位數，沒有資料時回傳None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(len(ordered) * percent / 100.0 + 0.5), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+def _latency_summary(seconds):
+    return {
+        name: round(value * 1000, 2) if value is not None else None
+        for name, value in (
+            ("p50", percentile(seconds, 50)),
+            ("p95", percentile(seconds, 95)),
+            ("p99", percentile(seconds, 99)),
+            ("max", max(seconds) if seconds else None)
+        )
+    }
+
+class HTTPError(Exception):
+    """非200回應"""
+
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+async def http_get(url, timeout, on_chunk=None):
+    """以單一連線送出GET請求
+
+    回傳 (內容, 位元組數)；提供 on_chunk 時內容逐塊交給它處理而不保留在記憶體。
+    """
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    async def request():
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        try:
+            writer.write(
+                f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: close\r\n\r\n".encode()
+            )
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("連線在回應前關閉")
+            status = int(status_line.split()[1])
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if status != 200:
+                raise HTTPError(status)
+
+            remaining = int(headers['content-length']) if 'content-length' in headers else None
+            body = bytearray()
+            size = 0
+            while remaining is None or remaining > 0:
+                chunk = await reader.read(READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    if remaining:
+                        raise ConnectionError("回應內容不完整")
+                    break
+                size += len(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+                if on_chunk is None:
+                    body += chunk
+                else:
+                    on_chunk(chunk)
+            return bytes(body), size
+        finally:
+            writer.close()
+
+    return await asyncio.wait_for(request(), timeout)
+
+class FleetStats:
+    """各類請求的延遲、錯誤與更新完成時間"""
+
+    def __init__(self):
+        self.latencies = {"check": [], "download": []}
+        self.errors = {"check": {}, "download": {}}
+        self.download_bytes = 0
+        self.completions = []
+        self.notifications = []
+
+    def record(self, kind, seconds):
+        self.latencies[kind].append(seconds)
+
+    def record_error(self, kind, reason):
+        self.errors[kind][reason] = self.errors[kind].get(reason, 0) + 1
+
+class SimulatedAgent:
+    """模擬裝置：週期性檢查更新，有新版本時下載"""
+
+    def __init__(self, index, simulator, version):
+        self.index = index
+        self.simulator = simulator
+        self.version = version
+        self.seen = None
+
+    async def run(self):
+        simulator = self.simulator
+        # 裝置開機時間分散在一個輪詢週期內
+        if await simulator.sleep(random.uniform(0, simulator.check_interval)):
+            return
+
+        while True:
+            update_info = await self.check()
+            if update_info and update_info.get('has_update'):
+                simulator.notified(update_info)
+                self.seen = update_info['latest_version']
+                if not simulator.download:
+                    self.version = update_info['latest_version']
+                    simulator.completed(self)
+                else:
+                    if await simulator.sleep(random.uniform(0, simulator.download_jitter)):
+                        return
+                    if await self.download(update_info):
+                        self.version = update_info['latest_version']
+                        simulator.completed(self)
+
+            # 長輪詢回應後立即重新等待；請求失敗時才等一個輪詢週期
+            delay = 0 if simulator.long_poll and update_info is not None else simulator.next_interval()
+            if await simulator.sleep(delay):
+                return
+
+    async def _timed(self, kind, url, on_chunk=None, timeout=None):
+        simulator = self.simulator
+        async with simulator.connections:
+            start_time = time.monotonic()
+            try:
+                result = await http_get(url, timeout or simulator.timeout, on_chunk)
+            except asyncio.TimeoutError:
+                simulator.stats.record_error(kind, "timeout")
+            except HTTPError as e:
+                simulator.stats.record_error(kind, f"http_{e.status}")
+            except (OSError, ValueError, IndexError) as e:
+                simulator.stats.record_error(kind, type(e).__name__)
+            else:
+                simulator.stats.record(kind, time.monotonic() - start_time)
+                return result
+        return None
+
+    async def check(self):
+        simulator = self.simulator
+        params = {"current_version": self.version, "formats": "tar,zipapp"}
+        if simulator.long_poll:
+            params["wait"] = simulator.long_poll
+            if self.seen:
+                params["seen"] = self.seen
+        result = await self._timed(
+            "check", f"{simulator.server}/api/check_update?{urlencode(params)}",
+            timeout=simulator.timeout + simulator.long_poll
+        )
+        if result is None:
+            return None
+        try:
+            return json.loads(result[0])
+        except ValueError:
+            self.simulator.stats.record_error("check", "invalid_json")
+            return None
+
+    async def download(self, update_info):
+        sha256_hash = hashlib.sha256()
+        result = await self._timed("download", update_info['download_url'], sha256_hash.update)
+        if result is None:
+            return False
+
+        self.simulator.stats.download_bytes += result[1]
+        if update_info.get('checksum') and sha256_hash.hexdigest() != update_info['checksum']:
+            self.simulator.stats.record_error("download", "checksum")
+            return False
+        return True
+
+class FleetSimulator:
+    """執行整批模擬裝置並產生報告"""
+
+    def __init__(self, server, agents=1000, check_interval=300.0, jitter=0.1, download_jitter=0.0,
+                 start_version="1.0.0", duration=600.0, timeout=30.0, max_connections=1000,
+                 keep_polling=False, seed=None, long_poll=0, publish_version=None, publish_after=0.0,
+                 download=True):
+        self.server = server.rstrip('/')
+        self.agents = agents
+        self.check_interval = check_interval
+        self.jitter = jitter
+        self.download_jitter = download_jitter
+        self.start_version = start_version
+        self.duration = duration
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.keep_polling = keep_polling
+        self.seed = seed
+        # long_poll 為長輪詢的等待秒數（0為定期輪詢）；publish_after 秒後發佈 publish_version
+        self.long_poll = long_poll
+        self.publish_version = publish_version
+        self.publish_after = publish_after
+        self.download = download
+        self.published_at = None
+        self.server_stats = {}
+        self.stats = FleetStats()
+        self._start_time = None
+        self._stop = None
+        self.connections = None
+
+    def next_interval(self):
+        """下一次輪詢前的等待時間（週期加上 ±jitter 比例的抖動）"""
+        return self.check_interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def sleep(self, seconds):
+        """等待指定秒數，模擬結束時提前返回True"""
+        try:
+            await asyncio.wait_for(self._stop.wait(), seconds)
+            return True
+        except asyncio.TimeoutError:
+            return self._stop.is_set()
+
+    def notified(self, update_info):
+        """記錄發佈新版本到裝置收到通知的延遲"""
+        if self.published_at is not None and update_info.get('latest_version') == self.publish_version:
+            self.stats.notifications.append(time.monotonic() - self.published_at)
+
+    async def _server_stats(self):
+        try:
+            body, _ = await http_get(f"{self.server}/api/stats", self.timeout)
+            return json.loads(body)
+        except (OSError, ValueError, HTTPError, asyncio.TimeoutError):
+            return None
+
+    async def _publish(self):
+        """等待 publish_after 秒，記錄服務器資源用量後發佈新版本"""
+        if await self.sleep(self.publish_after):
+            return
+        self.server_stats["attached"] = await self._server_stats()
+
+        request = urllib.request.Request(
+            f"{self.server}/api/publish",
+            data=json.dumps({"version": self.publish_version}).encode('utf-8'),
+            headers={"Content-Type": "application/json"}
+        )
+        self.published_at = time.monotonic()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, lambda: urllib.request.urlopen(request, timeout=self.timeout).read())
+
+    def completed(self, agent):
+        self.stats.completions.append(time.monotonic() - self._start_time)
+        if len(self.stats.completions) >= self.agents and not self.keep_polling:
+            self._stop.set()
+
+    async def run(self):
+        """執行模擬，回傳報告"""
+        if self.seed is not None:
+            random.seed(self.seed)
+
+        self._stop = asyncio.Event()
+        self.connections = asyncio.Semaphore(self.max_connections)
+        if self.publish_version:
+            self.server_stats["idle"] = await self._server_stats()
+        self._start_time = time.monotonic()
+
+        tasks = [
+            asyncio.ensure_future(SimulatedAgent(index, self, self.start_version).run())
+            for index in range(self.agents)
+        ]
+        if self.publish_version:
+            tasks.append(asyncio.ensure_future(self._publish()))
+        try:
+            await asyncio.wait_for(self._stop.wait(), self.duration)
+        except asyncio.TimeoutError:
+            self._stop.set()
+        if self.long_poll:
+            # 等待中的長輪詢請求不會自行結束
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        return self.report(time.monotonic() - self._start_time)
+
+    def report(self, elapsed):
+        stats = self.stats
+        requests = {}
+        for kind in ("check", "download"):
+            count = len(stats.latencies[kind])
+            errors = sum(stats.errors[kind].values())
+            attempts = count + errors
+            requests[kind] = {
+                "count": count,
+                "errors": errors,
+                "error_rate": round(errors / attempts, 4) if attempts else 0.0,
+                "throughput_rps": round(count / elapsed, 2) if elapsed else None,
+                "latency_ms": _latency_summary(stats.latencies[kind])
+            }
+        requests["download"]["bytes"] = stats.download_bytes
+        requests["download"]["throughput_mbps"] = (
+            round(stats.download_bytes * 8 / elapsed / 1e6, 2) if elapsed else None
+        )
+
+        completed = len(stats.completions)
+        report = {
+            "server": self.server,
+            "agents": self.agents,
+            "settings": {
+                "check_interval": self.check_interval,
+                "jitter": self.jitter,
+                "download_jitter": self.download_jitter,
+                "start_version": self.start_version,
+                "timeout": self.timeout,
+                "max_connections": self.max_connections,
+                "seed": self.seed,
+                "long_poll": self.long_poll,
+                "download": self.download
+            },
+            "elapsed_seconds": round(elapsed, 3),
+            "requests": requests,
+            "errors": {kind: dict(reasons) for kind, reasons in stats.errors.items()},
+            "rollout": {
+                "completed": completed,
+                "completion_rate": round(completed / self.agents, 4) if self.agents else 0.0,
+                # 全部裝置完成更新時才有整批完成時間
+                "time_to_fleet_completion_seconds": (
+                    round(max(stats.completions), 3) if completed >= self.agents else None
+                ),
+                "completion_seconds": {
+                    name: round(value, 3) if value is not None else None
+                    for name, value in (
+                        ("p50", percentile(stats.completions, 50)),
+                        ("p95", percentile(stats.completions, 95)),
+                        ("p99", percentile(stats.completions, 99))
+                    )
+                }
+            }
+        }
+        if self.publish_version:
+            report["notifications"] = self._notification_report()
+        return report
+
+    def _notification_report(self):
+        """通知延遲，以及所有裝置連線時服務器的資源用量"""
+        idle = self.server_stats.get("idle") or {}
+        attached = self.server_stats.get("attached") or {}
+        connections = attached.get("attached") or 0
+        rss_per_connection = None
+        if connections and idle.get("rss_kb") is not None and attached.get("rss_kb") is not None:
+            rss_per_connection = round((attached["rss_kb"] - idle["rss_kb"]) / connections, 2)
+
+        return {
+            "published_version": self.publish_version,
+            "published_after_seconds": self.publish_after,
+            "notified": len(self.stats.notifications),
+            "latency_ms": _latency_summary(self.stats.notifications),
+            "server_idle": idle or None,
+            "server_attached": attached or None,
+            "rss_kb_per_connection": rss_per_connection
+        }
+
+def _raise_open_file_limit(needed):
+    """每個模擬連線需要一個檔案描述子，盡量提高軟上限"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = hard if hard == resource.RLIM_INFINITY else min(max(soft, needed), hard)
+        if target != soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def start_mock_server(threading=False):
+    """以子行程啟動 mock_server.py，回傳 (行程, 網址)"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    command = [sys.executable, str(Path(__file__).parent / "mock_server.py"),
+               "--host", "127.0.0.1", "--port", str(port), "--quiet"]
+    if threading:
+        command.append("--threading")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise Exception("模擬更新服務器無法啟動")
+            time.sleep(0.05)
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="模擬大量裝置對更新服務器施加負載")
+    parser.add_argument("--server", default="http://localhost:9000", help="更新服務器網址")
+    parser.add_argument("--start-server", action="store_true", help="自行啟動 mock_server.py")
+    parser.add_argument("--server-threading", action="store_true", help="啟動的 mock_server.py 使用多線程")
+    parser.add_argument("--agents", type=int, default=1000, help="模擬裝置數量")
+    parser.add_argument("--check-interval", type=float, default=300.0, help="輪詢週期（秒），對應 ota.check_interval")
+    parser.add_argument("--jitter", type=float, default=0.1, help="輪詢週期的抖動比例")
+    parser.add_argument("--download-jitter", type=float, default=0.0, help="發現更新到開始下載的最長隨機延遲（秒）")
+    parser.add_argument("--start-version", default="1.0.0", help="裝置的起始版本（已是最新版本時只量測輪詢）")
+    parser.add_argument("--duration", type=float, default=600.0, help="最長模擬時間（秒）")
+    parser.add_argument("--timeout", type=float, default=30.0, help="單一請求逾時（秒）")
+    parser.add_argument("--max-connections", type=int, default=1000, help="同時連線數上限")
+    parser.add_argument("--keep-polling", action="store_true", help="全部完成更新後仍持續輪詢到模擬結束")
+    parser.add_argument("--seed", type=int, help="隨機種子，固定後可重現相同的請求時序")
+    parser.add_argument("--long-poll", type=float, default=0, help="長輪詢等待秒數（0為定期輪詢）")
+    parser.add_argument("--publish-version", help="模擬期間發佈的新版本（量測通知延遲）")
+    parser.add_argument("--publish-after", type=float, default=10.0, help="開始後幾秒發佈新版本")
+    parser.add_argument("--no-download", action="store_true", help="收到通知即視為完成，不下載更新包")
+    parser.add_argument("--output", help="報告輸出檔案（預設輸出到stdout）")
+    args = parser.parse_args()
+
+    _raise_open_file_limit(args.max_connections + 64)
+
+    server_process = None
+    server = args.server
+    if args.start_server:
+        server_process, server = start_mock_server(args.server_threading)
+
+    try:
+        simulator = FleetSimulator(
+            server, agents=args.agents, check_interval=args.check_interval, jitter=args.jitter,
+            download_jitter=args.download_jitter, start_version=args.start_version,
+            duration=args.duration, timeout=args.timeout, max_connections=args.max_connections,
+            keep_polling=args.keep_polling, seed=args.seed, long_poll=args.long_poll,
+            publish_version=args.publish_version, publish_after=args.publish_after,
+            download=not args.no_download
+        )
+        report = asyncio.run(simulator.run())
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    check = report['requests']['check']
+    rollout = report['rollout']
+    print(
+        f"檢查 {check['count']} 次 p99 {check['latency_ms']['p99']} ms，錯誤率 {check['error_rate']:.2%}；"
+        f"完成更新 {rollout['completed']}/{report['agents']}，"
+        f"整批完成時間 {rollout['time_to_fleet_completion_seconds']} 秒",
+        file=sys.stderr
+    )
+    notifications = report.get('notifications')
+    if notifications:
+        attached = notifications['server_attached'] or {}
+        print(
+            f"通知 {notifications['notified']} 台 p99 {notifications['latency_ms']['p99']} ms；"
+            f"服務器同時保持 {attached.get('attached')} 個連線，線程 {attached.get('threads')}，"
+            f"每個連線約 {notifications['rss_kb_per_connection']} KB",
+            file=sys.stderr
+        )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,15 +5,80 @@ Mock OTA Update Server - 模擬OTA更新服務器
 """
 
 import os
+import sys
 import json
+import time
+import shutil
 import hashlib
+import argparse
+import threading
 from pathlib import Path
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 
+def version_tuple(version):
+    return tuple(int(part) for part in version.split('.') if part.isdigit())
+
+class ReleaseFeed:
+    """已發佈的最新版本；發佈時喚醒所有等待中的長輪詢請求"""
+
+    def __init__(self):
+        self.latest = None
+        self.attached = 0
+        self.peak_attached = 0
+        self._condition = threading.Condition()
+
+    def publish(self, version):
+        """發佈新版本，回傳被喚醒的等待請求數"""
+        with self._condition:
+            self.latest = version
+            self._condition.notify_all()
+            return self.attached
+
+    def wait_for(self, predicate, timeout):
+        """等待 predicate 成立或逾時，回傳 predicate 的結果"""
+        with self._condition:
+            self.attached += 1
+            self.peak_attached = max(self.peak_attached, self.attached)
+            try:
+                return self._condition.wait_for(predicate, timeout)
+            finally:
+                self.attached -= 1
+
+class MockThreadingHTTPServer(ThreadingHTTPServer):
+    """長輪詢時每個裝置佔用一個連線，加大等待接受的連線佇列"""
+
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # 裝置中途斷線（包含網路狀況代理注入的連線中斷）是預期情況，不輸出堆疊
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
 class MockUpdateServerHandler(BaseHTTPRequestHandler):
     """模擬更新服務器HTTP請求處理器"""
 
+    # 更新包所在目錄；quiet 時不逐筆輸出請求（負載測試用）
+    updates_dir = Path(__file__).parent.parent / "updates"
+    quiet = False
+
+    # 長輪詢：發佈的版本與單一請求最長等待秒數（只有多線程服務器支援）
+    feed = ReleaseFeed()
+    max_wait = 300
+
+    # 鏡像：mirrors 為其他提供相同更新包的服務器（http://host:port），列在更新資訊中；
+    # 下載回應前等待 latency 秒、以 rate bytes/s 傳送，drop_after 時傳送該數量後中斷連線
+    mirrors = ()
+    latency = 0
+    rate = 0
+    drop_after = None
+
+    def _log(self, message):
+        if not self.quiet:
+            print(message)
+
     def do_GET(self):
         """處理GET請求"""
         path = urlparse(self.path).path
@@ -25,26 +90,87 @@ class MockUpdateServerHandler(BaseHTTPRequestHandler):
             self._handle_download_update(path)
         elif path == '/api/available_versions':
             self._handle_available_versions()
+        elif path == '/api/stats':
+            self._handle_stats()
         else:
             self._send_response(404, {"error": "Not Found"})
 
-    def _handle_check_update(self, query):
-        """處理檢查更新請求"""
-        current_version = query.get('current_version', [''])[0]
+    def do_POST(self):
+        """處理POST請求"""
+        path = urlparse(self.path).path
+
+        if path == '/api/publish':
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                version = json.loads(self.rfile.read(length) or b"{}").get('version')
+            except ValueError:
+                version = None
+            if not version:
+                self._send_response(400, {"error": "缺少 version"})
+                return
+            notified = self.feed.publish(version)
+            self._log(f"[Mock Server] 發佈版本 {version}，通知 {notified} 個等待中的裝置")
+            self._send_response(200, {"published": version, "notified": notified})
+        else:
+            self._send_response(404, {"error": "Not Found"})
 
-        print(f"[Mock Server] 檢查更新請求 - 當前版本: {current_version}")
+    def _supports_long_poll(self):
+        # 單線程服務器等待時會阻擋其他請求
+        return isinstance(self.server, ThreadingMixIn)
 
+    def _latest_version(self, current_version):
+        """目前版本可更新到的版本，已是最新時回傳None"""
         # 模擬可用版本
         available_versions = {
             "1.0.0": "1.1.0",  # 1.0.0 可以更新到 1.1.0
             "1.1.0": None      # 1.1.0 已是最新版本
         }
 
-        latest_version = available_versions.get(current_version)
+        latest = self.feed.latest
+        try:
+            if latest and version_tuple(latest) > version_tuple(current_version):
+                return latest
+        except ValueError:
+            pass
+        return available_versions.get(current_version)
+
+    def _handle_check_update(self, query):
+        """處理檢查更新請求"""
+        current_version = query.get('current_version', [''])[0]
+
+        self._log(f"[Mock Server] 檢查更新請求 - 當前版本: {current_version}")
+
+        # 長輪詢：等到可更新的版本不同於用戶端已知的版本，或逾時後回應目前狀態
+        try:
+            wait = min(float(query.get('wait', ['0'])[0]), self.max_wait)
+        except ValueError:
+            wait = 0
+        if wait > 0 and self._supports_long_poll():
+            seen = query.get('seen', [None])[0]
+            self.feed.wait_for(lambda: self._latest_version(current_version) not in (None, seen), wait)
+
+        latest_version = self._latest_version(current_version)
+        client_formats = query.get('formats', ['tar'])[0].split(',')
 
         if latest_version:
+            # 更新資訊檔標記 reloadable 時用戶端可嘗試熱更新
+            updates_dir = self.updates_dir
+            info_file = updates_dir / f"v{latest_version}_info.json"
+            info = {}
+            if info_file.exists():
+                with open(info_file, 'r', encoding='utf-8') as f:
+                    info = json.load(f)
+            reloadable = info.get('reloadable', False)
+            components = info.get('components')
+
+            # 用戶端支援且有 .pyz 時優先提供zipapp封存檔（多元件更新只有tar格式）
+            package_format = "tar"
+            update_file = updates_dir / f"v{latest_version}.tar.gz"
+            if not components and "zipapp" in client_formats and (updates_dir / f"v{latest_version}.pyz").exists():
+                package_format = "zipapp"
+                update_file = updates_dir / f"v{latest_version}.pyz"
+
             # 計算更新檔案的校驗和
-            update_file = Path(__file__).parent.parent / "updates" / f"v{latest_version}.tar.gz"
             checksum = ""
 
             if update_file.exists():
@@ -54,56 +180,118 @@ class MockUpdateServerHandler(BaseHTTPRequestHandler):
                 "has_update": True,
                 "current_version": current_version,
                 "latest_version": latest_version,
-                "download_url": f"http://localhost:9000/updates/v{latest_version}.tar.gz",
+                "version": latest_version,
+                "format": package_format,
+                "reloadable": reloadable,
+                # 以請求的 Host 組成下載網址，服務器不在預設埠時仍可下載
+                "download_url": f"http://{self.headers.get('Host', 'localhost:9000')}/updates/{update_file.name}",
                 "checksum": checksum,
                 "release_notes": f"更新到版本 {latest_version}",
                 "size": update_file.stat().st_size if update_file.exists() else 0,
-                "required": False
+                "required": False,
+                "long_poll": self._supports_long_poll()
             }
+            # 區塊清單屬於更新資訊描述的檔案，提供的是另一個格式時不附上
+            if info.get('chunks') and info.get('checksum') == checksum:
+                response_data["chunks"] = info['chunks']
+            if self.mirrors:
+                response_data["mirrors"] = self._mirror_urls(update_file.name)
+            if components:
+                host = self.headers.get('Host', 'localhost:9000')
+                response_data["components"] = [
+                    {**component, "download_url": f"http://{host}/updates/{component['filename']}",
+                     "mirrors": self._mirror_urls(component['filename'])}
+                    for component in components
+                ]
         else:
             response_data = {
                 "has_update": False,
                 "current_version": current_version,
                 "latest_version": current_version,
-                "message": "目前已是最新版本"
+                "message": "目前已是最新版本",
+                "long_poll": self._supports_long_poll()
             }
 
         self._send_response(200, response_data)
 
+    def _mirror_urls(self, filename):
+        return [f"{mirror.rstrip('/')}/updates/{filename}" for mirror in self.mirrors]
+
     def _handle_download_update(self, path):
         """處理更新檔案下載請求"""
         # 提取檔案名稱
         filename = path.split('/')[-1]
-        update_file = Path(__file__).parent.parent / "updates" / filename
+        update_file = self.updates_dir / filename
+
+        self._log(f"[Mock Server] 下載請求: {filename}")
 
-        print(f"[Mock Server] 下載請求: {filename}")
+        if self.latency:
+            time.sleep(self.latency)
 
         if update_file.exists():
+            # 支援單一範圍的Range請求，用戶端只重新下載損毀的區塊
+            file_size = update_file.stat().st_size
+            byte_range = self._parse_range(file_size)
+            start, end = byte_range or (0, file_size - 1)
+
             # 發送檔案
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/gzip')
-            self.send_header('Content-Length', str(update_file.stat().st_size))
+            self.send_response(206 if byte_range else 200)
+            content_type = 'application/gzip' if filename.endswith('.tar.gz') else 'application/zip'
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            if byte_range:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
             self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
             self.end_headers()
 
             with open(update_file, 'rb') as f:
-                self.wfile.write(f.read())
-
-            print(f"[Mock Server] 檔案下載完成: {filename}")
+                f.seek(start)
+                remaining = end - start + 1
+                if self.drop_after is not None:
+                    remaining = min(remaining, self.drop_after)
+                while remaining > 0:
+                    data = f.read(min(64 * 1024, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+                    if self.rate:
+                        time.sleep(len(data) / self.rate)
+            if self.drop_after is not None:
+                self.close_connection = True
+
+            self._log(f"[Mock Server] 檔案下載完成: {filename}")
         else:
             self._send_response(404, {"error": f"檔案不存在: {filename}"})
 
+    def _parse_range(self, file_size):
+        """解析 Range: bytes=start-end，不支援或無效時回傳None（傳送整個檔案）"""
+        header = self.headers.get('Range', '')
+        if not header.startswith('bytes=') or ',' in header:
+            return None
+        try:
+            start, end = header[len('bytes='):].split('-')
+            start = int(start)
+            end = min(int(end), file_size - 1) if end else file_size - 1
+        except ValueError:
+            return None
+        if start > end:
+            return None
+        return start, end
+
     def _handle_available_versions(self):
         """處理取得可用版本清單請求"""
-        updates_dir = Path(__file__).parent.parent / "updates"
+        updates_dir = self.updates_dir
         versions = []
 
         if updates_dir.exists():
             for item in updates_dir.iterdir():
-                if item.is_file() and item.name.endswith('.tar.gz'):
-                    version = item.name.replace('v', '').replace('.tar.gz', '')
+                if item.is_file() and item.name.endswith(('.tar.gz', '.pyz')):
+                    version = item.name.replace('v', '').replace('.tar.gz', '').replace('.pyz', '')
                     versions.append({
                         "version": version,
+                        "format": "zipapp" if item.name.endswith('.pyz') else "tar",
                         "filename": item.name,
                         "size": item.stat().st_size,
                         "checksum": self._calculate_checksum(item)
@@ -116,6 +304,25 @@ class MockUpdateServerHandler(BaseHTTPRequestHandler):
             "count": len(versions)
         })
 
+    def _handle_stats(self):
+        """長輪詢連線數與服務器資源用量（容量量測用）"""
+        rss_kb = None
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss_kb = int(line.split()[1])
+        except OSError:
+            pass
+
+        self._send_response(200, {
+            "attached": self.feed.attached,
+            "peak_attached": self.feed.peak_attached,
+            "latest": self.feed.latest,
+            "threads": threading.active_count(),
+            "rss_kb": rss_kb
+        })
+
     def _calculate_checksum(self, file_path):
         """計算檔案SHA256校驗和"""
         sha256_hash = hashlib.sha256()
@@ -136,12 +343,12 @@ class MockUpdateServerHandler(BaseHTTPRequestHandler):
 
     def log_message(self, format, *args):
         """自訂日誌格式"""
-        print(f"[Mock Server] {self.address_string()} - {format % args}")
+        self._log(f"[Mock Server] {self.address_string()} - {format % args}")
 
-def create_sample_update():
-    """建立範例更新檔案"""
-    updates_dir = Path(__file__).parent.parent / "updates"
-    updates_dir.mkdir(exist_ok=True)
+def create_sample_update(updates_dir=None):
+    """建立範例更新檔案（產生的檔案不納入版本控制，測試時建立在臨時目錄）"""
+    updates_dir = Path(updates_dir) if updates_dir else Path(__file__).parent.parent / "updates"
+    updates_dir.mkdir(parents=True, exist_ok=True)
 
     # 建立v1.1.0更新檔案
     version_dir = updates_dir / "v1.1.0"
@@ -188,9 +395,21 @@ def get_version_info():
             tar.add(version_dir, arcname="v1.1.0")
 
         print(f"[Mock Server] 已建立範例更新檔案: {tar_file}")
+    return updates_dir / "v1.1.0.tar.gz"
 
 def main():
     """主函數"""
+    parser = argparse.ArgumentParser(description="模擬OTA更新服務器")
+    parser.add_argument("--host", default="localhost", help="監聽位址")
+    parser.add_argument("--port", type=int, default=9000, help="監聽埠")
+    parser.add_argument("--quiet", action="store_true", help="不逐筆輸出請求")
+    parser.add_argument("--threading", action="store_true", help="每個請求使用獨立線程（支援長輪詢）")
+    parser.add_argument("--thread-stack-kb", type=int, default=256, help="多線程時每個線程的堆疊大小（KB）")
+    parser.add_argument("--mirror", action="append", default=[], help="提供相同更新包的鏡像服務器（可重複）")
+    parser.add_argument("--latency-ms", type=int, default=0, help="下載回應前的延遲（毫秒）")
+    parser.add_argument("--rate-kbps", type=int, default=0, help="下載速率上限（KB/s，0 為不限制）")
+    args = parser.parse_args()
+
     print("Mock OTA Update Server")
     print("=====================")
     print()
@@ -199,10 +418,18 @@ def main():
     create_sample_update()
 
     # 啟動服務器
-    host = "localhost"
-    port = 9000
-
-    server = HTTPServer((host, port), MockUpdateServerHandler)
+    host = args.host
+    port = args.port
+    MockUpdateServerHandler.quiet = args.quiet
+    MockUpdateServerHandler.mirrors = args.mirror
+    MockUpdateServerHandler.latency = args.latency_ms / 1000
+    MockUpdateServerHandler.rate = args.rate_kbps * 1024
+
+    if args.threading:
+        # 長輪詢時每個等待中的裝置佔用一個線程，縮小線程堆疊以容納更多連線
+        threading.stack_size(args.thread_stack_kb * 1024)
+    server_class = MockThreadingHTTPServer if args.threading else HTTPServer
+    server = server_class((host, port), MockUpdateServerHandler)
 
     print(f"模擬更新服務器啟動於: http://{host}:{port}")
     print()
@@ -210,6 +437,8 @@ def main():
     print(f"  - 檢查更新: GET http://{host}:{port}/api/check_update?current_version=1.0.0")
     print(f"  - 下載更新: GET http://{host}:{port}/updates/v1.1.0.tar.gz")
     print(f"  - 可用版本: GET http://{host}:{port}/api/available_versions")
+    print(f"  - 發佈版本: POST http://{host}:{port}/api/publish {{\"version\": \"1.2.0\"}}")
+    print(f"  - 連線統計: GET http://{host}:{port}/api/stats")
     print()
     print("測試指令:")
     print(f"  curl 'http://{host}:{port}/api/check_update?current_version=1.0.0'")
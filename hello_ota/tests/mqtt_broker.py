@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Local MQTT Broker - 測試用的行程內MQTT代理
+
+提供與 paho-mqtt 相同介面（connect、subscribe、message_callback_add、publish）的用戶端，
+支援主題萬用字元（+、#）、保留訊息與QoS 1：持久工作階段離線期間的訊息在重新連線後送達，
+用戶端離線時發佈的QoS 1訊息在重新連線後才送出，回呼函式拋出例外視為未確認而重新送達。
+不需要網路或外部代理即可測試MQTT更新流程。
+"""
+
+import time
+import queue
+import logging
+import threading
+import itertools
+
+logger = logging.getLogger(__name__)
+
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+def topic_matches(subscription, topic):
+    """MQTT主題比對：+ 比對單一層級，# 比對其餘所有層級"""
+    sub_levels = subscription.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(sub_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+class MQTTMessage:
+    """與 paho.mqtt.client.MQTTMessage 相同的欄位"""
+
+    def __init__(self, topic, payload, qos=0, retain=False, mid=0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self.dup = False
+
+class PublishInfo:
+    """與 paho 的 MQTTMessageInfo 相同：QoS 1 在代理確認（PUBACK）後才算送出"""
+
+    def __init__(self, mid):
+        self.mid = mid
+        self.rc = MQTT_ERR_SUCCESS
+        self._published = threading.Event()
+
+    def wait_for_publish(self, timeout=None):
+        self._published.wait(timeout)
+
+    def is_published(self):
+        return self._published.is_set()
+
+class _Session:
+    def __init__(self, client_id, clean_session):
+        self.client_id = client_id
+        self.clean_session = clean_session
+        self.subscriptions = {}
+        self.pending = []
+        self.client = None
+
+class LocalBroker:
+    """行程內的MQTT代理，訊息由獨立的派送線程送達（與網路用戶端相同為非同步）"""
+
+    def __init__(self, max_redeliveries=3):
+        self.max_redeliveries = max_redeliveries
+        self.published = []
+        self._sessions = {}
+        self._retained = {}
+        self._lock = threading.RLock()
+        self._mids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._running = True
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+
+    def client(self, client_id, clean_session=True):
+        """建立用戶端（尚未連線）"""
+        return LocalClient(self, client_id, clean_session)
+
+    def next_mid(self):
+        return next(self._mids)
+
+    def _connect(self, client):
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            session_present = session is not None and not client.clean_session
+            if not session_present:
+                session = _Session(client.client_id, client.clean_session)
+                self._sessions[client.client_id] = session
+            session.client = client
+            pending, session.pending = session.pending, []
+        for message in pending:
+            self._queue.put((client, message, 0))
+        return session_present
+
+    def _disconnect(self, client):
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session is None or session.client is not client:
+                return
+            session.client = None
+            if session.clean_session:
+                del self._sessions[client.client_id]
+
+    def _subscribe(self, client, subscription, qos):
+        with self._lock:
+            session = self._sessions[client.client_id]
+            session.subscriptions[subscription] = qos
+            retained = [message for topic, message in self._retained.items() if topic_matches(subscription, topic)]
+        for message in retained:
+            self._queue.put((client, self._copy(message, min(message.qos, qos), retain=True), 0))
+
+    def _route(self, message):
+        """將訊息交給所有訂閱者；持久工作階段離線時保留QoS 1訊息"""
+        with self._lock:
+            self.published.append(message)
+            if message.retain:
+                if message.payload:
+                    self._retained[message.topic] = message
+                else:
+                    self._retained.pop(message.topic, None)
+
+            for session in self._sessions.values():
+                granted = [qos for subscription, qos in session.subscriptions.items()
+                           if topic_matches(subscription, message.topic)]
+                if not granted:
+                    continue
+                copy = self._copy(message, min(message.qos, max(granted)))
+                if session.client is not None:
+                    self._queue.put((session.client, copy, 0))
+                elif copy.qos >= 1 and not session.clean_session:
+                    session.pending.append(copy)
+
+    @staticmethod
+    def _copy(message, qos, retain=False):
+        copy = MQTTMessage(message.topic, message.payload, qos=qos, retain=retain, mid=message.mid)
+        return copy
+
+    def _dispatch_loop(self):
+        while self._running:
+            try:
+                client, message, attempt = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                if not client.connected:
+                    # 傳送途中斷線：QoS 1訊息留給持久工作階段
+                    if message.qos >= 1:
+                        with self._lock:
+                            session = self._sessions.get(client.client_id)
+                            if session is not None and not session.clean_session:
+                                session.pending.append(message)
+                    continue
+                try:
+                    client._deliver(message)
+                except Exception as e:
+                    # 未確認的QoS 1訊息重新送達
+                    if message.qos >= 1 and attempt < self.max_redeliveries:
+                        logger.info(f"訊息未確認，重新送達 {message.topic}: {e}")
+                        message.dup = True
+                        self._queue.put((client, message, attempt + 1))
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout=5):
+        """等待所有訊息派送完成，逾時回傳False"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self):
+        self._running = False
+        self._dispatcher.join(timeout=1)
+
+class LocalClient:
+    """paho-mqtt 相容的用戶端"""
+
+    def __init__(self, broker, client_id, clean_session=True):
+        self.broker = broker
+        self.client_id = client_id
+        self.clean_session = clean_session
+        self.connected = False
+        self.on_connect = None
+        self.on_message = None
+        self._callbacks = {}
+        self._outbox = []
+        self._lock = threading.Lock()
+
+    def connect(self, host=None, port=None, keepalive=60):
+        session_present = self.broker._connect(self)
+        with self._lock:
+            self.connected = True
+            outbox, self._outbox = self._outbox, []
+        for message, info in outbox:
+            message.dup = True
+            self._send(message, info)
+        if self.on_connect is not None:
+            self.on_connect(self, None, {"session present": int(session_present)}, 0)
+        return MQTT_ERR_SUCCESS
+
+    connect_async = connect
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        with self._lock:
+            self.connected = False
+        self.broker._disconnect(self)
+        return MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic, qos=0):
+        if not self.connected:
+            return MQTT_ERR_NO_CONN, None
+        self.broker._subscribe(self, topic, qos)
+        return MQTT_ERR_SUCCESS, self.broker.next_mid()
+
+    def message_callback_add(self, subscription, callback):
+        self._callbacks[subscription] = callback
+
+    def message_callback_remove(self, subscription):
+        self._callbacks.pop(subscription, None)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        message = MQTTMessage(topic, payload or b"", qos=qos, retain=retain, mid=self.broker.next_mid())
+        info = PublishInfo(message.mid)
+
+        with self._lock:
+            if not self.connected:
+                # 離線時QoS 1訊息等重新連線後送出，QoS 0直接丟棄
+                if qos >= 1:
+                    self._outbox.append((message, info))
+                else:
+                    info.rc = MQTT_ERR_NO_CONN
+                return info
+        self._send(message, info)
+        return info
+
+    def _send(self, message, info):
+        self.broker._route(message)
+        info._published.set()
+
+    def _deliver(self, message):
+        callbacks = [callback for subscription, callback in self._callbacks.items()
+                     if topic_matches(subscription, message.topic)]
+        if not callbacks and self.on_message is not None:
+            callbacks = [self.on_message]
+        for callback in callbacks:
+            callback(self, None, message)
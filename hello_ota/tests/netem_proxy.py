@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Network Condition Proxy - 模擬不良網路的本機TCP代理
+
+放在裝置與模擬更新服務器之間，依命名的網路狀況設定注入延遲（RTT）、抖動、
+頻寬上限、傳輸停頓與連線中斷，重現現場的高延遲、低頻寬、停頓與下載中途被重設的連線。
+代理在TCP層轉發，HTTP內容不變，下載程式只需把網址的主機與埠換成代理的位址。
+"""
+
+import sys
+import time
+import queue
+import random
+import socket
+import struct
+import argparse
+import threading
+
+# 網路狀況設定：
+#   rtt_ms          來回延遲，每個方向各加一半
+#   jitter_ms       每段資料的延遲再加上 0 ~ jitter_ms 的隨機值（不改變資料順序）
+#   rate_kbps       下行頻寬上限（KB/s，同一代理的所有連線共用，0 為不限制）
+#   stall_every_kb  下行每傳送約這麼多資料停頓一次（0 為不停頓）
+#   stall_ms        每次停頓的時間
+#   drop_every_kb   每個連線下行傳送約這麼多資料後以RST中斷（0 為不中斷）
+PROFILES = {
+    "lan": {"rtt_ms": 1, "jitter_ms": 0, "rate_kbps": 0},
+    "dsl": {"rtt_ms": 40, "jitter_ms": 5, "rate_kbps": 1024},
+    "3g": {"rtt_ms": 300, "jitter_ms": 80, "rate_kbps": 192},
+    "satellite": {"rtt_ms": 650, "jitter_ms": 30, "rate_kbps": 512},
+    "stalling": {"rtt_ms": 100, "jitter_ms": 20, "rate_kbps": 512, "stall_every_kb": 256, "stall_ms": 1500},
+    "flaky": {"rtt_ms": 150, "jitter_ms": 40, "rate_kbps": 256, "drop_every_kb": 512},
+    "edge": {"rtt_ms": 500, "jitter_ms": 150, "rate_kbps": 32,
+             "stall_every_kb": 128, "stall_ms": 2000, "drop_every_kb": 256}
+}
+
+PROFILE_DEFAULTS = {
+    "rtt_ms": 0, "jitter_ms": 0, "rate_kbps": 0,
+    "stall_every_kb": 0, "stall_ms": 0, "drop_every_kb": 0
+}
+
+# 每次讀取與送出的資料段大小；頻寬上限以此粒度計算
+SEGMENT_SIZE = 16 * 1024
+
+def resolve_profile(profile, **overrides):
+    """取得網路狀況設定：名稱或設定字典，加上個別覆寫（值為None的覆寫忽略）"""
+    if isinstance(profile, str):
+        if profile not in PROFILES:
+            raise Exception(f"未知的網路狀況: {profile}（可用: {', '.join(PROFILES)}）")
+        profile = PROFILES[profile]
+    settings = {**PROFILE_DEFAULTS, **profile}
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    unknown = set(settings) - set(PROFILE_DEFAULTS)
+    if unknown:
+        raise Exception(f"未知的網路狀況參數: {', '.join(sorted(unknown))}")
+    return settings
+
+class TokenBucket:
+    """多個連線共用的頻寬上限（bytes/s），平行連線分享同一條鏈路"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_free = time.monotonic()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next_free = max(now, self._next_free) + size / self.rate
+            wait = self._next_free - now
+        if wait > 0:
+            time.sleep(wait)
+
+class _Link:
+    """一個被代理的連線：每個方向一個讀取線程與一個依到期時間送出的線程"""
+
+    def __init__(self, proxy, client, upstream):
+        self.proxy = proxy
+        self.client = client
+        self.upstream = upstream
+        self.closed = threading.Event()
+        self._lock = threading.Lock()
+        self._finished = 0
+
+        settings = proxy.settings
+        self.drop_at = None
+        if settings['drop_every_kb']:
+            self.drop_at = int(settings['drop_every_kb'] * 1024 * proxy.random.uniform(0.5, 1.5))
+        self.next_stall = self._next_stall(0)
+
+    def _next_stall(self, position):
+        every = self.proxy.settings['stall_every_kb'] * 1024
+        if not every or not self.proxy.settings['stall_ms']:
+            return None
+        return position + int(every * self.proxy.random.uniform(0.5, 1.5))
+
+    def start(self):
+        for source, target, downstream in ((self.client, self.upstream, False), (self.upstream, self.client, True)):
+            segments = queue.Queue()
+            threading.Thread(target=self._read, args=(source, segments), daemon=True).start()
+            threading.Thread(target=self._send, args=(target, segments, downstream), daemon=True).start()
+
+    def _delay(self):
+        settings = self.proxy.settings
+        delay = settings['rtt_ms'] / 2000
+        if settings['jitter_ms']:
+            delay += self.proxy.random.uniform(0, settings['jitter_ms'] / 1000)
+        return delay
+
+    def _read(self, source, segments):
+        """讀取資料並標記送出時間；TCP不重新排序，到期時間不早於前一段"""
+        due = 0
+        while not self.closed.is_set():
+            try:
+                data = source.recv(SEGMENT_SIZE)
+            except OSError:
+                data = b""
+            due = max(due, time.monotonic() + self._delay())
+            segments.put((due, data))
+            if not data:
+                return
+
+    def _send(self, target, segments, downstream):
+        sent = 0
+        try:
+            while True:
+                due, data = segments.get()
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                if self.closed.is_set():
+                    return
+                if not data:
+                    # 對方關閉寫入端，轉為關閉另一側的寫入端
+                    target.shutdown(socket.SHUT_WR)
+                    return
+                if not downstream:
+                    target.sendall(data)
+                    self.proxy._count("bytes_up", len(data))
+                    continue
+
+                for offset in range(0, len(data), SEGMENT_SIZE):
+                    piece = data[offset:offset + SEGMENT_SIZE]
+                    if self.next_stall is not None and sent >= self.next_stall:
+                        self.proxy._count("stalls")
+                        time.sleep(self.proxy.settings['stall_ms'] / 1000)
+                        self.next_stall = self._next_stall(sent)
+                    if self.drop_at is not None and sent + len(piece) > self.drop_at:
+                        piece = piece[:self.drop_at - sent]
+                        if piece:
+                            target.sendall(piece)
+                            self.proxy._count("bytes_down", len(piece))
+                        self.proxy._count("dropped")
+                        self.abort()
+                        return
+                    self.proxy.bucket.consume(len(piece))
+                    target.sendall(piece)
+                    sent += len(piece)
+                    self.proxy._count("bytes_down", len(piece))
+        except OSError:
+            self.abort()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._finished += 1
+            done = self._finished == 2
+        if done:
+            self.close()
+
+    def abort(self):
+        """以RST中斷用戶端連線（模擬現場連線被重設）"""
+        if self.closed.is_set():
+            return
+        try:
+            self.client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+        self.close(abort=True)
+
+    def close(self, abort=False):
+        with self._lock:
+            if self.closed.is_set():
+                return
+            self.closed.set()
+        # shutdown 喚醒阻塞在 recv 的讀取線程；中斷時用戶端只關閉讀取端，不送出FIN
+        for sock, how in ((self.client, socket.SHUT_RD if abort else socket.SHUT_RDWR),
+                          (self.upstream, socket.SHUT_RDWR)):
+            try:
+                sock.shutdown(how)
+            except OSError:
+                pass
+            sock.close()
+        self.proxy._forget(self)
+
+class NetemProxy:
+    """轉發到 upstream 的本機TCP代理，依網路狀況設定整形流量"""
+
+    def __init__(self, upstream, profile="lan", host='127.0.0.1', port=0, seed=None, **overrides):
+        self.upstream = upstream
+        self.settings = resolve_profile(profile, **overrides)
+        self.profile = profile if isinstance(profile, str) else "custom"
+        self.random = random.Random(seed)
+        self.bucket = TokenBucket(self.settings['rate_kbps'] * 1024)
+        self.stats = {"connections": 0, "dropped": 0, "stalls": 0, "bytes_up": 0, "bytes_down": 0}
+
+        self._lock = threading.Lock()
+        self._links = set()
+        self._server = socket.create_server((host, port))
+        self.host, self.port = self._server.getsockname()[:2]
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+            try:
+                upstream = socket.create_connection(self.upstream, timeout=10)
+                upstream.settimeout(None)
+            except OSError:
+                client.close()
+                continue
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            link = _Link(self, client, upstream)
+            with self._lock:
+                self._links.add(link)
+                self.stats["connections"] += 1
+            link.start()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _forget(self, link):
+        with self._lock:
+            self._links.discard(link)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def close(self):
+        try:
+            self._server.close()
+        except OSError:
+            pass
+        with self._lock:
+            links = list(self._links)
+        for link in links:
+            link.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="模擬不良網路的本機TCP代理")
+    parser.add_argument("--upstream", default="127.0.0.1:9000", help="被代理的服務器（host:port）")
+    parser.add_argument("--host", default="127.0.0.1", help="代理監聽位址")
+    parser.add_argument("--port", type=int, default=9100, help="代理監聽埠")
+    parser.add_argument("--profile", default="3g", choices=sorted(PROFILES), help="網路狀況")
+    parser.add_argument("--rtt-ms", type=int, help="覆寫來回延遲（毫秒）")
+    parser.add_argument("--jitter-ms", type=int, help="覆寫抖動（毫秒）")
+    parser.add_argument("--rate-kbps", type=int, help="覆寫下行頻寬上限（KB/s）")
+    parser.add_argument("--stall-every-kb", type=int, help="覆寫停頓間隔（KB）")
+    parser.add_argument("--stall-ms", type=int, help="覆寫停頓時間（毫秒）")
+    parser.add_argument("--drop-every-kb", type=int, help="覆寫連線中斷間隔（KB）")
+    parser.add_argument("--seed", type=int, help="隨機種子（固定時可重現相同的抖動、停頓與中斷位置）")
+    args = parser.parse_args()
+
+    proxy = NetemProxy(
+        parse_address(args.upstream), args.profile, host=args.host, port=args.port, seed=args.seed,
+        rtt_ms=args.rtt_ms, jitter_ms=args.jitter_ms, rate_kbps=args.rate_kbps,
+        stall_every_kb=args.stall_every_kb, stall_ms=args.stall_ms, drop_every_kb=args.drop_every_kb
+    ).start()
+
+    print(f"網路狀況代理 {proxy.url} -> {args.upstream}（{args.profile}）")
+    print(f"設定: {proxy.settings}")
+    print(f"下載測試: curl -o /dev/null {proxy.url}/updates/v1.1.0.tar.gz")
+    print("按 Ctrl+C 停止")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"\n連線統計: {proxy.snapshot()}")
+        proxy.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
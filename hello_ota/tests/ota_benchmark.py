@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+OTA Pipeline Benchmark - OTA更新流程各階段的效能基準
+
+以合成的版本目錄（預設 1 MB、50 MB、500 MB）量測建立更新包、檢查更新、下載、
+驗證、解壓縮、備份與切換版本的耗時。更新包由本機的模擬更新服務器提供。
+結果與儲存的JSON基準比較，任一階段退步超過門檻時以非零結束碼回報。
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+from pathlib import Path
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+TESTS_DIR = Path(__file__).resolve().parent
+APP_DIR = TESTS_DIR.parent / "app"
+UPDATES_DIR = TESTS_DIR.parent / "updates"
+for path in (APP_DIR, UPDATES_DIR, TESTS_DIR):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+STAGES = ("create_package", "check", "download", "verify", "extract", "backup", "swap")
+DEFAULT_SIZES_MB = (1, 50, 500)
+DEFAULT_BASELINE = TESTS_DIR / "benchmark_baseline.json"
+
+# 填充模組的單檔大小；內容為隨機資料的base64註解，壓縮後仍接近原大小
+BLOB_FILE_SIZE = 8 * 1024 * 1024
+# 應用程式模組最多佔合成版本大小的 1/APP_SHARE
+APP_SHARE = 4
+
+def size_key(size_mb):
+    return f"{size_mb:g}MB"
+
+def build_release_tree(target, size_bytes):
+    """建立合成版本目錄：實際的應用程式模組，加上填充到指定大小的模組
+
+    應用程式模組最多佔指定大小的四分之一（main.py 一定包含），其餘為幾乎無法壓縮的填充，
+    應用程式隨版本增長時更新包大小不會跟著變小。
+    """
+    target = Path(target)
+    target.mkdir(parents=True)
+    budget = size_bytes // APP_SHARE
+    sources = sorted(APP_DIR.glob("*.py"), key=lambda source: (source.name != "main.py", source.name))
+    for source in sources:
+        if source.name != "main.py" and source.stat().st_size > budget:
+            continue
+        shutil.copy2(source, target / source.name)
+        budget -= source.stat().st_size
+
+    remaining = size_bytes - sum(f.stat().st_size for f in target.glob("*.py"))
+    index = 0
+    while remaining > 0:
+        file_size = min(BLOB_FILE_SIZE, remaining)
+        # base64.encodebytes 每76個字元換行，加上 "# " 前綴成為註解
+        lines = base64.encodebytes(os.urandom(file_size * 57 // 79 + 57)).splitlines()
+        content = b"".join(b"# " + line + b"\n" for line in lines)[:file_size]
+        content = content[:content.rfind(b"\n") + 1] or b"\n"
+        with open(target / f"blob_{index:03d}.py", 'wb') as f:
+            f.write(content)
+        remaining -= len(content)
+        index += 1
+    return target
+
+class BenchmarkServer:
+    """在背景線程執行的模擬更新服務器"""
+
+    def __init__(self):
+        from http.server import ThreadingHTTPServer
+        from mock_server import MockUpdateServerHandler
+
+        self.handler = type("BenchmarkHandler", (MockUpdateServerHandler,), {"quiet": True})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def serve_from(self, updates_dir):
+        self.handler.updates_dir = Path(updates_dir)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class PipelineBenchmark:
+    """對每個大小的合成版本執行完整的OTA流程，記錄各階段耗時的中位數"""
+
+    def __init__(self, work_dir, repeat=1):
+        self.work_dir = Path(work_dir)
+        self.repeat = repeat
+
+    def run(self, sizes_mb=DEFAULT_SIZES_MB):
+        # 延遲匯入的模組先載入，第一個大小的量測才不含匯入時間
+        import tarfile
+        import requests
+
+        server = BenchmarkServer()
+        try:
+            results = {size_key(size_mb): self._run_size(server, size_mb) for size_mb in sizes_mb}
+        finally:
+            server.close()
+
+        return {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count()
+            },
+            "repeat": self.repeat,
+            "results": results
+        }
+
+    def _run_size(self, server, size_mb):
+        size_dir = self.work_dir / size_key(size_mb)
+        if size_dir.exists():
+            shutil.rmtree(size_dir)
+        source = build_release_tree(size_dir / "source", int(size_mb * 1024 * 1024))
+        tree_bytes = sum(f.stat().st_size for f in source.iterdir())
+
+        timings = {stage: [] for stage in STAGES}
+        package_bytes = None
+        for run in range(self.repeat):
+            run_dir = size_dir / f"run-{run}"
+            try:
+                stage_times, package_bytes = self._run_pipeline(server, source, run_dir)
+            finally:
+                shutil.rmtree(run_dir, ignore_errors=True)
+            for stage, seconds in stage_times.items():
+                timings[stage].append(seconds)
+
+        shutil.rmtree(size_dir, ignore_errors=True)
+        return {
+            "tree_bytes": tree_bytes,
+            "package_bytes": package_bytes,
+            "stages": {stage: round(statistics.median(values), 4) for stage, values in timings.items()}
+        }
+
+    def _run_pipeline(self, server, source, run_dir):
+        import version
+        from config import config
+        from ota_manager import OTAManager
+        from release_slots import ReleaseManager
+        from create_update import UpdatePackageCreator
+
+        times = {}
+
+        def timed(stage, function, *args):
+            start_time = time.perf_counter()
+            result = function(*args)
+            times[stage] = time.perf_counter() - start_time
+            return result
+
+        updates_dir = run_dir / "updates"
+        updates_dir.mkdir(parents=True)
+        with redirect_stdout(io.StringIO()):
+            package_file, _ = timed(
+                "create_package", UpdatePackageCreator().create_update_package, "1.1.0", source, updates_dir
+            )
+        server.serve_from(updates_dir)
+
+        # 目前版本為平舖安裝的 1.0.0，備份時複製整個目錄
+        installed = run_dir / "installed"
+        shutil.copytree(source, installed)
+
+        ota_manager = OTAManager()
+        ota_manager.app_dir = installed
+        ota_manager.temp_dir = run_dir / "tmp"
+        ota_manager.backup_dir = run_dir / "backup"
+
+        original_get = config.get
+        overrides = {'ota.update_server': server.url}
+        with patch.object(config, 'get', lambda key, default=None: overrides.get(
+                key, original_get(key, default))), patch.object(version, '__version__', "1.0.0"):
+            update_info = timed("check", ota_manager.check_for_updates)
+            if not update_info:
+                raise Exception("模擬更新服務器沒有回報更新")
+
+            update_file = run_dir / "update.tar.gz"
+
+            def download():
+                ota_manager._download_with_progress(update_info['download_url'], update_file)
+                ota_manager._finish_write_session()
+            timed("download", download)
+
+            if not timed("verify", ota_manager._verify_checksum, update_file, update_info['checksum']):
+                raise Exception("更新包校驗失敗")
+
+            extract_dir = run_dir / "extract"
+
+            def extract():
+                ota_manager._extract_update(update_file, extract_dir)
+                ota_manager._finish_write_session()
+            timed("extract", extract)
+
+            timed("backup", ota_manager._backup_current_version)
+
+            # 切換：新版本放入槽位（rename）並切換 current 連結
+            releases = ReleaseManager(run_dir / "slots")
+            current = run_dir / "current-src"
+            current.mkdir()
+            (current / "main.py").write_text("VERSION = '1.0.0'\n")
+            releases.stage("1.0.0", current)
+            releases.activate("1.0.0")
+            new_app_dir = ota_manager._find_app_dir(extract_dir)
+
+            def swap():
+                releases.stage("1.1.0", new_app_dir)
+                releases.activate("1.1.0")
+            timed("swap", swap)
+
+        return times, package_file.stat().st_size
+
+def compare_with_baseline(report, baseline, threshold=0.2, min_delta=0.005):
+    """找出比基準慢超過 threshold 比例（且至少 min_delta 秒）的階段"""
+    regressions = []
+    for size, result in report['results'].items():
+        base_stages = baseline.get('results', {}).get(size, {}).get('stages', {})
+        for stage, seconds in result['stages'].items():
+            base = base_stages.get(stage)
+            if base is None:
+                continue
+            if seconds > base * (1 + threshold) and seconds - base > min_delta:
+                regressions.append({
+                    "size": size,
+                    "stage": stage,
+                    "baseline_seconds": base,
+                    "current_seconds": seconds,
+                    "change_percent": round((seconds - base) / base * 100, 1) if base else None
+                })
+    return regressions
+
+def format_table(report):
+    """以表格列出各大小、各階段的耗時"""
+    sizes = list(report['results'])
+    lines = ["階段".ljust(16) + "".join(size.rjust(12) for size in sizes)]
+    for stage in STAGES:
+        lines.append(stage.ljust(16) + "".join(
+            f"{report['results'][size]['stages'][stage] * 1000:10.1f}ms" for size in sizes
+        ))
+    return "\n".join(lines)
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="OTA更新流程各階段的效能基準")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES_MB),
+                        help="合成版本大小（MB，以逗號分隔）")
+    parser.add_argument("--repeat", type=int, default=3, help="每個大小重複次數（取中位數）")
+    parser.add_argument("--work-dir", help="工作目錄（預設使用暫存目錄）")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="基準JSON檔案")
+    parser.add_argument("--update-baseline", action="store_true", help="以本次結果更新基準")
+    parser.add_argument("--threshold", type=float, default=0.2, help="視為退步的變慢比例")
+    parser.add_argument("--output", help="報告輸出檔案（預設輸出到stdout）")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    sizes = [float(size) for size in args.sizes.split(',')]
+
+    work_dir = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="ota-benchmark-"))
+    try:
+        report = PipelineBenchmark(work_dir, repeat=args.repeat).run(sizes)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline_file = Path(args.baseline)
+    report['regressions'] = []
+    if baseline_file.exists() and not args.update_baseline:
+        with open(baseline_file, 'r', encoding='utf-8') as f:
+            report['regressions'] = compare_with_baseline(report, json.load(f), args.threshold)
+        report['baseline'] = str(baseline_file)
+        report['threshold'] = args.threshold
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    print(format_table(report), file=sys.stderr)
+
+    if args.update_baseline:
+        with open(baseline_file, 'w', encoding='utf-8') as f:
+            json.dump({key: report[key] for key in ("created_at", "environment", "repeat", "results")},
+                      f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"已更新基準: {baseline_file}", file=sys.stderr)
+
+    for regression in report['regressions']:
+        print(
+            f"退步: {regression['size']} {regression['stage']} "
+            f"{regression['baseline_seconds'] * 1000:.1f}ms -> {regression['current_seconds'] * 1000:.1f}ms "
+            f"(+{regression['change_percent']}%)",
+            file=sys.stderr
+        )
+    return 1 if report['regressions'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
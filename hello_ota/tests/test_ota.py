@@ -20,6 +20,11 @@ sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
 
 from ota_manager import OTAManager
 from config import Config
+from update_history import UpdateHistory
+from release_slots import ReleaseManager
+from log_pipeline import (
+    CompressingRotatingFileHandler, CallSiteRateLimitFilter, ProgressThrottle, setup_queue_logging
+)
 import requests
 
 class TestOTAManager(unittest.TestCase):
@@ -78,7 +83,7 @@ class TestOTAManager(unittest.TestCase):
         self.ota_manager.app_dir = mock_app_dir
 
         # 執行備份
-        with patch('hello_ota.app.version.__version__', '1.0.0'):
+        with patch('version.__version__', '1.0.0'):
             self.ota_manager._backup_current_version()
 
         # 檢查備份是否存在
@@ -140,6 +145,2657 @@ class TestOTAManager(unittest.TestCase):
 
         self.assertIn("校驗失敗", str(context.exception))
 
+class TestUpdateHistory(unittest.TestCase):
+    """更新歷史記錄測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.journal_file = self.temp_dir / "update_history.jsonl"
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _record(self, version, status="completed", timestamp="2025-01-20T10:00:00"):
+        return {"timestamp": timestamp, "version": version, "status": status, "details": {}}
+
+    def test_append_and_recent(self):
+        """測試追加記錄與記憶體尾端快取"""
+        history = UpdateHistory(self.journal_file)
+        for i in range(10):
+            history.append(self._record(f"1.0.{i}"))
+
+        recent = history.recent(5)
+        self.assertEqual([r['version'] for r in recent], [f"1.0.{i}" for i in range(5, 10)])
+
+        # 日誌檔為每行一筆
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), 10)
+
+        # 重新載入後尾端快取相同
+        reloaded = UpdateHistory(self.journal_file)
+        self.assertEqual(reloaded.recent(5), recent)
+
+    def test_query_filters_and_pagination(self):
+        """測試依版本、狀態、時間篩選與分頁"""
+        history = UpdateHistory(self.journal_file)
+        history.append(self._record("1.1.0", "completed", "2025-01-01T00:00:00"))
+        history.append(self._record("1.2.0", "failed", "2025-02-01T00:00:00"))
+        history.append(self._record("1.2.0", "completed", "2025-03-01T00:00:00"))
+        history.append(self._record("1.3.0", "completed", "2025-04-01T00:00:00"))
+
+        result = history.query(version="1.2.0")
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(result['records'][0]['status'], "completed")  # 新的在前
+
+        result = history.query(status="failed")
+        self.assertEqual([r['version'] for r in result['records']], ["1.2.0"])
+
+        result = history.query(since="2025-02-15T00:00:00", until="2025-12-31T00:00:00")
+        self.assertEqual([r['version'] for r in result['records']], ["1.3.0", "1.2.0"])
+
+        # 含時區的查詢時間與未含時區（本機時間）的記錄可以比較
+        result = history.query(since="2025-02-15T00:00:00Z", until="2025-12-31T00:00:00+08:00")
+        self.assertEqual([r['version'] for r in result['records']], ["1.3.0", "1.2.0"])
+        with self.assertRaises(Exception):
+            history.query(since="last week")
+
+        result = history.query(offset=1, limit=2)
+        self.assertEqual(result['total'], 4)
+        self.assertEqual([r['timestamp'][:7] for r in result['records']], ["2025-03", "2025-02"])
+
+    def test_compaction_keeps_retention(self):
+        """測試壓縮只保留設定的筆數"""
+        history = UpdateHistory(self.journal_file, retention=5)
+        for i in range(11):
+            history.append(self._record(f"1.0.{i}"))
+
+        history.compact()
+
+        records = history.all()
+        self.assertEqual(len(records), 5)
+        self.assertEqual(records[-1]['version'], "1.0.10")
+
+    def test_migrate_legacy_and_skip_corrupt_line(self):
+        """測試轉換舊版JSON陣列並略過損毀行"""
+        legacy_file = self.temp_dir / "update_history.json"
+        with open(legacy_file, 'w') as f:
+            json.dump([self._record("1.0.0"), self._record("1.1.0")], f)
+
+        history = UpdateHistory(self.journal_file, legacy_file=legacy_file)
+        self.assertFalse(legacy_file.exists())
+        self.assertEqual(len(history.all()), 2)
+
+        # 模擬斷電造成的不完整行
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write('{"timestamp": "2025-')
+
+        reloaded = UpdateHistory(self.journal_file)
+        self.assertEqual([r['version'] for r in reloaded.recent(5)], ["1.0.0", "1.1.0"])
+
+        # 不完整行已截除，新記錄可正常追加
+        reloaded.append(self._record("1.2.0"))
+        self.assertEqual([r['version'] for r in reloaded.all()], ["1.0.0", "1.1.0", "1.2.0"])
+
+class TestFlashIO(unittest.TestCase):
+    """SD卡友善寫入層測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        self.temp_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def test_aligned_writes_and_preallocation(self):
+        """測試以對齊區塊寫入，預先配置多出的空間會被截斷"""
+        from flash_io import FlashWriteSession, ALIGNMENT
+
+        session = FlashWriteSession(buffer_size=16 * 1024)
+        data = os.urandom(50 * 1024 + 123)
+        target = self.temp_dir / "update.bin"
+
+        write_sizes = []
+        real_write = os.write
+
+        def recording_write(fd, chunk):
+            write_sizes.append(len(chunk))
+            return real_write(fd, chunk)
+
+        with patch('os.write', side_effect=recording_write):
+            with session.open(target, size=len(data) * 2) as f:
+                for i in range(0, len(data), 1000):
+                    f.write(data[i:i + 1000])
+
+        self.assertEqual(target.read_bytes(), data)
+        # 除了最後一次，每次寫入都是對齊的大區塊
+        self.assertTrue(all(size % ALIGNMENT == 0 and size >= 16 * 1024 for size in write_sizes[:-1]))
+        self.assertLess(len(write_sizes), 10)
+
+        session.commit()
+        report = session.report()
+        self.assertEqual(report['bytes_written'], len(data))
+        self.assertEqual(report['files_written'], 1)
+        self.assertGreaterEqual(report['fsync_count'], 2)  # 檔案與目錄項目
+
+    def test_extract_tar_rejects_path_traversal(self):
+        """測試解壓縮拒絕目標目錄之外的路徑"""
+        import io
+        import tarfile
+        from flash_io import FlashWriteSession
+
+        archive = self.temp_dir / "evil.tar.gz"
+        with tarfile.open(archive, "w:gz") as tar:
+            for name, content in (("app/main.py", b"ok"), ("../evil.py", b"bad")):
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+
+        session = FlashWriteSession()
+        with tarfile.open(archive, "r:gz") as tar:
+            with self.assertRaises(Exception) as context:
+                session.extract_tar(tar, self.temp_dir / "out")
+
+        self.assertIn("不安全", str(context.exception))
+        self.assertEqual((self.temp_dir / "out" / "app" / "main.py").read_bytes(), b"ok")
+        self.assertFalse((self.temp_dir / "evil.py").exists())
+
+    def test_atomic_write_json(self):
+        """測試JSON檔原子性寫入並同步目錄，寫入失敗時保留原內容且不留下暫存檔"""
+        from flash_io import atomic_write_json
+
+        target = self.temp_dir / "state.json"
+        with patch('flash_io.fsync_dir', return_value=True) as fsync_dir:
+            atomic_write_json(target, {"version": "1.1.0"})
+        fsync_dir.assert_called_once_with(self.temp_dir)
+        self.assertEqual(json.loads(target.read_text()), {"version": "1.1.0"})
+
+        with self.assertRaises(TypeError):
+            atomic_write_json(target, {"version": object()})
+        self.assertEqual(json.loads(target.read_text()), {"version": "1.1.0"})
+        self.assertEqual(list(self.temp_dir.iterdir()), [target])
+
+class TestMemoryBudget(unittest.TestCase):
+    """OTA記憶體預算與各階段峰值量測測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        self.temp_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def test_tmpfs_headroom_decision(self):
+        """測試tmpfs餘裕不足或大小未知時不放在記憶體中"""
+        from memory_budget import fits_in_memory_filesystem
+
+        mb = 1024 * 1024
+        with patch('memory_budget.memory_backed_headroom', return_value=100 * mb):
+            self.assertTrue(fits_in_memory_filesystem("/tmp", 10 * mb, reserve=64 * mb))
+            self.assertFalse(fits_in_memory_filesystem("/tmp", 50 * mb, reserve=64 * mb))
+            self.assertFalse(fits_in_memory_filesystem("/tmp", 0, reserve=64 * mb))
+
+        # 不在tmpfs上一律可用
+        with patch('memory_budget.memory_backed_headroom', return_value=None):
+            self.assertTrue(fits_in_memory_filesystem("/tmp", 10 ** 12, reserve=64 * mb))
+
+    def test_stage_profiler_records_peaks(self):
+        """測試各階段記錄RSS與Python配置峰值"""
+        from memory_budget import StageMemoryProfiler
+
+        profiler = StageMemoryProfiler()
+        with profiler.stage("download"):
+            buffer = bytearray(8 * 1024 * 1024)
+            del buffer
+        with profiler.stage("verify"):
+            pass
+
+        report = profiler.report()
+        self.assertEqual(list(report), ["download", "verify"])
+        self.assertGreaterEqual(report['download']['python_peak_kb'], 8 * 1024)
+        self.assertLess(report['verify']['python_peak_kb'], 1024)
+        if report['download']['rss_peak_kb'] is not None:
+            self.assertGreater(report['download']['rss_peak_kb'], 0)
+
+    def test_stage_profiler_merges_repeated_stages(self):
+        """測試同一階段進入多次時峰值取最大、耗時相加"""
+        from memory_budget import StageMemoryProfiler
+
+        profiler = StageMemoryProfiler()
+        with profiler.stage("extract"):
+            buffer = bytearray(8 * 1024 * 1024)
+            del buffer
+        first = dict(profiler.report()['extract'])
+        with profiler.stage("extract"):
+            time.sleep(0.05)
+        second = profiler.stages['extract']
+
+        self.assertGreaterEqual(second['python_peak_kb'], 8 * 1024)
+        self.assertEqual(second['python_peak_kb'], first['python_peak_kb'])
+        self.assertGreaterEqual(second['duration_ms'], first['duration_ms'] + 50)
+
+    @patch('requests.get')
+    def test_download_moves_to_disk_and_reports_stages(self, mock_get):
+        """測試tmpfs空間不足時下載到磁碟，並記錄下載與驗證階段"""
+        import hashlib
+
+        content = b"x" * 1000
+        mock_response = MagicMock()
+        mock_response.headers = {'content-length': str(len(content))}
+        mock_response.iter_content.return_value = [content]
+        mock_get.return_value = mock_response
+
+        ota_manager = OTAManager()
+        ota_manager.app_dir = self.temp_dir / "hello-ota"
+        ota_manager.temp_dir = self.temp_dir / "tmp"
+        ota_manager.history = UpdateHistory(self.temp_dir / "history.jsonl")
+
+        with patch('ota_manager.fits_in_memory_filesystem', return_value=False):
+            update_file = ota_manager.download_update({
+                "version": "1.1.0",
+                "size": len(content),
+                "download_url": "http://example.com/v1.1.0.tar.gz",
+                "checksum": hashlib.sha256(content).hexdigest()
+            })
+
+        self.assertEqual(update_file, ota_manager.releases.staging_package("1.1.0"))
+        self.assertEqual(update_file.read_bytes(), content)
+
+        memory = ota_manager._finish_memory_profile()
+        self.assertEqual(set(memory), {"download", "verify"})
+
+        ota_manager.history.append({"version": "1.1.0", "status": "completed", "memory": memory})
+        status = ota_manager.memory_status()
+        self.assertEqual(status['last_update']['stages'], memory)
+
+class TestLogPipeline(unittest.TestCase):
+    """日誌管線測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        self.temp_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def test_rotation_compresses_archives(self):
+        """測試依大小輪替並壓縮封存檔"""
+        import gzip
+        import logging
+
+        log_file = self.temp_dir / "hello-ota.log"
+        handler = CompressingRotatingFileHandler(log_file, max_bytes=1024, backup_count=2)
+        test_logger = logging.getLogger("test.rotation")
+        test_logger.propagate = False
+        test_logger.addHandler(handler)
+
+        try:
+            for i in range(200):
+                test_logger.warning(f"記錄 {i:04d} " + "x" * 40)
+        finally:
+            test_logger.removeHandler(handler)
+            handler.close()
+
+        archives = sorted(self.temp_dir.glob("hello-ota.log.*.gz"))
+        self.assertEqual(len(archives), 2)
+        with gzip.open(archives[0], 'rt', encoding='utf-8') as f:
+            self.assertIn("記錄", f.read())
+        self.assertLessEqual(log_file.stat().st_size, 1024)
+
+    def test_rate_limit_per_call_site(self):
+        """測試同一呼叫位置在間隔內只放行一筆"""
+        import logging
+
+        rate_filter = CallSiteRateLimitFilter(interval=60)
+
+        def make_record(lineno, level=logging.INFO):
+            return logging.LogRecord("test", level, "ota_manager.py", lineno, "msg", None, None)
+
+        passed = [rate_filter.filter(make_record(10)) for _ in range(100)]
+        self.assertEqual(passed.count(True), 1)
+
+        # 不同位置各自計算
+        self.assertTrue(rate_filter.filter(make_record(20)))
+
+        # 警告以上不受限制
+        self.assertTrue(rate_filter.filter(make_record(10, logging.ERROR)))
+
+    def test_progress_throttle(self):
+        """測試下載進度只在前進足夠百分比時回報"""
+        throttle = ProgressThrottle(step_percent=10, interval=3600)
+        total = 50 * 1024 * 1024
+        reports = sum(
+            1 for done in range(8192, total + 1, 8192)
+            if throttle.should_report(done, total)
+        )
+        self.assertLessEqual(reports, 12)
+        self.assertGreaterEqual(reports, 10)
+
+    def test_queue_logging_writes_in_background(self):
+        """測試佇列日誌由背景listener寫出"""
+        import logging
+
+        log_file = self.temp_dir / "queued.log"
+        root = logging.getLogger()
+        saved_handlers, saved_level = root.handlers[:], root.level
+
+        listener = setup_queue_logging(logging.INFO, [logging.FileHandler(log_file)])
+        try:
+            logging.getLogger("test.queue").info("背景寫入")
+        finally:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+            root.handlers[:] = saved_handlers
+            root.setLevel(saved_level)
+
+        with open(log_file, 'r', encoding='utf-8') as f:
+            self.assertIn("背景寫入", f.read())
+
+    def test_queue_logging_limits_only_progress_and_flushes_on_stop(self):
+        """測試只有進度日誌器受限流，停止時寫出被略過的最後一筆"""
+        import logging
+        from log_pipeline import PROGRESS_LOGGER
+
+        log_file = self.temp_dir / "queued.log"
+        root = logging.getLogger()
+        saved_handlers, saved_level = root.handlers[:], root.level
+
+        listener = setup_queue_logging(logging.INFO, [logging.FileHandler(log_file)], rate_limit_interval=60)
+        try:
+            for i in range(3):
+                logging.getLogger("test.queue").info(f"請求 {i}")
+            for percent in (10, 20, 30):
+                logging.getLogger(PROGRESS_LOGGER).info(f"下載進度: {percent}%")
+        finally:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+            root.handlers[:] = saved_handlers
+            root.setLevel(saved_level)
+
+        with open(log_file, 'r', encoding='utf-8') as f:
+            lines = [line.split(" - ", 3)[3] for line in f.read().splitlines()]
+        self.assertEqual(lines[:3], ["請求 0", "請求 1", "請求 2"])
+        self.assertEqual(lines[3:], ["下載進度: 10%", "下載進度: 30% (略過 1 筆重複訊息)"])
+
+class TestStartup(unittest.TestCase):
+    """冷啟動測試"""
+
+    APP_DIR = Path(__file__).parent.parent / "app"
+
+    def test_import_main_has_no_side_effects(self):
+        """測試匯入main不會載入requests或建立全域實例"""
+        code = (
+            f"import sys; sys.path.insert(0, {str(self.APP_DIR)!r}); import main, config; "
+            "print('requests' in sys.modules, main.app is None, config.config._instance is None)"
+        )
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.split(), ["False", "True", "True"])
+
+    def test_import_timer_records_modules(self):
+        """測試匯入計時器記錄模組匯入時間"""
+        from startup_profiler import StartupProfiler
+
+        profiler = StartupProfiler()
+        profiler.import_timer.install()
+        try:
+            sys.modules.pop('colorsys', None)
+            import colorsys  # noqa: F401
+        finally:
+            profiler.import_timer.uninstall()
+
+        with profiler.phase("noop"):
+            pass
+        profiler.mark("done")
+
+        report = profiler.report()
+        self.assertIn("colorsys", report['slowest_imports'])
+        self.assertIn("noop", report['phases_ms'])
+        self.assertIn("done", report['marks_ms'])
+
+class TestReleaseSlots(unittest.TestCase):
+    """版本槽位測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.base_dir = self.temp_dir / "hello-ota"
+        self.base_dir.mkdir()
+        self.releases = ReleaseManager(self.base_dir)
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _make_release(self, version):
+        source = self.temp_dir / f"src-{version}"
+        source.mkdir()
+        with open(source / "main.py", 'w') as f:
+            f.write(f"VERSION = '{version}'")
+        return self.releases.stage(version, source)
+
+    def test_running_process_imports_from_its_own_slot(self):
+        """測試以 current 啟動的行程固定使用啟動時的槽位，切換 current 後延遲匯入仍來自原版本"""
+        import shutil
+
+        app_source = Path(__file__).parent.parent / "app"
+        for version in ("1.0.0", "1.1.0"):
+            source = self.temp_dir / f"src-{version}"
+            shutil.copytree(app_source, source, ignore=shutil.ignore_patterns("__pycache__"))
+            self.releases.stage(version, source)
+        self.releases.activate("1.0.0")
+
+        current = self.base_dir / "current"
+        code = (
+            f"import sys; sys.path.insert(0, {str(current)!r}); import main; "
+            "from release_slots import ReleaseManager; "
+            f"ReleaseManager({str(self.base_dir)!r}).activate('1.1.0'); "
+            "import updater; print(updater.__file__)"
+        )
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+
+        self.assertEqual(self.releases.current_version(), "1.1.0")
+        self.assertEqual(Path(result.stdout.strip()).parent, self.releases.release_dir("1.0.0").resolve())
+
+    def test_activate_and_rollback(self):
+        """測試切換與回滾只改變符號連結"""
+        self._make_release("1.0.0")
+        self._make_release("1.1.0")
+
+        self.releases.activate("1.0.0")
+        self.releases.activate("1.1.0")
+        self.assertEqual(self.releases.current_version(), "1.1.0")
+        self.assertEqual(self.releases.previous_version(), "1.0.0")
+        self.assertEqual(
+            (self.base_dir / "current" / "main.py").read_text(), "VERSION = '1.1.0'"
+        )
+
+        self.releases.rollback()
+        self.assertEqual(self.releases.current_version(), "1.0.0")
+        self.assertEqual(self.releases.previous_version(), "1.1.0")
+
+    def test_migrate_legacy_layout(self):
+        """測試平鋪安裝轉換為槽位結構"""
+        with open(self.base_dir / "main.py", 'w') as f:
+            f.write("legacy")
+
+        self.releases.migrate_legacy("1.0.0")
+
+        self.assertTrue(self.releases.is_slot_layout())
+        self.assertEqual((self.base_dir / "current" / "main.py").read_text(), "legacy")
+        self.assertIn("current", (self.base_dir / "main.py").read_text())
+
+    def test_collect_garbage_keeps_current_and_previous(self):
+        """測試清理舊槽位時保留 current 與 previous"""
+        for i in range(5):
+            self._make_release(f"1.{i}.0")
+            self.releases.activate(f"1.{i}.0")
+            os.utime(self.releases.release_dir(f"1.{i}.0"), (i, i))
+
+        removed = self.releases.collect_garbage(keep=2)
+
+        self.assertEqual(removed, ["1.0.0", "1.1.0"])
+        self.assertEqual(self.releases.list_releases(), ["1.2.0", "1.3.0", "1.4.0"])
+
+    def test_collect_garbage_keeps_staging_of_versions_in_use(self):
+        """測試清理暫存項目時保留目前、下載中與等待套用版本的暫存項目"""
+        self._make_release("1.0.0")
+        self.releases.activate("1.0.0")
+
+        kept = [
+            self.releases.staging_dir("1.0.0"),
+            self.releases.staging_archive("1.1.0"),
+            self.releases.releases_dir / ".staging-1.1.0-core",
+            self.releases.releases_dir / ".staging-1.1.0-core.chunks",
+            self.releases.releases_dir / ".staging-1.1.0.pyz.chunks.x1y2.tmp",
+            self.releases.staging_package("1.1.0")
+        ]
+        stale = [
+            self.releases.staging_dir("0.9.0"),
+            self.releases.releases_dir / ".staging-0.9.0-core.chunks",
+            self.releases.staging_archive("1.1.0.1")
+        ]
+        for path in kept + stale:
+            if path.name in (".staging-1.0.0", ".staging-0.9.0"):
+                path.mkdir()
+            else:
+                path.write_bytes(b"partial")
+
+        self.releases.collect_garbage(in_use=lambda: {"1.1.0"})
+
+        for path in kept:
+            self.assertTrue(path.exists(), path.name)
+        for path in stale:
+            self.assertFalse(path.exists(), path.name)
+
+    def _make_package(self, version, extra_files=None):
+        """以目前的app原始碼建立指定版本的更新包"""
+        import shutil
+        import tarfile
+
+        package_dir = self.temp_dir / "package" / f"v{version}" / "app"
+        package_dir.mkdir(parents=True)
+        for source in (Path(__file__).parent.parent / "app").glob("*.py"):
+            shutil.copy2(source, package_dir)
+        with open(package_dir / "version.py", 'w') as f:
+            f.write(
+                f'__version__ = "{version}"\n'
+                'def get_version_info():\n'
+                '    return {"version": __version__}\n'
+            )
+        for name, content in (extra_files or {}).items():
+            with open(package_dir / name, 'w') as f:
+                f.write(content)
+
+        update_file = self.temp_dir / f"v{version}.tar.gz"
+        with tarfile.open(update_file, "w:gz") as tar:
+            tar.add(package_dir.parent, arcname=f"v{version}")
+        shutil.rmtree(self.temp_dir / "package")
+        return update_file
+
+    def _make_ota_manager(self):
+        ota_manager = OTAManager()
+        ota_manager.app_dir = self.base_dir
+        ota_manager.update_script = self.temp_dir / "updater.py"
+        ota_manager.backup_dir = self.temp_dir / "backup"
+        ota_manager.history = UpdateHistory(self.temp_dir / "history.jsonl")
+        return ota_manager
+
+    def test_apply_update_stages_into_slot(self):
+        """測試套用更新時解壓縮到槽位並產生切換腳本"""
+        update_file = self._make_package("1.1.0")
+
+        self._make_release("1.0.0")
+        self.releases.activate("1.0.0")
+
+        ota_manager = self._make_ota_manager()
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            ota_manager.apply_update(update_file, {"version": "1.1.0"})
+
+        schedule.assert_called_once()
+        release_dir = self.releases.release_dir("1.1.0")
+        self.assertTrue((release_dir / "main.py").exists())
+        self.assertEqual(list(self.releases.releases_dir.glob(".staging-*")), [])
+        # 切換在更新腳本中執行，此時仍為舊版本
+        self.assertEqual(self.releases.current_version(), "1.0.0")
+        script = ota_manager.update_script.read_text()
+        self.assertIn("run_update(PARAMS)", script)
+        self.assertIn("'version': '1.1.0'", script)
+        # 寫入統計隨參數交給更新執行器記錄
+        self.assertIn("'io_stats': {'bytes_written': ", script)
+
+        # 已預先編譯位元組碼
+        self.assertTrue(list((release_dir / "__pycache__").glob("main.*.pyc")))
+
+    def test_apply_update_rejects_broken_package(self):
+        """測試無法匯入的更新包被拒絕且不佔用槽位"""
+        update_file = self._make_package("1.2.0", {"ota_manager.py": "import not_a_real_module\n"})
+
+        ota_manager = self._make_ota_manager()
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            with self.assertRaises(Exception) as context:
+                ota_manager.apply_update(update_file, {"version": "1.2.0"})
+
+        schedule.assert_not_called()
+        self.assertIn("匯入測試失敗", str(context.exception))
+        self.assertFalse(self.releases.release_dir("1.2.0").exists())
+        self.assertEqual(list(self.releases.releases_dir.glob(".staging-*")), [])
+        self.assertEqual(ota_manager.get_update_history(1)[0]['status'], "failed")
+
+    def test_apply_update_rejects_version_mismatch(self):
+        """測試更新包版本與預期不符時拒絕"""
+        update_file = self._make_package("1.3.0")
+
+        ota_manager = self._make_ota_manager()
+        with patch.object(OTAManager, '_schedule_update_handover'):
+            with self.assertRaises(Exception):
+                ota_manager.apply_update(update_file, {"version": "9.9.9"})
+
+        self.assertFalse(self.releases.release_dir("9.9.9").exists())
+
+class TestZipappRelease(unittest.TestCase):
+    """zipapp單一封存檔版本測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        sys.path.insert(0, str(Path(__file__).parent.parent / "updates"))
+        from create_update import UpdatePackageCreator
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.base_dir = self.temp_dir / "hello-ota"
+        self.base_dir.mkdir()
+        self.releases = ReleaseManager(self.base_dir)
+
+        with patch('builtins.print'):
+            self.package_file, info_file = UpdatePackageCreator().create_update_package(
+                "2.0.0", output_dir=self.temp_dir / "out", package_format="zipapp"
+            )
+        with open(info_file, 'r', encoding='utf-8') as f:
+            self.update_info = json.load(f)
+
+        self.ota_manager = OTAManager()
+        self.ota_manager.app_dir = self.base_dir
+        self.ota_manager.update_script = self.temp_dir / "updater.py"
+        self.ota_manager.backup_dir = self.temp_dir / "backup"
+        self.ota_manager.history = UpdateHistory(self.temp_dir / "history.jsonl")
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        sys.path.remove(str(Path(__file__).parent.parent / "updates"))
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _download(self):
+        """模擬下載：將封存檔放到暫存位置"""
+        import shutil
+        staging = self.releases.staging_archive("2.0.0")
+        staging.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(self.package_file, staging)
+        return staging
+
+    def test_zipapp_contains_only_bytecode(self):
+        """測試封存檔只包含pyc與清單"""
+        import zipfile
+
+        self.assertEqual(self.update_info['format'], "zipapp")
+        with zipfile.ZipFile(self.package_file) as archive:
+            names = archive.namelist()
+            manifest = json.loads(archive.read("MANIFEST.json"))
+
+        self.assertIn("__main__.pyc", names)
+        self.assertIn("main.pyc", names)
+        self.assertFalse([n for n in names if n.endswith(".py")])
+        self.assertEqual(manifest['version'], "2.0.0")
+
+    def test_zipapp_runs_without_extraction(self):
+        """測試直接從封存檔匯入並取得版本"""
+        code = "import sys; sys.path.insert(0, sys.argv[1]); import version; print(version.__version__)"
+        result = subprocess.run(
+            [sys.executable, "-I", "-c", code, str(self.package_file)],
+            capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.strip(), "2.0.0")
+
+    def test_apply_zipapp_is_single_rename(self):
+        """測試套用封存檔版本只需rename到槽位"""
+        staging = self._download()
+
+        with patch.object(OTAManager, '_schedule_update_handover'):
+            self.ota_manager.apply_update(staging, self.update_info)
+
+        self.assertFalse(staging.exists())
+        self.assertTrue(self.releases.release_archive("2.0.0").is_file())
+
+        self.releases.activate("2.0.0")
+        self.assertEqual(self.releases.current_version(), "2.0.0")
+        self.assertTrue((self.base_dir / "current").is_file())
+
+    def test_apply_zipapp_rejects_other_python(self):
+        """測試位元組碼版本不符的封存檔被拒絕"""
+        import zipfile
+
+        staging = self._download()
+        with zipfile.ZipFile(staging, 'a') as archive:
+            with patch('warnings.warn'):
+                archive.writestr("MANIFEST.json", json.dumps({"version": "2.0.0", "python_magic": "00000000"}))
+
+        with patch.object(OTAManager, '_schedule_update_handover'):
+            with self.assertRaises(Exception) as context:
+                self.ota_manager.apply_update(staging, self.update_info)
+
+        self.assertIn("Python版本不符", str(context.exception))
+        self.assertIsNone(self.releases.release_path("2.0.0"))
+        self.assertFalse(staging.exists())
+
+class TestBackgroundWorker(unittest.TestCase):
+    """低優先權OTA工作行程測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        import functools
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+        sys.path.insert(0, str(Path(__file__).parent.parent / "updates"))
+        from create_update import UpdatePackageCreator
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.base_dir = self.temp_dir / "hello-ota"
+        self.releases = ReleaseManager(self.base_dir)
+
+        # 目前版本為槽位結構，不需要完整備份
+        current = self.temp_dir / "src-1.0.0"
+        current.mkdir()
+        (current / "main.py").write_text("VERSION = '1.0.0'")
+        self.releases.stage("1.0.0", current)
+        self.releases.activate("1.0.0")
+
+        with patch('builtins.print'):
+            package_file, info_file = UpdatePackageCreator().create_update_package(
+                "1.1.0", output_dir=self.temp_dir / "out"
+            )
+        with open(info_file, 'r', encoding='utf-8') as f:
+            self.update_info = json.load(f)
+
+        # 以本機HTTP服務器提供更新包
+        handler = functools.partial(SimpleHTTPRequestHandler, directory=str(package_file.parent))
+        handler.log_message = lambda *args: None
+        self.file_server = HTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.file_server.serve_forever, daemon=True).start()
+        self.update_info['download_url'] = (
+            f"http://127.0.0.1:{self.file_server.server_port}/{package_file.name}"
+        )
+
+        # 工作行程以相同設定檔啟動
+        config_file = self.temp_dir / "config.json"
+        with open(config_file, 'w') as f:
+            json.dump({
+                "app": {"log_level": "WARNING"},
+                "ota": {"worker_nice": 5},
+                "system": {"data_dir": str(self.temp_dir / "data")}
+            }, f)
+        self.env = patch.dict(os.environ, {"HELLO_OTA_CONFIG": str(config_file)})
+        self.env.start()
+
+        self.ota_manager = OTAManager()
+        self.ota_manager.app_dir = self.base_dir
+        self.ota_manager.temp_dir = self.temp_dir / "tmp"
+        self.ota_manager.update_script = self.temp_dir / "updater.py"
+        self.ota_manager.backup_dir = self.temp_dir / "backup"
+        self.ota_manager.history = UpdateHistory(self.temp_dir / "history.jsonl")
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        self.env.stop()
+        self.file_server.shutdown()
+        self.file_server.server_close()
+        sys.path.remove(str(Path(__file__).parent.parent / "updates"))
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def test_worker_stages_release_at_low_priority(self):
+        """測試工作行程以較低優先權下載並放入槽位，服務行程只負責切換"""
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            self.ota_manager.perform_update(self.update_info)
+
+        schedule.assert_called_once()
+        self.assertTrue((self.releases.release_dir("1.1.0") / "main.py").exists())
+        self.assertEqual(self.releases.current_version(), "1.0.0")
+
+        script = self.ota_manager.update_script.read_text()
+        import ast
+        params = ast.literal_eval(script.split("PARAMS = ", 1)[1].split("\n\n", 1)[0])
+        worker = params['update_info']['worker']
+        self.assertGreaterEqual(worker['priority']['nice'], os.nice(0) + 5)
+        self.assertEqual(set(params['memory_stats']), {"download", "verify", "extract"})
+        self.assertGreater(params['io_stats']['bytes_written'], 0)
+
+    def test_worker_failure_is_recorded(self):
+        """測試工作行程失敗時由服務行程記錄並清除暫存"""
+        self.update_info['checksum'] = "0" * 64
+
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            with self.assertRaises(Exception) as context:
+                self.ota_manager.perform_update(self.update_info)
+
+        schedule.assert_not_called()
+        self.assertIn("校驗失敗", str(context.exception))
+        self.assertEqual(self.ota_manager.get_update_history(1)[0]['status'], "failed")
+        self.assertIsNone(self.releases.release_path("1.1.0"))
+
+    def test_worker_prefetch_then_apply_from_cache(self):
+        """測試工作行程預先下載後，套用時不再經由網路下載"""
+        from update_scheduler import PrefetchCache
+
+        self.ota_manager.prefetch_cache = PrefetchCache(self.temp_dir / "prefetch")
+        self.ota_manager.prefetch_in_background(self.update_info)
+
+        self.assertEqual(self.ota_manager.prefetch_cache.pending()['version'], "1.1.0")
+        self.assertIsNotNone(self.ota_manager.prefetch_cache.get(self.update_info))
+
+        # 更新服務器離線仍可套用
+        self.file_server.shutdown()
+        self.file_server.server_close()
+        self.file_server = MagicMock()
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            self.ota_manager.perform_update(self.update_info)
+
+        schedule.assert_called_once()
+        self.assertTrue((self.releases.release_dir("1.1.0") / "main.py").exists())
+        self.assertIsNone(self.ota_manager.prefetch_cache.pending())
+        self.assertEqual(list((self.temp_dir / "prefetch").iterdir()), [])
+
+    def test_load_budget_pauses_until_load_drops(self):
+        """測試負載超過預算時暫停，並受最長暫停時間限制"""
+        from ota_worker import LoadBudget
+
+        budget = LoadBudget(check_interval=0, pause_interval=0.01, max_pause=5)
+        with patch.object(budget, 'over_budget', side_effect=[True, True, False]):
+            budget.wait()
+        self.assertEqual(budget.pause_count, 1)
+        self.assertGreater(budget.paused_seconds, 0)
+
+        budget = LoadBudget(check_interval=0, pause_interval=0.01, max_pause=0.05)
+        started = time.monotonic()
+        with patch.object(budget, 'over_budget', return_value=True):
+            budget.wait()
+        self.assertLess(time.monotonic() - started, 1)
+
+class TestComponentUpdate(unittest.TestCase):
+    """多元件（程式碼、相依套件、版本設定）交易式更新測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        import functools
+        from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+        sys.path.insert(0, str(Path(__file__).parent.parent / "updates"))
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.base_dir = self.temp_dir / "hello-ota"
+        self.releases = ReleaseManager(self.base_dir)
+
+        current = self.temp_dir / "src-1.0.0"
+        current.mkdir()
+        (current / "main.py").write_text("VERSION = '1.0.0'")
+        self.releases.stage("1.0.0", current)
+        self.releases.activate("1.0.0")
+
+        deps_dir = self.temp_dir / "deps"
+        (deps_dir / "vendored").mkdir(parents=True)
+        (deps_dir / "vendored" / "__init__.py").write_text("NAME = 'vendored-1'\n")
+        config_source = self.temp_dir / "release_config.json"
+        config_source.write_text(json.dumps({"ota": {"check_interval": 42}}))
+
+        self.update_info = self._create_package("1.1.0", deps_dir, config_source)
+
+        # 每個請求延遲 delay 秒，用來確認元件是平行下載
+        self.delay = 0
+
+        class SlowHandler(SimpleHTTPRequestHandler):
+            def do_GET(handler):
+                time.sleep(self.delay)
+                super().do_GET()
+
+            def log_message(handler, *args):
+                pass
+
+        self.file_server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), functools.partial(SlowHandler, directory=str(self.temp_dir / "out"))
+        )
+        threading.Thread(target=self.file_server.serve_forever, daemon=True).start()
+        self._serve(self.update_info)
+
+        config_file = self.temp_dir / "config.json"
+        with open(config_file, 'w') as f:
+            json.dump({
+                "app": {"log_level": "WARNING"},
+                "system": {"data_dir": str(self.temp_dir / "data")}
+            }, f)
+        self.env = patch.dict(os.environ, {"HELLO_OTA_CONFIG": str(config_file)})
+        self.env.start()
+
+        self.ota_manager = OTAManager()
+        self.ota_manager.app_dir = self.base_dir
+        self.ota_manager.temp_dir = self.temp_dir / "tmp"
+        self.ota_manager.update_script = self.temp_dir / "updater.py"
+        self.ota_manager.backup_dir = self.temp_dir / "backup"
+        self.ota_manager.history = UpdateHistory(self.temp_dir / "history.jsonl")
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        self.env.stop()
+        self.file_server.shutdown()
+        self.file_server.server_close()
+        sys.path.remove(str(Path(__file__).parent.parent / "updates"))
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _create_package(self, version, deps_dir, config_source):
+        from create_update import UpdatePackageCreator
+
+        with patch('builtins.print'):
+            _, info_file = UpdatePackageCreator().create_update_package(
+                version, output_dir=self.temp_dir / "out", deps_dir=deps_dir, config_file=config_source
+            )
+        with open(info_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _serve(self, update_info):
+        for component in update_info['components']:
+            component['download_url'] = (
+                f"http://127.0.0.1:{self.file_server.server_port}/{component['filename']}"
+            )
+        update_info['download_url'] = update_info['components'][0]['download_url']
+
+    def _component(self, name):
+        return next(c for c in self.update_info['components'] if c['name'] == name)
+
+    def test_components_staged_into_one_slot(self):
+        """測試所有元件放入同一個槽位，新版本可匯入相依套件並讀到版本設定"""
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            self.ota_manager.perform_update(self.update_info)
+
+        schedule.assert_called_once()
+        self.assertEqual(self.releases.current_version(), "1.0.0")
+        slot = self.releases.release_dir("1.1.0")
+        self.assertEqual(
+            set(self.releases.installed_components("1.1.0")), {"app", "deps", "config"}
+        )
+        self.assertEqual(list(self.releases.releases_dir.glob(".staging-*")), [])
+
+        code = (
+            "import sys; sys.path.insert(0, sys.argv[1]); import main, vendored; "
+            "from config import config; print(vendored.NAME, config.get('ota.check_interval'))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code, str(slot)], capture_output=True, text=True, timeout=30
+        )
+        self.assertEqual(result.stdout.split(), ["vendored-1", "42"], result.stderr)
+
+    def test_unchanged_component_is_carried_over(self):
+        """測試版本未變動的元件沿用目前槽位，不重新下載"""
+        with patch.object(OTAManager, '_schedule_update_handover'):
+            self.ota_manager.perform_update(self.update_info)
+        self.releases.activate("1.1.0")
+
+        # 相依套件與版本設定內容相同，元件版本不變；下載網址無法連線
+        update_info = self._create_package("1.2.0", self.temp_dir / "deps", self.temp_dir / "release_config.json")
+        self._serve(update_info)
+        for component in update_info['components']:
+            self.assertEqual(component['version'], self._component(component['name'])['version']
+                             if component['name'] != "app" else "1.2.0")
+            if component['name'] != "app":
+                component['download_url'] = "http://127.0.0.1:9/unreachable"
+
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            self.ota_manager.perform_update(update_info)
+
+        schedule.assert_called_once()
+        slot = self.releases.release_dir("1.2.0")
+        self.assertEqual((slot / "_deps" / "vendored" / "__init__.py").read_text(), "NAME = 'vendored-1'\n")
+        self.assertEqual(json.loads((slot / "release_config.json").read_text()), {"ota": {"check_interval": 42}})
+
+    def test_failed_component_aborts_whole_update(self):
+        """測試任一元件校驗失敗時整個更新都不套用，也不留下暫存檔"""
+        self._component("deps")['checksum'] = "0" * 64
+
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            with self.assertRaises(Exception) as context:
+                self.ota_manager.perform_update(self.update_info)
+
+        schedule.assert_not_called()
+        self.assertIn("deps", str(context.exception))
+        self.assertEqual(self.ota_manager.get_update_history(1)[0]['status'], "failed")
+        self.assertIsNone(self.releases.release_path("1.1.0"))
+        self.assertEqual(self.releases.current_version(), "1.0.0")
+        self.assertEqual(list(self.releases.releases_dir.glob(".staging-*")), [])
+
+    def test_components_download_in_parallel(self):
+        """測試元件平行下載：總時間接近單一元件而非所有元件相加"""
+        self.delay = 0.3
+
+        started = time.monotonic()
+        files = self.ota_manager.download_update(self.update_info)
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(set(files), {"app", "deps", "config"})
+        self.assertLess(elapsed, self.delay * len(files))
+        for name, path in files.items():
+            self.assertTrue(self.ota_manager._verify_checksum(path, self._component(name)['checksum']))
+        # 所有元件寫入同一個工作階段，寫入統計包含每個元件
+        io_stats = self.ota_manager._finish_write_session()
+        self.assertEqual(io_stats['files_written'], len(files))
+        self.assertEqual(io_stats['bytes_written'], sum(path.stat().st_size for path in files.values()))
+
+class TestUpdateScheduler(unittest.TestCase):
+    """預先下載與延後套用排程測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        import hashlib
+        from update_scheduler import PrefetchCache
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.content = b"prefetched package"
+        self.update_info = {
+            "version": "9.9.9",
+            "download_url": "http://example.com/v9.9.9.tar.gz",
+            "checksum": hashlib.sha256(self.content).hexdigest()
+        }
+        self.cache = PrefetchCache(self.temp_dir / "prefetch")
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _inline(self):
+        """不啟動工作行程，直接在測試行程中執行"""
+        from config import config
+
+        original_get = config.get
+        return patch.object(config, 'get', lambda key, default=None: (
+            False if key == 'ota.background_worker' else original_get(key, default)))
+
+    def _prefetch(self):
+        self.cache.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache.package_path(self.update_info).write_bytes(self.content)
+        self.cache.set_pending(self.update_info)
+
+    def test_maintenance_window(self):
+        """測試維護時段（含跨越午夜）"""
+        from datetime import datetime
+        from update_scheduler import MaintenanceWindow
+
+        window = MaintenanceWindow("23:30-02:00")
+        self.assertTrue(window.contains(datetime(2025, 1, 20, 23, 45)))
+        self.assertTrue(window.contains(datetime(2025, 1, 21, 1, 59)))
+        self.assertFalse(window.contains(datetime(2025, 1, 21, 2, 0)))
+        self.assertFalse(window.contains(datetime(2025, 1, 21, 12, 0)))
+
+        self.assertTrue(MaintenanceWindow("02:00-05:00").contains(datetime(2025, 1, 21, 3, 0)))
+        self.assertFalse(MaintenanceWindow("").enabled())
+        with self.assertRaises(Exception):
+            MaintenanceWindow("25:00-03:00")
+        with self.assertRaises(Exception):
+            MaintenanceWindow(200)
+
+    def _build_app(self, overrides):
+        import main
+        from config import config
+
+        original_get = config.get
+        with patch.object(config, 'get', lambda key, default=None: overrides.get(key, original_get(key, default))), \
+                patch.object(main.signal, 'signal'):
+            return main.HelloOTAApp()
+
+    def test_invalid_maintenance_window_does_not_apply_immediately(self):
+        """測試維護時段設定格式錯誤時服務仍可啟動，但不會立即套用更新"""
+        app = self._build_app({'ota.maintenance_window': "25:00-03:00", 'ota.apply_after_idle_minutes': 0})
+
+        self.assertTrue(app.scheduler.window.enabled())
+        self.assertFalse(app.scheduler.window.contains())
+        self.assertFalse(app.scheduler.apply_due())
+
+    def test_invalid_maintenance_window_keeps_idle_rule(self):
+        """測試維護時段設定格式錯誤且設定閒置條件時，只在閒置後套用"""
+        app = self._build_app({'ota.maintenance_window': "25:00-03:00", 'ota.apply_after_idle_minutes': 10})
+
+        with patch.object(app.activity, 'idle_seconds', return_value=60):
+            self.assertFalse(app.scheduler.apply_due())
+        with patch.object(app.activity, 'idle_seconds', return_value=600):
+            self.assertTrue(app.scheduler.apply_due())
+
+    def test_cache_survives_restart_and_validates_checksum(self):
+        """測試等待套用的更新在重新建立後仍存在，且快取內容會重新校驗"""
+        from update_scheduler import PrefetchCache
+
+        self._prefetch()
+        restarted = PrefetchCache(self.temp_dir / "prefetch")
+        self.assertEqual(restarted.pending(), self.update_info)
+        self.assertEqual(restarted.get(self.update_info), self.cache.package_path(self.update_info))
+
+        self.cache.package_path(self.update_info).write_bytes(b"corrupted")
+        self.assertIsNone(restarted.get(self.update_info))
+        self.assertFalse(self.cache.package_path(self.update_info).exists())
+
+        restarted.discard()
+        self.assertIsNone(restarted.pending())
+
+    @patch('requests.get', side_effect=Exception("network unreachable"))
+    def test_download_uses_prefetched_package(self, mock_get):
+        """測試已預先下載時不經由網路"""
+        ota_manager = OTAManager()
+        ota_manager.app_dir = self.temp_dir / "hello-ota"
+        ota_manager.temp_dir = self.temp_dir / "tmp"
+        ota_manager.prefetch_cache = self.cache
+        self._prefetch()
+
+        update_file = ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file.read_bytes(), self.content)
+        mock_get.assert_not_called()
+
+    @patch('requests.get')
+    def test_prefetch_update_writes_cache(self, mock_get):
+        """測試預先下載驗證後才記錄為等待套用"""
+        mock_response = MagicMock()
+        mock_response.headers = {'content-length': str(len(self.content))}
+        mock_response.iter_content.return_value = [self.content]
+        mock_get.return_value = mock_response
+
+        ota_manager = OTAManager()
+        ota_manager.temp_dir = self.temp_dir / "tmp"
+        ota_manager.prefetch_cache = self.cache
+
+        with self._inline():
+            ota_manager.prefetch_in_background(self.update_info)
+        self.assertEqual(self.cache.pending()['version'], "9.9.9")
+        self.assertEqual(self.cache.get(self.update_info).read_bytes(), self.content)
+
+        # 校驗失敗時不留下快取或等待套用記錄
+        self.cache.discard()
+        bad_info = {**self.update_info, "checksum": "0" * 64}
+        with self._inline():
+            with self.assertRaises(Exception):
+                ota_manager.prefetch_in_background(bad_info)
+        self.assertIsNone(self.cache.pending())
+        self.assertEqual(list(self.cache.cache_dir.iterdir()), [])
+
+    def test_apply_waits_for_idle_or_window(self):
+        """測試有活動時不套用，閒置或進入維護時段後才套用"""
+        from update_scheduler import UpdateScheduler, MaintenanceWindow, ActivityTracker
+
+        self._prefetch()
+        ota_manager = MagicMock()
+        ota_manager.prefetch_cache = self.cache
+
+        activity = ActivityTracker()
+        scheduler = UpdateScheduler(ota_manager, idle_minutes=10, activity=activity)
+        self.assertFalse(scheduler.tick())
+        ota_manager.perform_update.assert_not_called()
+
+        # 活動檔的修改時間也算活動
+        activity_file = self.temp_dir / "activity"
+        activity_file.touch()
+        activity = ActivityTracker(activity_file)
+        activity._last_activity = 0
+        scheduler.activity = activity
+        self.assertFalse(scheduler.tick())
+
+        old = time.time() - 11 * 60
+        os.utime(activity_file, (old, old))
+        self.assertTrue(scheduler.tick())
+        ota_manager.perform_update.assert_called_once_with(self.update_info)
+
+        # 維護時段內即使有活動也套用
+        ota_manager.reset_mock()
+        with patch.object(MaintenanceWindow, 'contains', return_value=True):
+            scheduler = UpdateScheduler(ota_manager, window=MaintenanceWindow("02:00-05:00"),
+                                        activity=ActivityTracker())
+            self.assertTrue(scheduler.tick())
+        ota_manager.perform_update.assert_called_once()
+
+    def test_failed_apply_discards_cache(self):
+        """測試套用失敗時清除快取，避免反覆套用同一個更新包"""
+        from update_scheduler import UpdateScheduler
+
+        self._prefetch()
+        ota_manager = MagicMock()
+        ota_manager.prefetch_cache = self.cache
+        ota_manager.perform_update.side_effect = Exception("apply failed")
+
+        self.assertFalse(UpdateScheduler(ota_manager).tick())
+        self.assertIsNone(self.cache.pending())
+        self.assertFalse(self.cache.package_path(self.update_info).exists())
+
+class TestPeerCache(unittest.TestCase):
+    """同一站點節點間共用更新包測試（本機上執行多個服務）"""
+
+    AGENTS = 3
+
+    def setUp(self):
+        """測試前設定"""
+        import socket
+        import hashlib
+        import functools
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.content = os.urandom(256 * 1024)
+        origin_dir = self.temp_dir / "origin"
+        origin_dir.mkdir()
+        (origin_dir / "v1.1.0.tar.gz").write_bytes(self.content)
+
+        # 更新服務器，記錄被下載的次數
+        self.origin_requests = []
+
+        class CountingHandler(SimpleHTTPRequestHandler):
+            def do_GET(handler):
+                self.origin_requests.append(handler.path)
+                super().do_GET()
+
+            def log_message(handler, *args):
+                pass
+
+        self.origin = HTTPServer(('127.0.0.1', 0), functools.partial(CountingHandler, directory=str(origin_dir)))
+        threading.Thread(target=self.origin.serve_forever, daemon=True).start()
+
+        self.update_info = {
+            "version": "1.1.0",
+            "size": len(self.content),
+            "download_url": f"http://127.0.0.1:{self.origin.server_port}/v1.1.0.tar.gz",
+            "checksum": hashlib.sha256(self.content).hexdigest()
+        }
+
+        self.urls = []
+        for _ in range(self.AGENTS):
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', 0))
+                self.urls.append(f"http://127.0.0.1:{sock.getsockname()[1]}")
+
+        # 每個節點是獨立的服務行程，資料目錄各自分開
+        self.agents = []
+        app_dir = Path(__file__).parent.parent / "app"
+        for index, url in enumerate(self.urls):
+            agent_dir = self.temp_dir / f"agent-{index}"
+            config_file = agent_dir / "config.json"
+            agent_dir.mkdir()
+            with open(config_file, 'w') as f:
+                json.dump({
+                    "app": {"host": "127.0.0.1", "port": int(url.rsplit(':', 1)[1]), "log_level": "WARNING"},
+                    "ota": {"enabled": False, "peer_cache": True, "peers": self._peers(index)},
+                    "system": {
+                        "data_dir": str(agent_dir / "data"),
+                        "log_dir": str(agent_dir / "log"),
+                        "pid_file": str(agent_dir / "hello-ota.pid")
+                    }
+                }, f)
+            self.agents.append(subprocess.Popen(
+                [sys.executable, str(app_dir / "main.py")],
+                env={**os.environ, "HELLO_OTA_CONFIG": str(config_file)},
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            ))
+
+        for url in self.urls:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    requests.get(f"{url}/health", timeout=1)
+                    break
+                except requests.exceptions.RequestException:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        for agent in self.agents:
+            agent.terminate()
+            agent.wait(timeout=10)
+        self.origin.shutdown()
+        self.origin.server_close()
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _peers(self, index):
+        return [url for i, url in enumerate(self.urls) if i != index]
+
+    def _ota_manager(self, index, peers=None):
+        """與節點共用資料目錄的OTA管理器（代表該節點的更新流程）"""
+        from peer_cache import PeerCache
+
+        agent_dir = self.temp_dir / f"agent-{index}"
+        ota_manager = OTAManager()
+        ota_manager.app_dir = agent_dir / "hello-ota"
+        ota_manager.temp_dir = agent_dir / "tmp"
+        ota_manager.prefetch_cache.cache_dir = agent_dir / "data" / "prefetch"
+        ota_manager.peer_cache = PeerCache(
+            agent_dir / "data" / "peer_cache", enabled=True,
+            peers=self._peers(index) if peers is None else peers
+        )
+        return ota_manager
+
+    def test_site_downloads_one_copy_from_origin(self):
+        """測試第一台向更新服務器下載，其餘節點都由同一站點取得"""
+        for index in range(self.AGENTS):
+            ota_manager = self._ota_manager(index)
+            update_file = ota_manager.download_update(self.update_info)
+            self.assertEqual(update_file.read_bytes(), self.content)
+            if index == 0:
+                self.assertEqual(ota_manager.download_source, self.update_info['download_url'])
+            else:
+                self.assertTrue(ota_manager.download_source.startswith(self.urls[0]))
+
+        self.assertEqual(self.origin_requests, ["/v1.1.0.tar.gz"])
+
+        status = requests.get(f"{self.urls[0]}/ota/packages", timeout=2).json()
+        self.assertEqual([package['checksum'] for package in status['packages']], [self.update_info['checksum']])
+        self.assertEqual(status['served_bytes'], len(self.content) * (self.AGENTS - 1))
+        self.assertEqual(
+            requests.get(f"{self.urls[1]}/ota/status", timeout=2).json()['peer_cache']['packages'][0]['version'],
+            "1.1.0"
+        )
+
+    def test_corrupt_peer_falls_back_to_origin(self):
+        """測試節點提供的內容與校驗和不符時改向更新服務器下載"""
+        self._ota_manager(0).download_update(self.update_info)
+        package_file = self.temp_dir / "agent-0" / "data" / "peer_cache" / f"{self.update_info['checksum']}.pkg"
+        package_file.write_bytes(b"tampered" + self.content[8:])
+
+        ota_manager = self._ota_manager(1, peers=[self.urls[0]])
+        update_file = ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file.read_bytes(), self.content)
+        self.assertEqual(ota_manager.download_source, self.update_info['download_url'])
+        self.assertEqual(len(self.origin_requests), 2)
+
+    def test_cache_keeps_recent_packages_and_rejects_bad_paths(self):
+        """測試只保留最近的更新包，且不接受非校驗和的路徑"""
+        import hashlib
+        from peer_cache import PeerCache
+
+        peer_cache = PeerCache(self.temp_dir / "cache", enabled=True, keep=2)
+        for version in ("1.1.0", "1.2.0", "1.3.0"):
+            package = self.temp_dir / f"{version}.tar.gz"
+            package.write_bytes(version.encode())
+            peer_cache.store(package, {"version": version, "checksum": hashlib.sha256(version.encode()).hexdigest()})
+            time.sleep(0.01)
+
+        self.assertEqual(sorted(info['version'] for info in peer_cache.packages()), ["1.2.0", "1.3.0"])
+        self.assertIsNone(peer_cache.package_file("../config"))
+        self.assertEqual(peer_cache.peer_urls("../config"), [])
+        self.assertEqual(
+            requests.get(f"{self.urls[0]}/ota/packages/..%2Fconfig.json", timeout=2).status_code, 404
+        )
+
+class TestChunkVerification(unittest.TestCase):
+    """雜湊樹分塊驗證測試：只重新下載損毀的區塊，續傳時沿用已驗證的區塊"""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def setUp(self):
+        """測試前設定"""
+        import hashlib
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from chunk_verify import build_chunk_info
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        # 5 個區塊，最後一個不滿
+        self.content = os.urandom(self.CHUNK_SIZE * 4 + 1000)
+        package = self.temp_dir / "v1.1.0.tar.gz"
+        package.write_bytes(self.content)
+
+        # 記錄每個請求的Range與傳送的位元組數；corrupt 為下一次回應要翻轉的位置，
+        # truncate 為下一次回應傳送到的位置，support_range 為False時忽略Range
+        self.served = []
+        self.corrupt = []
+        self.truncate = []
+        self.support_range = True
+        test = self
+
+        class ChunkHandler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                start, end = 0, len(test.content) - 1
+                byte_range = handler.headers.get('Range')
+                if byte_range and test.support_range:
+                    first, last = byte_range[len('bytes='):].split('-')
+                    start, end = int(first), int(last)
+                    handler.send_response(206)
+                    handler.send_header('Content-Range', f'bytes {start}-{end}/{len(test.content)}')
+                else:
+                    handler.send_response(200)
+                handler.send_header('Content-Length', str(end - start + 1))
+                handler.end_headers()
+
+                data = bytearray(test.content[start:end + 1])
+                if test.corrupt:
+                    offset = test.corrupt.pop(0) - start
+                    data[offset] ^= 0xFF
+                if test.truncate:
+                    data = data[:test.truncate.pop(0) - start]
+                test.served.append((byte_range, len(data)))
+                handler.wfile.write(data)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ChunkHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.update_info = {
+            "version": "1.1.0",
+            "size": len(self.content),
+            "checksum": hashlib.sha256(self.content).hexdigest(),
+            "chunks": build_chunk_info(package, chunk_size=self.CHUNK_SIZE),
+            "download_url": f"http://127.0.0.1:{self.server.server_port}/v1.1.0.tar.gz"
+        }
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        self.server.shutdown()
+        self.server.server_close()
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _ota_manager(self):
+        from update_scheduler import PrefetchCache
+
+        ota_manager = OTAManager()
+        ota_manager.app_dir = self.temp_dir / "hello-ota"
+        ota_manager.temp_dir = self.temp_dir / "tmp"
+        ota_manager.prefetch_cache = PrefetchCache(self.temp_dir / "prefetch")
+        return ota_manager
+
+    def _chunk_range(self, index):
+        start = index * self.CHUNK_SIZE
+        return f"bytes={start}-{min(start + self.CHUNK_SIZE, len(self.content)) - 1}"
+
+    def test_manifest_matches_package_tool(self):
+        """測試更新包工具寫入的區塊清單與裝置計算的雜湊樹相同，且拒絕不一致的清單"""
+        import hashlib
+        sys.path.insert(0, str(Path(__file__).parent.parent / "updates"))
+        from create_update import UpdatePackageCreator
+        from chunk_verify import ChunkManifest, build_chunk_info
+
+        package = self.temp_dir / "v1.1.0.tar.gz"
+        self.assertEqual(build_chunk_info(package, chunk_size=self.CHUNK_SIZE), self.update_info['chunks'])
+        self.assertEqual(UpdatePackageCreator()._create_update_info(package, "1.1.0")['chunks'],
+                         build_chunk_info(package))
+
+        manifest = ChunkManifest.from_update_info(self.update_info)
+        self.assertEqual(len(manifest), 5)
+        self.assertEqual(manifest.chunk_range(4), (self.CHUNK_SIZE * 4, 1000))
+        self.assertIsNone(ChunkManifest.from_update_info({"size": 10}))
+
+        tampered = json.loads(json.dumps(self.update_info))
+        tampered['chunks']['hashes'][2] = hashlib.sha256(b"other").hexdigest()
+        with self.assertRaises(Exception):
+            ChunkManifest.from_update_info(tampered)
+        with self.assertRaises(Exception):
+            ChunkManifest.from_update_info({**self.update_info, "size": len(self.content) + self.CHUNK_SIZE})
+
+    def test_corrupt_chunk_is_refetched_alone(self):
+        """測試傳輸中損毀一個區塊時只重新下載該區塊"""
+        self.corrupt.append(self.CHUNK_SIZE * 2 + 10)
+
+        ota_manager = self._ota_manager()
+        update_file = ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file.read_bytes(), self.content)
+        self.assertEqual(ota_manager.chunk_stats['bad'], 1)
+        self.assertEqual(ota_manager.chunk_stats['refetched'], 1)
+        self.assertEqual(self.served[1], (self._chunk_range(2), self.CHUNK_SIZE))
+        self.assertEqual(sum(size for _, size in self.served), len(self.content) + self.CHUNK_SIZE)
+        self.assertFalse(update_file.with_name(update_file.name + ".chunks").exists())
+
+    def test_interrupted_prefetch_resumes_verified_chunks(self):
+        """測試中斷的預先下載保留已驗證的區塊，下次只下載其餘區塊且不重新計算雜湊"""
+        from config import config
+        from chunk_verify import ChunkManifest
+
+        self.truncate.append(self.CHUNK_SIZE * 3 + 500)
+        original_get = config.get
+        with patch.object(config, 'get', lambda key, default=None: 0 if key == 'ota.download_retries'
+                          else original_get(key, default)):
+            with self.assertRaises(Exception):
+                self._ota_manager().prefetch_update(self.update_info)
+
+        partial = self.temp_dir / "prefetch"
+        self.assertEqual(len(list(partial.glob("*.part"))), 1)
+        self.assertEqual(len(list(partial.glob("*.chunks"))), 1)
+
+        original_verify = ChunkManifest.verify
+        verified = []
+
+        def counting_verify(manifest, index, data):
+            verified.append(index)
+            return original_verify(manifest, index, data)
+
+        ota_manager = self._ota_manager()
+        with patch.object(ChunkManifest, 'verify', counting_verify):
+            package = ota_manager.prefetch_update(self.update_info)
+
+        self.assertEqual(package.read_bytes(), self.content)
+        self.assertEqual(verified, [3, 4])
+        self.assertEqual(ota_manager.chunk_stats['resumed'], 3)
+        self.assertEqual(self.served[-1][0], f"bytes={self.CHUNK_SIZE * 3}-{len(self.content) - 1}")
+        self.assertEqual(list(partial.glob("*.part")) + list(partial.glob("*.chunks")), [])
+
+    def test_interrupted_download_resumes_missing_chunks(self):
+        """測試中斷的下載保留臨時目錄中的部分檔案，再次下載同一版本時只下載缺少的區塊"""
+        from config import config
+
+        self.truncate.append(self.CHUNK_SIZE * 3 + 500)
+        original_get = config.get
+        with patch('ota_manager.fits_in_memory_filesystem', return_value=True), \
+                patch.object(config, 'get', lambda key, default=None: 0 if key == 'ota.download_retries'
+                             else original_get(key, default)):
+            with self.assertRaises(Exception):
+                self._ota_manager().download_update(self.update_info)
+            served_before = len(self.served)
+
+            ota_manager = self._ota_manager()
+            update_file = ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file, self.temp_dir / "tmp" / "update.tar.gz")
+        self.assertEqual(update_file.read_bytes(), self.content)
+        self.assertEqual(ota_manager.chunk_stats['resumed'], 3)
+        self.assertEqual(self.served[served_before:],
+                         [(f"bytes={self.CHUNK_SIZE * 3}-{len(self.content) - 1}", len(self.content) - self.CHUNK_SIZE * 3)])
+
+    def test_download_discards_partial_file_of_other_package(self):
+        """測試臨時目錄中其他更新包留下的部分檔案與區塊狀態不會被沿用"""
+        from chunk_verify import ChunkState, ChunkManifest, merkle_root
+
+        tmp_dir = self.temp_dir / "tmp"
+        tmp_dir.mkdir()
+        stale = tmp_dir / "update.tar.gz"
+        stale.write_bytes(b"\0" * len(self.content))
+        # 大小相同但內容不同的更新包（雜湊樹根不同）
+        hashes = list(reversed(self.update_info['chunks']['hashes']))
+        other = {**self.update_info, "chunks": {**self.update_info['chunks'], "hashes": hashes,
+                                                "root": merkle_root(hashes)}}
+        state = ChunkState(stale, ChunkManifest.from_update_info(other))
+        state.verified = {0, 1, 2}
+        state.save()
+        (tmp_dir / "leftover").mkdir()
+
+        with patch('ota_manager.fits_in_memory_filesystem', return_value=True):
+            ota_manager = self._ota_manager()
+            update_file = ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file.read_bytes(), self.content)
+        self.assertEqual(ota_manager.chunk_stats['resumed'], 0)
+        self.assertFalse((tmp_dir / "leftover").exists())
+
+    def test_server_without_range_support(self):
+        """測試服務器不支援Range時從頭讀取，仍只寫入缺少的區塊"""
+        self.support_range = False
+        self.corrupt.append(self.CHUNK_SIZE + 1)
+
+        ota_manager = self._ota_manager()
+        update_file = ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file.read_bytes(), self.content)
+        self.assertEqual(ota_manager.chunk_stats['bad'], 1)
+        self.assertEqual(len(self.served), 2)
+        # 第二次回應讀到缺少的區塊後即停止
+        self.assertLessEqual(self.served[1][1], len(self.content))
+
+class TestMirrorDownload(unittest.TestCase):
+    """多鏡像下載測試：依延遲排序、記住最佳鏡像、下載中斷時由下一個鏡像接續"""
+
+    # 各鏡像注入的延遲（秒）
+    LATENCIES = {"slow": 0.3, "fast": 0.0, "medium": 0.15}
+
+    def setUp(self):
+        """測試前設定"""
+        import hashlib
+        from http.server import ThreadingHTTPServer
+        from mock_server import MockUpdateServerHandler, ReleaseFeed
+        from mirror_select import MirrorSelector
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        updates_dir = self.temp_dir / "updates"
+        updates_dir.mkdir()
+        self.content = os.urandom(512 * 1024)
+        (updates_dir / "v1.1.0.tar.gz").write_bytes(self.content)
+
+        # 記錄每個鏡像收到的下載請求與Range
+        self.requests = []
+        self.servers = {}
+        self.handlers = {}
+        for name, latency in self.LATENCIES.items():
+            def do_GET(handler, name=name):
+                if handler.path.startswith('/updates/'):
+                    self.requests.append((name, handler.headers.get('Range')))
+                MockUpdateServerHandler.do_GET(handler)
+
+            handler = type(f"{name}Handler", (MockUpdateServerHandler,), {
+                "quiet": True, "updates_dir": updates_dir, "feed": ReleaseFeed(),
+                "latency": latency, "do_GET": do_GET
+            })
+            server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers[name] = server
+            self.handlers[name] = handler
+
+        self.update_info = {
+            "version": "1.1.0",
+            "size": len(self.content),
+            "checksum": hashlib.sha256(self.content).hexdigest(),
+            "download_url": self._url("slow"),
+            "mirrors": [self._url("fast"), self._url("medium")]
+        }
+
+        self.state_file = self.temp_dir / "mirrors.json"
+        self.ota_manager = OTAManager()
+        self.ota_manager.app_dir = self.temp_dir / "hello-ota"
+        self.ota_manager.temp_dir = self.temp_dir / "tmp"
+        self.ota_manager.mirrors = MirrorSelector(self.state_file)
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _origin(self, name):
+        return f"http://127.0.0.1:{self.servers[name].server_port}"
+
+    def _url(self, name):
+        return f"{self._origin(name)}/updates/v1.1.0.tar.gz"
+
+    def test_fastest_mirror_selected_and_remembered(self):
+        """測試選擇延遲最低的鏡像，量測結果保存後下一次不需重新探測"""
+        from mirror_select import MirrorSelector
+
+        self.handlers["slow"].mirrors = [self._origin("fast"), self._origin("medium")]
+        response = requests.get(f"{self._origin('slow')}/api/check_update?current_version=1.0.0", timeout=5).json()
+        self.assertEqual(response['mirrors'], self.update_info['mirrors'])
+
+        update_file = self.ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file.read_bytes(), self.content)
+        self.assertEqual(self.ota_manager.download_source, self._url("fast"))
+        self.assertEqual(self.ota_manager.mirrors.probes, 3)
+        # 較慢的鏡像只收到探測的小範圍請求
+        self.assertEqual([r for r in self.requests if r[0] != "fast"],
+                         [("slow", "bytes=0-65535"), ("medium", "bytes=0-65535")])
+
+        restarted = MirrorSelector(self.state_file)
+        self.assertEqual(restarted.best, self._origin("fast"))
+        ranked = restarted.rank([self._url("slow"), self._url("medium"), self._url("fast")], size=len(self.content))
+        self.assertEqual(ranked, [self._url("fast"), self._url("medium"), self._url("slow")])
+        self.assertEqual(restarted.probes, 0)
+
+    def test_failover_resumes_from_written_bytes(self):
+        """測試最佳鏡像下載中斷時由下一個鏡像從已寫入的位置接續"""
+        self.handlers["fast"].drop_after = 200 * 1024
+
+        update_file = self.ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file.read_bytes(), self.content)
+        self.assertEqual(self.ota_manager.download_source, self._url("medium"))
+        # 只重新下載中斷時尚未寫入的部分
+        resumed = [int(r[1][len("bytes="):-1]) for r in self.requests if r[0] == "medium" and r[1].endswith("-")]
+        self.assertEqual(len(resumed), 1)
+        self.assertTrue(128 * 1024 < resumed[0] <= 200 * 1024)
+        status = self.ota_manager.mirrors.status()
+        self.assertEqual(status['best'], self._origin("medium"))
+        self.assertIsNone(status['mirrors'][self._origin("fast")]['throughput'])
+        self.assertEqual(status['mirrors'][self._origin("fast")]['failures'], 1)
+
+    def test_stalled_mirror_times_out_and_fails_over(self):
+        """測試停滯的鏡像在讀取逾時後改由下一個鏡像下載，不會無限等待"""
+        from config import config
+
+        self.handlers["fast"].latency = 3
+        original_get = config.get
+        overrides = {'ota.download_read_timeout': 0.3}
+        update_file = self.temp_dir / "stalled.tar.gz"
+
+        started = time.monotonic()
+        with patch.object(config, 'get', lambda key, default=None: overrides.get(
+                key, original_get(key, default))):
+            source = self.ota_manager._download_with_progress([self._url("fast"), self._url("medium")], update_file)
+            self.ota_manager._finish_write_session()
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(source, self._url("medium"))
+        self.assertEqual(update_file.read_bytes(), self.content)
+
+    def test_probe_failure_then_successful_download(self):
+        """測試探測失敗的鏡像之後下載成功，量測結果仍可用於下一次排序"""
+        from mirror_select import MirrorSelector
+
+        selector = MirrorSelector(self.state_file, probe_timeout=0.1)
+        selector.rank([self._url("slow"), self._url("fast")])
+        self.assertNotIn('rtt_ms', selector.status()['mirrors'][self._origin("slow")])
+
+        selector.record_success(self._url("slow"), len(self.content), 0.5)
+        ranked = selector.rank([self._url("slow"), self._url("fast")], size=len(self.content))
+
+        self.assertEqual(set(ranked), {self._url("slow"), self._url("fast")})
+        self.assertEqual(selector.status()['mirrors'][self._origin("slow")]['rtt_ms'], 0)
+
+    def test_chunked_failover_keeps_verified_chunks(self):
+        """測試分塊下載中斷時，已驗證的區塊保留，其餘區塊由下一個鏡像下載"""
+        from chunk_verify import build_chunk_info
+
+        chunk_size = 64 * 1024
+        self.update_info['chunks'] = build_chunk_info(self.temp_dir / "updates" / "v1.1.0.tar.gz",
+                                                      chunk_size=chunk_size)
+        self.handlers["fast"].drop_after = chunk_size * 3 + 100
+
+        update_file = self.ota_manager.download_update(self.update_info)
+
+        self.assertEqual(update_file.read_bytes(), self.content)
+        self.assertEqual(self.ota_manager.download_source, self._url("medium"))
+        self.assertIn(("medium", f"bytes={chunk_size * 3}-{len(self.content) - 1}"), self.requests)
+        self.assertEqual(self.ota_manager.chunk_stats['refetched'], 5)
+
+class TestUpdateWatcher(unittest.TestCase):
+    """長輪詢更新通知測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        from mock_server import MockUpdateServerHandler, ReleaseFeed
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.feed = ReleaseFeed()
+        self.handler = type("Handler", (MockUpdateServerHandler,), {
+            "updates_dir": self.temp_dir, "quiet": True, "feed": self.feed
+        })
+        self.server = None
+        self.ota_manager = OTAManager()
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _start_server(self, server_class):
+        self.server = server_class(('127.0.0.1', 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def _using(self, update_server):
+        from config import config
+        import version
+
+        original_get = config.get
+        overrides = {'ota.update_server': update_server}
+        config_patch = patch.object(config, 'get', lambda key, default=None: overrides.get(
+            key, original_get(key, default)))
+        version_patch = patch.object(version, '__version__', "1.1.0")
+        config_patch.start()
+        version_patch.start()
+        self.addCleanup(config_patch.stop)
+        self.addCleanup(version_patch.stop)
+
+    def test_long_poll_returns_when_release_published(self):
+        """測試長輪詢等待中發佈新版本時立即回應"""
+        from mock_server import MockThreadingHTTPServer
+        from update_watcher import UpdateWatcher
+
+        self._using(self._start_server(MockThreadingHTTPServer))
+        watcher = UpdateWatcher(self.ota_manager, check_interval=300, wait_seconds=30)
+
+        threading.Timer(0.3, self.feed.publish, args=("1.2.0",)).start()
+        started = time.monotonic()
+        update_info, delay = watcher.check()
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(update_info['latest_version'], "1.2.0")
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 5)
+        self.assertEqual(watcher.mode, "long_poll")
+        self.assertLessEqual(delay, 1)
+
+        # 已知的版本不會再次立即回應，逾時後回報目前狀態
+        watcher.wait_seconds = 0.5
+        started = time.monotonic()
+        update_info, _ = watcher.check()
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+        self.assertEqual(update_info['latest_version'], "1.2.0")
+
+    def test_falls_back_to_polling(self):
+        """測試服務器不支援長輪詢時改為定期輪詢"""
+        from http.server import HTTPServer
+        from update_watcher import UpdateWatcher
+
+        self._using(self._start_server(HTTPServer))
+        watcher = UpdateWatcher(self.ota_manager, check_interval=300, wait_seconds=30)
+
+        started = time.monotonic()
+        update_info, delay = watcher.check()
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertIsNone(update_info)
+        self.assertEqual(watcher.mode, "poll")
+        self.assertEqual(delay, 300)
+
+    def test_connection_failure_backs_off(self):
+        """測試連線失敗時以指數退避重試，最長為輪詢間隔"""
+        import socket
+        from update_watcher import UpdateWatcher
+
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self._using(f"http://127.0.0.1:{port}")
+        watcher = UpdateWatcher(self.ota_manager, check_interval=12, retry_seconds=5)
+
+        delays = [watcher.check()[1] for _ in range(3)]
+
+        self.assertEqual(delays, [5, 10, 12])
+        self.assertEqual(watcher.status()['consecutive_failures'], 3)
+
+class TestMQTTTransport(unittest.TestCase):
+    """MQTT更新傳輸測試（使用行程內MQTT代理）"""
+
+    def setUp(self):
+        """測試前設定"""
+        import functools
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+        from mqtt_broker import LocalBroker
+        from update_transport import MQTTTransport
+
+        sys.path.insert(0, str(Path(__file__).parent.parent / "updates"))
+        from create_update import UpdatePackageCreator
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.base_dir = self.temp_dir / "hello-ota"
+        self.releases = ReleaseManager(self.base_dir)
+        current = self.temp_dir / "src-1.0.0"
+        current.mkdir()
+        (current / "main.py").write_text("VERSION = '1.0.0'")
+        self.releases.stage("1.0.0", current)
+        self.releases.activate("1.0.0")
+
+        with patch('builtins.print'):
+            package_file, info_file = UpdatePackageCreator().create_update_package(
+                "1.1.0", output_dir=self.temp_dir / "out"
+            )
+        with open(info_file, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+
+        handler = functools.partial(SimpleHTTPRequestHandler, directory=str(package_file.parent))
+        handler.log_message = lambda *args: None
+        self.file_server = HTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.file_server.serve_forever, daemon=True).start()
+        self.announcement = {
+            "version": "1.1.0",
+            "download_url": f"http://127.0.0.1:{self.file_server.server_port}/{package_file.name}",
+            "checksum": info['checksum'],
+            "size": info['size']
+        }
+
+        config_file = self.temp_dir / "config.json"
+        with open(config_file, 'w') as f:
+            json.dump({
+                "app": {"log_level": "WARNING"},
+                "ota": {"background_worker": False},
+                "system": {"data_dir": str(self.temp_dir / "data")}
+            }, f)
+        self.env = patch.dict(os.environ, {"HELLO_OTA_CONFIG": str(config_file)})
+        self.env.start()
+
+        self.ota_manager = OTAManager()
+        self.ota_manager.app_dir = self.base_dir
+        self.ota_manager.temp_dir = self.temp_dir / "tmp"
+        self.ota_manager.update_script = self.temp_dir / "updater.py"
+        self.ota_manager.backup_dir = self.temp_dir / "backup"
+        self.ota_manager.history = UpdateHistory(self.temp_dir / "history.jsonl")
+        self.ota_manager.outcome_marker = self.temp_dir / "outcome_reported.json"
+
+        # 雲端：發佈新版本並接收進度與結果
+        self.broker = LocalBroker()
+        self.cloud = self.broker.client("cloud")
+        self.cloud.connect()
+        self.progress = []
+        self.outcomes = []
+        self.cloud.message_callback_add(
+            "hello-ota/+/progress", lambda client, userdata, message: self.progress.append(json.loads(message.payload)))
+        self.cloud.message_callback_add(
+            "hello-ota/+/outcome", lambda client, userdata, message: self.outcomes.append(json.loads(message.payload)))
+        self.cloud.subscribe("hello-ota/+/progress", qos=1)
+        self.cloud.subscribe("hello-ota/+/outcome", qos=1)
+
+        # 裝置：持久工作階段，套用通知直接執行更新
+        self.device = self.broker.client("hello-ota-dev-1", clean_session=False)
+        self.device.connect()
+        self.transport = MQTTTransport(
+            self.device, "dev-1", on_trigger=self.ota_manager.perform_update, publish_timeout=0.5
+        )
+        self.transport.start()
+        self.ota_manager.transport = self.transport
+
+        # 啟用時的記錄不回報
+        self.assertEqual(self.ota_manager.report_outcomes(), 0)
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        self.broker.stop()
+        self.env.stop()
+        self.file_server.shutdown()
+        self.file_server.server_close()
+        sys.path.remove(str(Path(__file__).parent.parent / "updates"))
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _announce(self, topic="hello-ota/dev-1/update", **extra):
+        self.cloud.publish(topic, json.dumps({**self.announcement, **extra}), qos=1)
+
+    def test_notification_wakes_watcher(self):
+        """測試MQTT通知立即喚醒等待中的更新檢查（廣播主題亦可）"""
+        import version
+        from update_watcher import UpdateWatcher
+
+        watcher = UpdateWatcher(self.ota_manager, check_interval=300, wait_seconds=10)
+        with patch.object(version, '__version__', "1.0.0"):
+            threading.Timer(0.2, self._announce, kwargs={"topic": "hello-ota/broadcast/update"}).start()
+            started = time.monotonic()
+            update_info, delay = watcher.check()
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertTrue(update_info['has_update'])
+        self.assertEqual(update_info['latest_version'], "1.1.0")
+        self.assertEqual(update_info['download_url'], self.announcement['download_url'])
+        self.assertEqual(watcher.mode, "long_poll")
+        self.assertLessEqual(delay, 1)
+
+    def test_apply_message_runs_update_and_reports(self):
+        """測試套用通知觸發更新，進度與更新執行器寫入的結果經由MQTT回報"""
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            self._announce(apply=True)
+            self.assertTrue(self.broker.flush(30))
+
+        schedule.assert_called_once()
+        self.assertTrue((self.releases.release_dir("1.1.0") / "main.py").exists())
+        self.assertTrue(self.broker.flush())
+        self.assertEqual([p['stage'] for p in self.progress], ["downloading", "activating"])
+
+        # 更新執行器在其他行程切換成功後寫入歷史記錄
+        from datetime import datetime
+        UpdateHistory(self.temp_dir / "history.jsonl").append({
+            "timestamp": datetime.now().isoformat(), "version": "1.1.0", "status": "completed", "downtime_ms": 120.0
+        })
+        self.assertEqual(self.ota_manager.report_outcomes(), 1)
+        self.assertTrue(self.broker.flush())
+        self.assertEqual([(o['version'], o['status']) for o in self.outcomes], [("1.1.0", "completed")])
+        self.assertEqual(self.ota_manager.report_outcomes(), 0)
+
+    def test_outcome_delivered_after_reconnect(self):
+        """測試離線時的失敗結果在重新連線後送達（至少一次，以 id 去除重複）"""
+        self.device.disconnect()
+        with self.assertRaises(Exception):
+            self.ota_manager.perform_update({**self.announcement, "checksum": "0" * 64})
+
+        self.assertEqual(self.ota_manager.report_outcomes(), 0)
+        self.assertEqual(self.outcomes, [])
+
+        self.device.connect()
+        self.assertEqual(self.ota_manager.report_outcomes(), 1)
+        self.assertTrue(self.broker.flush())
+        self.assertGreaterEqual(len(self.outcomes), 1)
+        self.assertEqual({(o['id'], o['status']) for o in self.outcomes},
+                         {(self.outcomes[0]['id'], "failed")})
+        self.assertIn("校驗失敗", self.outcomes[0]['error'])
+        self.assertEqual(self.ota_manager.report_outcomes(), 0)
+
+    def test_create_transport_shares_existing_client(self):
+        """測試傳入機器既有的MQTT用戶端時共用該工作階段，停止時不關閉它"""
+        from config import config
+        from update_transport import create_transport
+
+        original_get = config.get
+        overrides = {'ota.transport': 'mqtt', 'ota.device_id': 'dev-2'}
+        shared = self.broker.client("site-gateway")
+        shared.connect()
+        with patch.object(config, 'get', lambda key, default=None: overrides.get(
+                key, original_get(key, default))):
+            transport = create_transport(client=shared)
+
+        self.assertIs(transport.client, shared)
+        self.cloud.publish("hello-ota/dev-2/update", json.dumps(self.announcement), qos=1)
+        self.assertTrue(self.broker.flush())
+        self.assertEqual(transport.received, 1)
+
+        transport.stop()
+        self.assertTrue(shared.connected)
+
+    def test_broker_qos1_semantics(self):
+        """測試代理：萬用字元、保留訊息、離線佇列與未確認時重新送達"""
+        from mqtt_broker import topic_matches
+
+        self.assertTrue(topic_matches("a/+/c", "a/b/c"))
+        self.assertTrue(topic_matches("a/#", "a/b/c"))
+        self.assertFalse(topic_matches("a/+", "a/b/c"))
+
+        received = []
+        attempts = []
+
+        def flaky(client, userdata, message):
+            attempts.append(message.dup)
+            if len(attempts) == 1:
+                raise Exception("處理失敗")
+            received.append(message.payload)
+
+        listener = self.broker.client("listener", clean_session=False)
+        listener.connect()
+        listener.message_callback_add("t/#", flaky)
+        listener.subscribe("t/#", qos=1)
+        self.cloud.publish("t/retained", b"r", qos=1, retain=True)
+        self.assertTrue(self.broker.flush())
+        self.assertEqual(attempts, [False, True])
+
+        listener.disconnect()
+        self.cloud.publish("t/offline", b"queued", qos=1)
+        self.cloud.publish("t/offline", b"dropped", qos=0)
+        listener.connect()
+        self.assertTrue(self.broker.flush())
+        self.assertEqual(received, [b"r", b"queued"])
+
+        late = self.broker.client("late")
+        late.connect()
+        late_received = []
+        late.on_message = lambda client, userdata, message: late_received.append(message.retain)
+        late.subscribe("t/retained", qos=1)
+        self.assertTrue(self.broker.flush())
+        self.assertEqual(late_received, [True])
+
+class TestFleetSimulator(unittest.TestCase):
+    """更新服務器負載模擬測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        from mock_server import MockUpdateServerHandler, MockThreadingHTTPServer, ReleaseFeed
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.package = self.temp_dir / "v1.1.0.tar.gz"
+        self.package.write_bytes(os.urandom(32 * 1024))
+
+        handler = type("Handler", (MockUpdateServerHandler,), {
+            "updates_dir": self.temp_dir, "quiet": True, "feed": ReleaseFeed()
+        })
+        # 與 mock_server.py --threading 相同的連線佇列，數百台裝置同時連線時不會被拒絕
+        self.server = MockThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        self.server.shutdown()
+        self.server.server_close()
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def test_rollout_report(self):
+        """測試整批裝置完成更新並產生可比較的報告"""
+        import asyncio
+        from fleet_simulator import FleetSimulator
+
+        agents = 200
+        simulator = FleetSimulator(self.url, agents=agents, check_interval=0.3, jitter=0.2,
+                                   download_jitter=0.1, duration=30, seed=1)
+        report = json.loads(json.dumps(asyncio.run(simulator.run())))
+
+        self.assertEqual(report['rollout']['completed'], agents)
+        self.assertIsNotNone(report['rollout']['time_to_fleet_completion_seconds'])
+        self.assertEqual(report['requests']['download']['count'], agents)
+        self.assertEqual(report['requests']['download']['bytes'], agents * self.package.stat().st_size)
+        self.assertGreaterEqual(report['requests']['check']['count'], agents)
+        self.assertEqual(report['requests']['check']['error_rate'], 0.0)
+        self.assertEqual(set(report['requests']['check']['latency_ms']), {"p50", "p95", "p99", "max"})
+        self.assertLessEqual(report['requests']['check']['latency_ms']['p50'],
+                             report['requests']['check']['latency_ms']['p99'])
+
+    def test_errors_are_counted(self):
+        """測試下載失敗計入錯誤率，未全部完成時沒有整批完成時間"""
+        import asyncio
+        from fleet_simulator import FleetSimulator
+
+        self.package.unlink()
+        simulator = FleetSimulator(self.url, agents=20, check_interval=0.2, duration=1, seed=1)
+        report = asyncio.run(simulator.run())
+
+        self.assertEqual(report['rollout']['completed'], 0)
+        self.assertIsNone(report['rollout']['time_to_fleet_completion_seconds'])
+        self.assertEqual(report['requests']['download']['error_rate'], 1.0)
+        self.assertGreater(report['errors']['download']['http_404'], 0)
+
+    def test_long_poll_notification_capacity(self):
+        """測試長輪詢：所有裝置保持連線，發佈新版本後立即收到通知"""
+        import asyncio
+        from fleet_simulator import FleetSimulator
+
+        agents = 300
+        simulator = FleetSimulator(self.url, agents=agents, check_interval=0.5, start_version="1.1.0",
+                                   duration=30, max_connections=agents, seed=1, long_poll=20,
+                                   publish_version="1.2.0", publish_after=2, download=False)
+        report = json.loads(json.dumps(asyncio.run(simulator.run())))
+
+        notifications = report['notifications']
+        self.assertEqual(notifications['notified'], agents)
+        self.assertEqual(notifications['server_attached']['attached'], agents)
+        self.assertLess(notifications['latency_ms']['p99'], 5000)
+        # 每台裝置只在連線時與收到通知時各送出一個請求
+        self.assertEqual(report['requests']['check']['count'], agents)
+        self.assertEqual(report['rollout']['completed'], agents)
+
+    def test_percentile(self):
+        """測試最近排名法百分位數"""
+        from fleet_simulator import percentile
+
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([5], 95), 5)
+        self.assertIsNone(percentile([], 50))
+
+class TestPipelineBenchmark(unittest.TestCase):
+    """OTA流程效能基準測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        self.temp_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def test_synthetic_tree_size(self):
+        """測試合成版本目錄接近指定大小且可被匯入"""
+        from ota_benchmark import build_release_tree
+
+        tree = build_release_tree(self.temp_dir / "tree", 3 * 1024 * 1024)
+        total = sum(f.stat().st_size for f in tree.iterdir())
+        self.assertLessEqual(total, 3 * 1024 * 1024)
+        self.assertGreater(total, 3 * 1024 * 1024 - 1024)
+        compile((tree / "blob_000.py").read_text(), "blob_000.py", "exec")
+
+    def test_pipeline_stages_are_measured(self):
+        """測試每個階段都經由本機更新服務器實際執行並記錄耗時"""
+        from ota_benchmark import PipelineBenchmark, STAGES
+
+        report = PipelineBenchmark(self.temp_dir).run(sizes_mb=(0.25,))
+
+        result = report['results']['0.25MB']
+        self.assertEqual(set(result['stages']), set(STAGES))
+        for seconds in result['stages'].values():
+            self.assertGreater(seconds, 0)
+        self.assertGreater(result['package_bytes'], 128 * 1024)
+        self.assertEqual(list(self.temp_dir.iterdir()), [])
+
+    def test_regression_threshold(self):
+        """測試超過門檻且超過最小差距才視為退步"""
+        from ota_benchmark import compare_with_baseline
+
+        baseline = {"results": {"50MB": {"stages": {"download": 1.0, "verify": 0.001, "swap": 0.5}}}}
+        report = {"results": {
+            "50MB": {"stages": {"download": 1.3, "verify": 0.003, "swap": 0.55, "extract": 9.0}},
+            "500MB": {"stages": {"download": 10.0}}
+        }}
+
+        regressions = compare_with_baseline(report, baseline, threshold=0.2)
+        self.assertEqual([(r['size'], r['stage']) for r in regressions], [("50MB", "download")])
+        self.assertEqual(regressions[0]['change_percent'], 30.0)
+        self.assertEqual(compare_with_baseline(report, baseline, threshold=0.5), [])
+
+class TestNetworkSimulator(unittest.TestCase):
+    """網路狀況代理與下載策略比較測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        from mock_server import MockUpdateServerHandler, MockThreadingHTTPServer
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.content = os.urandom(128 * 1024)
+        (self.temp_dir / "v1.1.0.tar.gz").write_bytes(self.content)
+
+        handler = type("Handler", (MockUpdateServerHandler,), {"updates_dir": self.temp_dir, "quiet": True})
+        self.server = MockThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.upstream = ('127.0.0.1', self.server.server_port)
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        self.server.shutdown()
+        self.server.server_close()
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _fetch(self, proxy):
+        started = time.monotonic()
+        response = requests.get(f"{proxy.url}/updates/v1.1.0.tar.gz", timeout=10)
+        return response.content, time.monotonic() - started
+
+    def test_latency_and_rate_limit(self):
+        """測試延遲與頻寬上限：128 KB 以 256 KB/s 傳送，加上來回延遲"""
+        from netem_proxy import NetemProxy
+
+        with NetemProxy(self.upstream, "lan", rtt_ms=200, rate_kbps=256) as proxy:
+            content, elapsed = self._fetch(proxy)
+
+        self.assertEqual(content, self.content)
+        self.assertGreater(elapsed, 0.2 + 0.4)
+        self.assertEqual(proxy.snapshot()['connections'], 1)
+
+        with self.assertRaises(Exception):
+            NetemProxy(self.upstream, "dialup")
+
+    def test_stalls_and_connection_drops(self):
+        """測試停頓延後傳送但資料完整；中斷時用戶端收到連線錯誤"""
+        from netem_proxy import NetemProxy
+
+        with NetemProxy(self.upstream, {"stall_every_kb": 32, "stall_ms": 200}, seed=1) as proxy:
+            content, elapsed = self._fetch(proxy)
+        self.assertEqual(content, self.content)
+        self.assertGreaterEqual(proxy.snapshot()['stalls'], 2)
+        self.assertGreater(elapsed, 0.4)
+
+        with NetemProxy(self.upstream, {"drop_every_kb": 64}, seed=1) as proxy:
+            with self.assertRaises(requests.exceptions.RequestException):
+                self._fetch(proxy)
+        stats = proxy.snapshot()
+        self.assertEqual(stats['dropped'], 1)
+        self.assertLess(stats['bytes_down'], len(self.content))
+
+    def test_strategies_under_connection_drops(self):
+        """測試連線中斷時只有逐區塊續傳的策略能完成"""
+        from download_benchmark import DownloadBenchmark, STRATEGIES
+
+        benchmark = DownloadBenchmark(
+            self.temp_dir / "benchmark", size_bytes=512 * 1024, chunk_size=32 * 1024, attempts=10
+        )
+        report = benchmark.run(profiles=({"drop_every_kb": 128},))
+
+        results = report['results']['custom']
+        self.assertEqual(set(results), set(STRATEGIES))
+        # 每個連線最多傳送 192 KB，從頭下載永遠無法完成
+        self.assertEqual(results['single']['completed'], 0)
+        self.assertIsNone(results['single']['seconds'])
+        self.assertEqual(results['single']['dropped'], 10)
+        for strategy in ("parallel", "resumable"):
+            self.assertEqual(results[strategy]['completed'], 1)
+            self.assertGreater(results[strategy]['dropped'], 0)
+        self.assertEqual(list((self.temp_dir / "benchmark").iterdir()), [])
+
+class TestUpdateHandover(unittest.TestCase):
+    """以就緒通知取代固定等待的版本交接測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        import socket
+        import shutil
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.base_dir = self.temp_dir / "hello-ota"
+        self.releases = ReleaseManager(self.base_dir)
+
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+
+        self.config_file = self.temp_dir / "config.json"
+        with open(self.config_file, 'w') as f:
+            json.dump({
+                "app": {"host": "127.0.0.1", "port": self.port, "log_level": "WARNING"},
+                "ota": {"enabled": False},
+                "system": {
+                    "data_dir": str(self.temp_dir / "data"),
+                    "log_dir": str(self.temp_dir / "log"),
+                    "pid_file": str(self.temp_dir / "hello-ota.pid")
+                }
+            }, f)
+
+        for version in ("1.0.0", "1.1.0"):
+            source = self.temp_dir / f"src-{version}"
+            shutil.copytree(Path(__file__).parent.parent / "app", source,
+                            ignore=shutil.ignore_patterns("__pycache__"))
+            with open(source / "version.py", 'w') as f:
+                f.write(
+                    f'__version__ = "{version}"\n'
+                    'def get_version_info():\n'
+                    '    return {"version": __version__}\n'
+                )
+            self.releases.stage(version, source)
+
+        self.env = patch.dict(os.environ, {"HELLO_OTA_CONFIG": str(self.config_file)})
+        self.env.start()
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+        import signal
+
+        self.env.stop()
+        try:
+            response = requests.get(f"http://127.0.0.1:{self.port}/", timeout=2)
+            os.kill(response.json()['pid'], signal.SIGTERM)
+        except (requests.exceptions.RequestException, OSError):
+            pass
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def test_process_handover_records_downtime(self):
+        """測試舊行程結束後新版本送出就緒通知並記錄停機時間"""
+        from updater import ProcessController, run_update
+
+        self.releases.activate("1.0.0")
+        old_service = ProcessController([sys.executable, str(self.base_dir / "current")])
+        old_service.restart(None, timeout=10)
+        self.assertEqual(
+            requests.get(f"http://127.0.0.1:{self.port}/version", timeout=2).json()['version'], "1.0.0"
+        )
+
+        with patch('builtins.print'):
+            exit_code = run_update({
+                "app_dir": str(self.base_dir),
+                "version": "1.1.0",
+                "old_version": "1.0.0",
+                "old_pid": old_service.process.pid,
+                "update_info": {"version": "1.1.0"},
+                "data_dir": str(self.temp_dir / "data"),
+                "port": self.port,
+                "service_manager": "process",
+                "timeout": 10
+            })
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(self.releases.current_version(), "1.1.0")
+        self.assertEqual(
+            requests.get(f"http://127.0.0.1:{self.port}/version", timeout=2).json()['version'], "1.1.0"
+        )
+
+        record = UpdateHistory(self.temp_dir / "data" / "update_history.jsonl").recent(1)[0]
+        self.assertEqual(record['status'], "completed")
+        self.assertLess(record['downtime_ms'], 3000)
+        self.assertGreaterEqual(record['time_to_healthy_ms'], record['downtime_ms'])
+
+    def test_health_gate_rolls_back_wrong_version(self):
+        """測試新版本回報的版本不符時，閘門逾時後自動回滾"""
+        from updater import ProcessController, run_update
+
+        # 能啟動且 /health 正常，但 /version 不是預期的版本
+        with open(self.releases.release_dir("1.1.0") / "version.py", 'w') as f:
+            f.write(
+                '__version__ = "1.0.9"\n'
+                'def get_version_info():\n'
+                '    return {"version": __version__}\n'
+            )
+
+        self.releases.activate("1.0.0")
+        old_service = ProcessController([sys.executable, str(self.base_dir / "current")])
+        old_service.restart(None, timeout=10)
+
+        with patch('builtins.print'):
+            exit_code = run_update({
+                "app_dir": str(self.base_dir),
+                "version": "1.1.0",
+                "old_version": "1.0.0",
+                "old_pid": old_service.process.pid,
+                "update_info": {"version": "1.1.0"},
+                "data_dir": str(self.temp_dir / "data"),
+                "port": self.port,
+                "service_manager": "process",
+                "timeout": 10,
+                "health_deadline": 3
+            })
+
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(self.releases.current_version(), "1.0.0")
+        self.assertEqual(
+            requests.get(f"http://127.0.0.1:{self.port}/version", timeout=2).json()['version'], "1.0.0"
+        )
+
+        record = UpdateHistory(self.temp_dir / "data" / "update_history.jsonl").recent(1)[0]
+        self.assertEqual(record['status'], "rolled_back")
+        self.assertEqual(record['rolled_back_to'], "1.0.0")
+        self.assertIn("健康檢查", record['details']['error'])
+        self.assertGreater(record['time_to_rollback_ms'], 0)
+
+    def test_socket_handoff_refuses_no_connections(self):
+        """測試共用監聽socket交接期間持續請求不會失敗"""
+        import socket
+        from updater import ProcessController, run_update
+
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', self.port))
+        listener.listen(128)
+        self.addCleanup(listener.close)
+
+        self.releases.activate("1.0.0")
+        old_service = ProcessController(
+            [sys.executable, str(self.base_dir / "current")], listen_fd=listener.fileno()
+        )
+        old_service.restart(None, timeout=10)
+
+        results = {"ok": 0, "errors": []}
+        stop = threading.Event()
+
+        def hammer():
+            while not stop.is_set():
+                try:
+                    response = requests.get(f"http://127.0.0.1:{self.port}/health", timeout=5)
+                    response.raise_for_status()
+                    results["ok"] += 1
+                except requests.exceptions.RequestException as e:
+                    results["errors"].append(str(e))
+
+        hammer_thread = threading.Thread(target=hammer, daemon=True)
+        hammer_thread.start()
+
+        try:
+            with patch('builtins.print'):
+                exit_code = run_update({
+                    "app_dir": str(self.base_dir),
+                    "version": "1.1.0",
+                    "old_version": "1.0.0",
+                    "old_pid": old_service.process.pid,
+                    "update_info": {"version": "1.1.0"},
+                    "data_dir": str(self.temp_dir / "data"),
+                    "port": self.port,
+                    "service_manager": "process",
+                    "listen_fd": listener.fileno(),
+                    "timeout": 10
+                })
+            time.sleep(0.2)
+        finally:
+            stop.set()
+            hammer_thread.join(timeout=10)
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(results["errors"], [])
+        self.assertGreater(results["ok"], 0)
+        self.assertEqual(
+            requests.get(f"http://127.0.0.1:{self.port}/version", timeout=2).json()['version'], "1.1.0"
+        )
+
+        record = UpdateHistory(self.temp_dir / "data" / "update_history.jsonl").recent(1)[0]
+        self.assertEqual(record['downtime_ms'], 0.0)
+
+    def test_notify_ready_socket(self):
+        """測試本機就緒通知socket"""
+        from service_notify import ReadySocket, notify
+
+        with ReadySocket() as ready_socket:
+            with patch.dict(os.environ, ready_socket.environ(), clear=True):
+                self.assertTrue(notify("READY=1"))
+            self.assertTrue(ready_socket.wait_ready(timeout=1))
+
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertFalse(notify("READY=1"))
+
+class TestHotReload(unittest.TestCase):
+    """reloadable版本行程內熱更新測試"""
+
+    def setUp(self):
+        """測試前設定"""
+        import shutil
+        import main
+        from http.server import HTTPServer
+
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.base_dir = self.temp_dir / "hello-ota"
+        self.releases = ReleaseManager(self.base_dir)
+        self.app_source = Path(main.__file__).resolve().parent
+
+        # 以目前的app原始碼作為執行中的1.0.0版本
+        source = self.temp_dir / "src-1.0.0"
+        shutil.copytree(self.app_source, source, ignore=shutil.ignore_patterns("__pycache__"))
+        self.releases.stage("1.0.0", source)
+        self.releases.activate("1.0.0")
+
+        self.saved_modules = {name: sys.modules.get(name) for name in ("main", "version")}
+        self.main = main
+
+        self.ota_manager = OTAManager()
+        self.ota_manager.app_dir = self.base_dir
+        self.ota_manager.update_script = self.temp_dir / "updater.py"
+        self.ota_manager.backup_dir = self.temp_dir / "backup"
+        self.ota_manager.history = UpdateHistory(self.temp_dir / "history.jsonl")
+
+        fake_app = MagicMock(start_time=time.time(), ota_manager=self.ota_manager)
+        self.saved_app = main.app
+        main.app = fake_app
+
+        self.server = HTTPServer(('127.0.0.1', 0), main.HelloOTAHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+        from hot_reload import HotReloader
+        self.ota_manager.hot_reloader = HotReloader(self.server, fake_app)
+
+    def tearDown(self):
+        """測試後清理"""
+        import shutil
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.main.app = self.saved_app
+        for name, module in self.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        if self.temp_dir.exists():
+            shutil.rmtree(self.temp_dir)
+
+    def _make_package(self, version, patches):
+        """以目前的app原始碼建立更新包，patches 為 {檔名: (原字串, 新字串)}"""
+        import shutil
+        import tarfile
+
+        package_dir = self.temp_dir / "package" / f"v{version}" / "app"
+        shutil.copytree(self.app_source, package_dir, ignore=shutil.ignore_patterns("__pycache__"))
+        with open(package_dir / "version.py", 'w') as f:
+            f.write(
+                f'__version__ = "{version}"\n'
+                'def get_version_info():\n'
+                '    return {"version": __version__}\n'
+            )
+        for name, (old, new) in patches.items():
+            path = package_dir / name
+            path.write_text(path.read_text(encoding='utf-8').replace(old, new), encoding='utf-8')
+
+        update_file = self.temp_dir / f"v{version}.tar.gz"
+        with tarfile.open(update_file, "w:gz") as tar:
+            tar.add(package_dir.parent, arcname=f"v{version}")
+        shutil.rmtree(self.temp_dir / "package")
+        return update_file
+
+    def test_reloadable_update_swaps_handler_in_process(self):
+        """測試reloadable版本不重啟即替換處理器，sys.path 不因新版本的 main.py 增加"""
+        update_file = self._make_package("1.1.0", {
+            "main.py": ('"status": "healthy"', '"status": "healthy", "patched": True')
+        })
+        saved_path = list(sys.path)
+
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            self.ota_manager.apply_update(update_file, {"version": "1.1.0", "reloadable": True})
+
+        schedule.assert_not_called()
+        self.assertEqual(sys.path, saved_path)
+        self.assertEqual(requests.get(f"{self.url}/version", timeout=2).json()['version'], "1.1.0")
+        self.assertTrue(requests.get(f"{self.url}/health", timeout=2).json()['patched'])
+        self.assertEqual(self.releases.current_version(), "1.1.0")
+
+        record = self.ota_manager.get_update_history(1)[0]
+        self.assertEqual(record['mode'], "hot_reload")
+        self.assertEqual(record['downtime_ms'], 0.0)
+
+    def test_unsafe_change_falls_back_to_restart(self):
+        """測試非處理邏輯模組有變動時改走重啟流程"""
+        update_file = self._make_package("1.1.0", {
+            "config.py": ('"check_interval": 300', '"check_interval": 600')
+        })
+        original_handler = self.server.RequestHandlerClass
+
+        with patch.object(OTAManager, '_schedule_update_handover') as schedule:
+            self.ota_manager.apply_update(update_file, {"version": "1.1.0", "reloadable": True})
+
+        schedule.assert_called_once()
+        self.assertIs(self.server.RequestHandlerClass, original_handler)
+        self.assertIs(sys.modules["main"], self.saved_modules["main"])
+        self.assertEqual(self.releases.current_version(), "1.0.0")
+        self.assertNotEqual(requests.get(f"{self.url}/version", timeout=2).json()['version'], "1.1.0")
+
+class TestEndToEnd(unittest.TestCase):
+    """沙箱中的完整更新循環測試（臨時埠、測試用的服務管理器）"""
+
+    # 目前單一沙箱每次循環約 1.1 秒、兩個沙箱同時執行約 1.6-1.9 秒，停機約 0.4-0.7 秒；
+    # 上限保留約兩倍餘裕以容忍同時執行其他測試，超過時表示更新路徑變慢
+    MAX_TOTAL_MS = 3500
+    MAX_DOWNTIME_MS = 1500
+
+    def setUp(self):
+        """測試前設定"""
+        from e2e_harness import OTASandbox
+
+        self.sandbox = OTASandbox().start()
+
+    def tearDown(self):
+        """測試後清理"""
+        self.sandbox.close()
+
+    def test_update_cycle_in_sandbox(self):
+        """測試檢查、下載、套用、重啟與健康檢查都在沙箱中完成"""
+        for version in ("1.1.0", "1.2.0"):
+            self.sandbox.publish(version)
+            result = self.sandbox.run_cycle(version)
+
+            self.assertEqual(result['status'], "completed")
+            self.assertEqual(result['running_version'], version)
+            self.assertIsNotNone(result['time_to_healthy_ms'])
+            self.assertLess(result['downtime_ms'], self.MAX_DOWNTIME_MS)
+            self.assertLess(result['total_ms'], self.MAX_TOTAL_MS)
+
+        self.assertEqual(result['restarts'], 2)
+        self.assertTrue((self.sandbox.root / "tmp" / "hello_ota_updater.py").exists())
+        self.assertEqual(
+            sorted(p.name for p in (self.sandbox.app_dir / "releases").iterdir()), ["1.0.0", "1.1.0", "1.2.0"]
+        )
+
+    def test_failed_start_rolls_back(self):
+        """測試新版本啟動失敗時回滾，舊版本恢復服務"""
+        def break_startup(tree):
+            (tree / "__main__.py").write_text("raise SystemExit('啟動失敗')\n")
+
+        self.sandbox.publish("1.1.0", prepare=break_startup)
+        result = self.sandbox.run_cycle("1.1.0")
+
+        self.assertEqual(result['status'], "rolled_back")
+        self.assertEqual(result['running_version'], "1.0.0")
+        self.assertEqual(self.sandbox.history()[-1]['rolled_back_to'], "1.0.0")
+
 class TestOTAIntegration(unittest.TestCase):
     """OTA整合測試"""
 
@@ -157,42 +2813,51 @@ class TestOTAIntegration(unittest.TestCase):
 
     def setUp(self):
         """測試前設定"""
+        # 範例更新包建立在臨時目錄，不在原始碼樹中留下產生的檔案
+        self.temp_dir = Path(tempfile.mkdtemp())
         # 啟動模擬服務器
         self._start_mock_server()
 
     def tearDown(self):
         """測試後清理"""
+        import shutil
+
         # 停止模擬服務器
         self._stop_mock_server()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
 
     def _start_mock_server(self):
         """啟動模擬服務器"""
-        def run_server():
-            from mock_server import MockUpdateServerHandler
-            from http.server import HTTPServer
+        import io
+        from contextlib import redirect_stdout
+        from mock_server import MockUpdateServerHandler, create_sample_update
+        from http.server import HTTPServer
+
+        with redirect_stdout(io.StringIO()):
+            create_sample_update(self.temp_dir)
+        handler = type("Handler", (MockUpdateServerHandler,), {"updates_dir": self.temp_dir, "quiet": True})
 
-            server = HTTPServer(('localhost', 9001), MockUpdateServerHandler)
-            self.__class__.mock_server = server
-            server.serve_forever()
+        # 臨時埠：綁定後即可接受連線，不需等待，也不與其他測試衝突
+        server = HTTPServer(('localhost', 0), handler)
+        self.__class__.mock_server = server
+        self.base_url = f"http://localhost:{server.server_port}"
 
-        self.__class__.mock_server_thread = threading.Thread(target=run_server)
+        self.__class__.mock_server_thread = threading.Thread(target=server.serve_forever)
         self.__class__.mock_server_thread.daemon = True
         self.__class__.mock_server_thread.start()
 
-        # 等待服務器啟動
-        time.sleep(1)
-
     def _stop_mock_server(self):
         """停止模擬服務器"""
         if self.__class__.mock_server:
             self.__class__.mock_server.shutdown()
+            self.__class__.mock_server.server_close()
             self.__class__.mock_server = None
 
     def test_check_update_api(self):
         """測試檢查更新API"""
         try:
             response = requests.get(
-                "http://localhost:9001/api/check_update",
+                f"{self.base_url}/api/check_update",
                 params={"current_version": "1.0.0"},
                 timeout=5
             )
@@ -210,13 +2875,13 @@ class TestOTAIntegration(unittest.TestCase):
         """測試下載更新檔案"""
         try:
             response = requests.get(
-                "http://localhost:9001/updates/v1.1.0.tar.gz",
+                f"{self.base_url}/updates/v1.1.0.tar.gz",
                 timeout=5
             )
 
-            # 如果檔案存在，應該返回200
-            # 如果檔案不存在，應該返回404
-            self.assertIn(response.status_code, [200, 404])
+            # 範例更新包已建立在模擬服務器的更新目錄
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Type'], 'application/gzip')
 
         except requests.exceptions.RequestException:
             self.skipTest("模擬服務器未啟動")
@@ -260,6 +2925,67 @@ class TestConfig(unittest.TestCase):
         # 測試預設值
         self.assertEqual(config.get('nonexistent.key', 'default'), 'default')
 
+    def test_release_config_overlay(self):
+        """測試版本設定優先於本機設定，且寫入時不會寫進版本設定"""
+        release_config_file = Path(tempfile.mktemp(suffix='.json'))
+        release_config_file.write_text(json.dumps({"ota": {"check_interval": 42}}))
+        try:
+            config = Config(str(self.temp_config_file), flush_delay=0, release_config_file=release_config_file)
+
+            self.assertEqual(config.get('ota.check_interval'), 42)
+            self.assertEqual(config.get('app.port'), 8080)
+
+            config.set('ota.backup_count', 7)
+            self.assertEqual(config.get('ota.backup_count'), 7)
+            self.assertEqual(json.loads(release_config_file.read_text()), {"ota": {"check_interval": 42}})
+            with open(self.temp_config_file, 'r', encoding='utf-8') as f:
+                self.assertEqual(json.load(f)['ota']['check_interval'], 300)
+
+            # 版本設定提供的鍵在本機寫入不會生效，直接拒絕
+            with self.assertRaises(Exception):
+                config.set('ota.check_interval', 10)
+            self.assertEqual(config.get('ota.check_interval'), 42)
+        finally:
+            release_config_file.unlink()
+
+    def test_config_batched_writes(self):
+        """測試窗口內的多次設定只寫入一次"""
+        config = Config(str(self.temp_config_file), flush_delay=0.2)
+        initial_writes = config.write_count
+
+        for i in range(20):
+            config.set('batch.value', i)
+
+        # 窗口內尚未寫入
+        self.assertEqual(config.write_count, initial_writes)
+
+        time.sleep(0.5)
+        self.assertEqual(config.write_count, initial_writes + 1)
+
+        with open(self.temp_config_file, 'r', encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['batch']['value'], 19)
+
+    def test_config_transaction(self):
+        """測試交易區塊離開時只寫入一次"""
+        config = Config(str(self.temp_config_file), flush_delay=60)
+        initial_writes = config.write_count
+
+        with config.transaction():
+            config.set('ota.auto_update', True)
+            config.set('ota.check_interval', 60)
+            config.set('app.port', 8081)
+            self.assertEqual(config.write_count, initial_writes)
+
+        self.assertEqual(config.write_count, initial_writes + 1)
+
+        reloaded = Config(str(self.temp_config_file))
+        self.assertEqual(reloaded.get('app.port'), 8081)
+        self.assertTrue(reloaded.get('ota.auto_update'))
+
+        # 不應殘留暫存檔
+        leftovers = list(self.temp_config_file.parent.glob(f".{self.temp_config_file.name}.*"))
+        self.assertEqual(leftovers, [])
+
 def run_performance_test():
     """執行效能測試"""
     print("執行效能測試...")
@@ -294,6 +3020,234 @@ def run_performance_test():
         if large_file.exists():
             large_file.unlink()
 
+    run_logging_benchmark()
+    run_release_format_benchmark()
+    run_update_latency_benchmark()
+    run_pipeline_benchmark()
+
+def run_pipeline_benchmark(sizes_mb=(1, 50)):
+    """OTA流程各階段耗時（完整的1/50/500 MB基準與退步比較請執行 tests/ota_benchmark.py）"""
+    from ota_benchmark import PipelineBenchmark, format_table
+
+    temp_dir = Path(tempfile.mkdtemp())
+    try:
+        report = PipelineBenchmark(temp_dir).run(sizes_mb)
+    finally:
+        import shutil
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    print()
+    print("OTA流程各階段耗時:")
+    print(format_table(report))
+
+def run_logging_benchmark(records=20000):
+    """比較同步檔案日誌與佇列日誌每筆記錄的呼叫端開銷"""
+    import logging
+    import shutil
+
+    temp_dir = Path(tempfile.mkdtemp())
+    bench_logger = logging.getLogger("bench.logging")
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def measure(handler):
+        bench_logger.addHandler(handler)
+        start_time = time.perf_counter()
+        for i in range(records):
+            bench_logger.info("下載進度: %d", i)
+        elapsed = time.perf_counter() - start_time
+        bench_logger.removeHandler(handler)
+        return elapsed / records * 1e6
+
+    try:
+        file_handler = logging.FileHandler(temp_dir / "sync.log")
+        file_handler.setFormatter(formatter)
+        sync_us = measure(file_handler)
+        file_handler.close()
+
+        import queue
+        import logging.handlers
+        log_queue = queue.SimpleQueue()
+        queued_file = logging.FileHandler(temp_dir / "queued.log")
+        queued_file.setFormatter(formatter)
+        listener = logging.handlers.QueueListener(log_queue, queued_file)
+        listener.start()
+        queue_us = measure(logging.handlers.QueueHandler(log_queue))
+        listener.stop()
+        queued_file.close()
+
+        print(f"日誌開銷 (每筆, {records:,} 筆):")
+        print(f"  同步 FileHandler: {sync_us:.2f} µs")
+        print(f"  QueueHandler:     {queue_us:.2f} µs")
+    finally:
+        shutil.rmtree(temp_dir)
+
+def run_release_format_benchmark(runs=5):
+    """比較tar與zipapp兩種版本格式的套用時間與啟動時間"""
+    import shutil
+    import statistics
+
+    sys.path.insert(0, str(Path(__file__).parent.parent / "updates"))
+    from create_update import UpdatePackageCreator
+
+    temp_dir = Path(tempfile.mkdtemp())
+    try:
+        creator = UpdatePackageCreator()
+        with patch('builtins.print'):
+            tar_file, _ = creator.create_update_package("9.0.0", output_dir=temp_dir / "tar")
+            pyz_file, _ = creator.create_update_package(
+                "9.0.1", output_dir=temp_dir / "zip", package_format="zipapp"
+            )
+
+        releases = ReleaseManager(temp_dir / "hello-ota")
+        ota_manager = OTAManager()
+
+        start_time = time.perf_counter()
+        ota_manager._stage_tarball(tar_file, "9.0.0", releases)
+        tar_apply = time.perf_counter() - start_time
+
+        staging = releases.staging_archive("9.0.1")
+        shutil.copy2(pyz_file, staging)
+        start_time = time.perf_counter()
+        ota_manager._stage_zipapp(staging, "9.0.1", releases)
+        zip_apply = time.perf_counter() - start_time
+
+        def startup_time(path):
+            code = "import sys; sys.path.insert(0, sys.argv[1]); import main, ota_manager"
+            samples = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                subprocess.run([sys.executable, "-I", "-c", code, str(path)], check=True)
+                samples.append(time.perf_counter() - started)
+            return statistics.median(samples)
+
+        print("版本格式比較:")
+        print(f"  套用時間  tar: {tar_apply * 1000:.1f} ms, zipapp: {zip_apply * 1000:.1f} ms")
+        print(f"  啟動匯入  tar: {startup_time(releases.release_path('9.0.0')) * 1000:.1f} ms, "
+              f"zipapp: {startup_time(releases.release_path('9.0.1')) * 1000:.1f} ms")
+    finally:
+        shutil.rmtree(temp_dir)
+        sys.path.remove(str(Path(__file__).parent.parent / "updates"))
+
+def run_update_latency_benchmark(package_mb=30, interval=0.01):
+    """比較更新期間的請求延遲：不更新、在服務行程內更新、在低優先權工作行程中更新"""
+    import shutil
+    import hashlib
+    import functools
+    import statistics
+    from http.server import HTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+
+    import tarfile
+
+    class TransactionHandler(BaseHTTPRequestHandler):
+        """模擬交易處理：每個請求做少量CPU工作"""
+        def do_GET(self):
+            body = hashlib.sha256(b"x" * 64 * 1024).hexdigest().encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    temp_dir = Path(tempfile.mkdtemp())
+    servers = []
+    try:
+        # 含大型資料檔的更新包，讓下載、校驗與解壓縮有實際負載
+        source = temp_dir / "package" / "v9.1.0" / "app"
+        shutil.copytree(Path(__file__).parent.parent / "app", source,
+                        ignore=shutil.ignore_patterns("__pycache__"))
+        (source / "version.py").write_text('__version__ = "9.1.0"\ndef get_version_info():\n    return {}\n')
+        with open(source / "assets.bin", 'wb') as f:
+            f.write(os.urandom(package_mb * 1024 * 1024))
+
+        package_file = temp_dir / "out" / "v9.1.0.tar.gz"
+        package_file.parent.mkdir()
+        with tarfile.open(package_file, "w:gz") as tar:
+            tar.add(source.parent, arcname="v9.1.0")
+        update_info = {
+            "version": "9.1.0",
+            "checksum": hashlib.sha256(package_file.read_bytes()).hexdigest(),
+            "size": package_file.stat().st_size
+        }
+
+        file_handler = functools.partial(SimpleHTTPRequestHandler, directory=str(package_file.parent))
+        file_handler.log_message = lambda *args: None
+        for handler in (TransactionHandler, file_handler):
+            server = HTTPServer(('127.0.0.1', 0), handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append(server)
+        transaction_url = f"http://127.0.0.1:{servers[0].server_port}/"
+        update_info['download_url'] = f"http://127.0.0.1:{servers[1].server_port}/{package_file.name}"
+
+        def measure(action):
+            samples = []
+            done = threading.Event()
+
+            def client():
+                session = requests.Session()
+                while not done.is_set():
+                    started = time.perf_counter()
+                    session.get(transaction_url, timeout=10)
+                    samples.append((time.perf_counter() - started) * 1000)
+                    time.sleep(interval)
+
+            client_thread = threading.Thread(target=client)
+            client_thread.start()
+            started = time.perf_counter()
+            action()
+            elapsed = time.perf_counter() - started
+            done.set()
+            client_thread.join()
+
+            samples.sort()
+            return {
+                "p50": statistics.median(samples),
+                "p99": samples[min(int(len(samples) * 0.99), len(samples) - 1)],
+                "seconds": elapsed
+            }
+
+        def update(background, run):
+            base_dir = temp_dir / f"hello-ota-{run}"
+            releases = ReleaseManager(base_dir)
+            current = temp_dir / f"current-{run}"
+            current.mkdir()
+            (current / "main.py").write_text("")
+            releases.stage("9.0.0", current)
+            releases.activate("9.0.0")
+
+            ota_manager = OTAManager()
+            ota_manager.app_dir = base_dir
+            ota_manager.temp_dir = temp_dir / f"tmp-{run}"
+            ota_manager.update_script = temp_dir / f"updater-{run}.py"
+            ota_manager.history = UpdateHistory(temp_dir / f"history-{run}.jsonl")
+
+            original_get = config.get
+            overrides = {'ota.background_worker': background}
+            with patch.object(OTAManager, '_schedule_update_handover'), \
+                    patch.object(config, 'get', lambda key, default=None: overrides.get(
+                        key, original_get(key, default))):
+                ota_manager.perform_update(update_info)
+
+        from config import config
+        results = {
+            "無更新": measure(lambda: time.sleep(3)),
+            "服務行程內更新": measure(lambda: update(False, "inline")),
+            "低優先權工作行程": measure(lambda: update(True, "worker")),
+        }
+
+        print(f"更新期間交易請求延遲（{package_mb}MB更新包）:")
+        for name, result in results.items():
+            print(f"  {name}: p50 {result['p50']:.2f} ms, p99 {result['p99']:.2f} ms, "
+                  f"耗時 {result['seconds']:.1f}秒")
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(temp_dir)
+
 def run_manual_tests():
     """執行手動測試"""
     print("執行手動測試...")
@@ -309,6 +3263,7 @@ def run_manual_tests():
     print("   curl http://localhost:8080/health")
     print("   curl http://localhost:8080/version")
     print("   curl http://localhost:8080/ota/status")
+    print("   curl 'http://localhost:8080/ota/history?status=failed&limit=10'")
     print()
     print("4. 觸發更新:")
     print("   curl -X POST http://localhost:8080/trigger_update \\")
@@ -339,6 +3294,27 @@ def main():
     # 添加測試
     suite.addTests(loader.loadTestsFromTestCase(TestOTAManager))
     suite.addTests(loader.loadTestsFromTestCase(TestConfig))
+    suite.addTests(loader.loadTestsFromTestCase(TestUpdateHistory))
+    suite.addTests(loader.loadTestsFromTestCase(TestFlashIO))
+    suite.addTests(loader.loadTestsFromTestCase(TestMemoryBudget))
+    suite.addTests(loader.loadTestsFromTestCase(TestLogPipeline))
+    suite.addTests(loader.loadTestsFromTestCase(TestStartup))
+    suite.addTests(loader.loadTestsFromTestCase(TestReleaseSlots))
+    suite.addTests(loader.loadTestsFromTestCase(TestZipappRelease))
+    suite.addTests(loader.loadTestsFromTestCase(TestBackgroundWorker))
+    suite.addTests(loader.loadTestsFromTestCase(TestComponentUpdate))
+    suite.addTests(loader.loadTestsFromTestCase(TestUpdateScheduler))
+    suite.addTests(loader.loadTestsFromTestCase(TestPeerCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestChunkVerification))
+    suite.addTests(loader.loadTestsFromTestCase(TestMirrorDownload))
+    suite.addTests(loader.loadTestsFromTestCase(TestUpdateWatcher))
+    suite.addTests(loader.loadTestsFromTestCase(TestMQTTTransport))
+    suite.addTests(loader.loadTestsFromTestCase(TestFleetSimulator))
+    suite.addTests(loader.loadTestsFromTestCase(TestPipelineBenchmark))
+    suite.addTests(loader.loadTestsFromTestCase(TestNetworkSimulator))
+    suite.addTests(loader.loadTestsFromTestCase(TestUpdateHandover))
+    suite.addTests(loader.loadTestsFromTestCase(TestHotReload))
+    suite.addTests(loader.loadTestsFromTestCase(TestEndToEnd))
     suite.addTests(loader.loadTestsFromTestCase(TestOTAIntegration))
 
     # 執行測試
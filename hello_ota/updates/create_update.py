@@ -13,6 +13,13 @@ import argparse
 from pathlib import Path
 from datetime import datetime
 
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+if str(APP_DIR) not in sys.path:
+    sys.path.insert(0, str(APP_DIR))
+
+# 區塊雜湊與雜湊樹根和裝置端使用同一份實作，格式不會不一致
+from chunk_verify import build_chunk_info
+
 class UpdatePackageCreator:
     """更新包建立器"""
 
@@ -20,8 +27,15 @@ class UpdatePackageCreator:
         self.script_dir = Path(__file__).parent
         self.project_dir = self.script_dir.parent
 
-    def create_update_package(self, version, source_dir=None, output_dir=None):
-        """建立更新包"""
+    def create_update_package(self, version, source_dir=None, output_dir=None, package_format="tar",
+                              reloadable=False, deps_dir=None, config_file=None):
+        """建立更新包
+
+        package_format 為 "tar"（解開成目錄）或 "zipapp"（預先編譯的單一 .pyz 封存檔）
+        reloadable 表示只修改請求處理邏輯，裝置可在行程內熱更新
+        deps_dir（相依套件目錄）或 config_file（版本設定JSON）指定時建立多元件更新，
+        裝置將所有元件放入同一個版本槽位，一起切換、一起回滾
+        """
         if source_dir is None:
             source_dir = self.project_dir / "app"
 
@@ -34,6 +48,9 @@ class UpdatePackageCreator:
         if not source_dir.exists():
             raise FileNotFoundError(f"來源目錄不存在: {source_dir}")
 
+        if (deps_dir or config_file) and package_format != "tar":
+            raise ValueError("多元件更新只支援tar格式")
+
         print(f"建立更新包 v{version}")
         print(f"來源目錄: {source_dir}")
         print(f"輸出目錄: {output_dir}")
@@ -55,10 +72,19 @@ class UpdatePackageCreator:
         self._copy_source_files(source_dir, app_dir, version)
 
         # 建立壓縮檔
-        tar_file = self._create_tar_package(version_dir, output_dir, version)
+        if package_format == "zipapp":
+            tar_file = self._create_zipapp_package(app_dir, output_dir, version)
+        else:
+            tar_file = self._create_tar_package(version_dir, output_dir, version)
 
         # 建立更新資訊檔案
-        update_info = self._create_update_info(tar_file, version)
+        update_info = self._create_update_info(tar_file, version, package_format)
+        if reloadable:
+            update_info["reloadable"] = True
+        if deps_dir or config_file:
+            update_info["components"] = self._create_components(
+                update_info, output_dir, version, deps_dir, config_file
+            )
         info_file = output_dir / f"v{version}_info.json"
 
         with open(info_file, 'w', encoding='utf-8') as f:
@@ -69,6 +95,8 @@ class UpdatePackageCreator:
         print(f"   - 資訊檔: {info_file}")
         print(f"   - 檔案大小: {tar_file.stat().st_size:,} bytes")
         print(f"   - 校驗和: {update_info['checksum']}")
+        for component in update_info.get("components", []):
+            print(f"   - 元件 {component['name']}: {component['version']} ({component['strategy']})")
 
         return tar_file, info_file
 
@@ -125,6 +153,107 @@ def get_version_info():
 
         return tar_file
 
+    def _create_zipapp_package(self, app_dir, output_dir, version):
+        """建立只含 .pyc 與清單的 zipapp，裝置上以 zipimport 直接執行"""
+        import zipfile
+        import tempfile
+        import py_compile
+        import importlib.util
+
+        zip_file = output_dir / f"v{version}.pyz"
+
+        print(f"建立zipapp封存檔: {zip_file.name}")
+
+        files = {}
+        with tempfile.TemporaryDirectory() as build_dir, open(zip_file, 'wb') as f:
+            f.write(b"#!/usr/bin/env python3\n")
+
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for source in sorted(app_dir.glob("*.py")):
+                    arcname = f"{source.stem}.pyc"
+                    compiled = Path(build_dir) / arcname
+
+                    # 封存檔內沒有原始碼，使用不檢查來源的雜湊式pyc
+                    py_compile.compile(
+                        str(source),
+                        cfile=str(compiled),
+                        dfile=f"v{version}.pyz/{source.name}",
+                        doraise=True,
+                        invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH
+                    )
+                    archive.write(compiled, arcname)
+                    files[arcname] = self._calculate_checksum(compiled)
+
+                manifest = {
+                    "version": version,
+                    "format": "zipapp",
+                    "python_magic": importlib.util.MAGIC_NUMBER.hex(),
+                    "python_tag": sys.implementation.cache_tag,
+                    "created_at": datetime.now().isoformat(),
+                    "files": files
+                }
+                archive.writestr("MANIFEST.json", json.dumps(manifest, indent=2, ensure_ascii=False))
+
+        return zip_file
+
+    def _create_components(self, update_info, output_dir, version, deps_dir=None, config_file=None):
+        """建立多元件更新的元件清單
+
+        元件版本為內容摘要，內容未變動時版本相同，裝置沿用已安裝的元件而不下載。
+        """
+        components = [self._component_info(
+            "app", version, "release", output_dir / update_info['filename']
+        )]
+
+        if deps_dir:
+            deps_dir = Path(deps_dir)
+            if not deps_dir.is_dir():
+                raise FileNotFoundError(f"相依套件目錄不存在: {deps_dir}")
+            deps_file = output_dir / f"v{version}-deps.tar.gz"
+            print(f"建立相依套件壓縮包: {deps_file.name}")
+            with tarfile.open(deps_file, "w:gz") as tar:
+                for path in sorted(deps_dir.iterdir()):
+                    tar.add(path, arcname=path.name)
+            components.append(self._component_info(
+                "deps", self._content_digest(deps_dir), "site-packages", deps_file
+            ))
+
+        if config_file:
+            with open(config_file, 'r', encoding='utf-8') as f:
+                release_config = json.load(f)
+            if not isinstance(release_config, dict):
+                raise ValueError("版本設定必須是JSON物件")
+            target = output_dir / f"v{version}-config.json"
+            with open(target, 'w', encoding='utf-8') as f:
+                json.dump(release_config, f, indent=2, ensure_ascii=False, sort_keys=True)
+            components.append(self._component_info(
+                "config", self._calculate_checksum(target)[:12], "config", target
+            ))
+
+        return components
+
+    def _component_info(self, name, component_version, strategy, file_path):
+        return {
+            "name": name,
+            "version": component_version,
+            "strategy": strategy,
+            "filename": file_path.name,
+            "size": file_path.stat().st_size,
+            "checksum": self._calculate_checksum(file_path),
+            "chunks": build_chunk_info(file_path),
+            "download_url": f"http://localhost:9000/updates/{file_path.name}"
+        }
+
+    def _content_digest(self, directory):
+        """目錄內容（相對路徑與檔案內容）的摘要，與壓縮時間無關"""
+        digest = hashlib.sha256()
+        for path in sorted(p for p in Path(directory).rglob("*") if p.is_file()):
+            if "__pycache__" in path.parts:
+                continue
+            digest.update(str(path.relative_to(directory)).encode('utf-8') + b"\0")
+            digest.update(self._calculate_checksum(path).encode('ascii'))
+        return digest.hexdigest()[:12]
+
     def _calculate_checksum(self, file_path):
         """計算檔案SHA256校驗和"""
         sha256_hash = hashlib.sha256()
@@ -135,16 +264,18 @@ def get_version_info():
 
         return sha256_hash.hexdigest()
 
-    def _create_update_info(self, tar_file, version):
+    def _create_update_info(self, tar_file, version, package_format="tar"):
         """建立更新資訊"""
         checksum = self._calculate_checksum(tar_file)
         file_size = tar_file.stat().st_size
 
         return {
             "version": version,
+            "format": package_format,
             "filename": tar_file.name,
             "size": file_size,
             "checksum": checksum,
+            "chunks": build_chunk_info(tar_file),
             "created_at": datetime.now().isoformat(),
             "download_url": f"http://localhost:9000/updates/{tar_file.name}",
             "release_notes": f"更新到版本 {version}",
@@ -165,12 +296,11 @@ def get_version_info():
         print("=============")
 
         updates = []
-        for tar_file in self.script_dir.glob("v*.tar.gz"):
-            info_file = self.script_dir / f"{tar_file.stem}_info.json"
+        for info_file in self.script_dir.glob("v*_info.json"):
+            with open(info_file, 'r', encoding='utf-8') as f:
+                info = json.load(f)
 
-            if info_file.exists():
-                with open(info_file, 'r', encoding='utf-8') as f:
-                    info = json.load(f)
+            if (self.script_dir / info['filename']).exists():
                 updates.append(info)
 
         if not updates:
@@ -181,7 +311,7 @@ def get_version_info():
 
         for update in updates:
             print(f"版本: {update['version']}")
-            print(f"  檔案: {update['filename']}")
+            print(f"  檔案: {update['filename']} ({update.get('format', 'tar')})")
             print(f"  大小: {update['size']:,} bytes")
             print(f"  建立時間: {update['created_at']}")
             print(f"  校驗和: {update['checksum'][:16]}...")
@@ -189,13 +319,8 @@ def get_version_info():
 
     def verify_package(self, version):
         """驗證更新包完整性"""
-        tar_file = self.script_dir / f"v{version}.tar.gz"
         info_file = self.script_dir / f"v{version}_info.json"
 
-        if not tar_file.exists():
-            print(f"❌ 更新包不存在: {tar_file}")
-            return False
-
         if not info_file.exists():
             print(f"❌ 資訊檔不存在: {info_file}")
             return False
@@ -204,6 +329,12 @@ def get_version_info():
         with open(info_file, 'r', encoding='utf-8') as f:
             info = json.load(f)
 
+        tar_file = self.script_dir / info['filename']
+
+        if not tar_file.exists():
+            print(f"❌ 更新包不存在: {tar_file}")
+            return False
+
         # 驗證檔案大小
         actual_size = tar_file.stat().st_size
         expected_size = info['size']
@@ -271,6 +402,16 @@ def main():
     create_parser.add_argument("--version", required=True, help="版本號 (例如: 1.1.0)")
     create_parser.add_argument("--source", help="來源目錄路徑")
     create_parser.add_argument("--output", help="輸出目錄路徑")
+    create_parser.add_argument(
+        "--format", choices=["tar", "zipapp"], default="tar",
+        help="更新包格式: tar（解開成目錄）或 zipapp（預先編譯的單一 .pyz 檔）"
+    )
+    create_parser.add_argument(
+        "--reloadable", action="store_true",
+        help="只修改請求處理邏輯（main.py），裝置可不重啟直接熱更新"
+    )
+    create_parser.add_argument("--deps", help="相依套件目錄（建立多元件更新）")
+    create_parser.add_argument("--config-file", help="隨版本發佈的設定JSON（建立多元件更新）")
 
     # 列出更新包命令
     list_parser = subparsers.add_parser("list", help="列出可用更新包")
@@ -297,7 +438,11 @@ def main():
             creator.create_update_package(
                 version=args.version,
                 source_dir=args.source,
-                output_dir=args.output
+                output_dir=args.output,
+                package_format=args.format,
+                reloadable=args.reloadable,
+                deps_dir=args.deps,
+                config_file=args.config_file
             )
 
         elif args.command == "list":